@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+""" Compares the JSON codecs on the router's message mix. For each
+    payload size, CALL and PUBLISH frames are decoded (as they arrive
+    from clients) and RESULT and EVENT messages are encoded (as they
+    go out), which is what the router spends its serialization time on.
+
+    Codecs that aren't installed are skipped.
+
+    Usage: PYTHONPATH=. python benchmarks/bench_codec.py [iterations]
+"""
+
+import sys
+import time
+
+from swampyer.messages import CALL, RESULT, EVENT, PUBLISH
+
+from izaber_flask_wamp.jsoncodec import JSON_CODEC_CLASSES, JSON_CODECS
+
+SIZES = [ 64, 1024, 16*1024, 256*1024 ]
+
+def payload(size):
+    """ Something shaped like real data: a dict of mixed values with a
+        list of records, roughly size bytes once encoded
+    """
+    record = {
+        'id': 12345,
+        'name': u'device-é',
+        'value': 3.14159,
+        'ok': True,
+        'tags': ['a','b'],
+    }
+    count = max(1,size//90)
+    return {
+        'records': [ dict(record,id=i) for i in range(count) ],
+        'total': count,
+    }
+
+def messages(size):
+    data = payload(size)
+    return {
+        'CALL': CALL(request_id=1,options={},procedure='com.example.get',
+                        args=[data],kwargs={}),
+        'PUBLISH': PUBLISH(request_id=2,options={},topic='com.example.topic',
+                        args=[],kwargs=data),
+        'RESULT': RESULT(request_id=1,details={},args=[data],kwargs={}),
+        'EVENT': EVENT(subscription_id=3,publish_id=4,details={},
+                        args=[],kwargs=data),
+    }
+
+def measure(function,iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        function()
+    return ( time.perf_counter() - start ) / iterations * 1e6
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    codecs = []
+    for name in JSON_CODECS:
+        try:
+            codecs.append(JSON_CODEC_CLASSES[name]())
+        except ImportError:
+            print("{}: not installed".format(name))
+
+    print("{:>8} {:>8} {:>8} {:>12} {:>10}".format(
+            'size','message','codec','us/message','bytes'))
+    for size in SIZES:
+        loops = max(10,iterations*64//size)
+        for kind, message in messages(size).items():
+            data = message.package()
+            for codec in codecs:
+                encoded = codec.dumps(data)
+                if kind in ('CALL','PUBLISH'):
+                    cost = measure(lambda: codec.loads(encoded),loops)
+                else:
+                    cost = measure(lambda: codec.dumps(data),loops)
+                print("{:>8} {:>8} {:>8} {:>12.2f} {:>10}".format(
+                        size,kind,codec.name,cost,len(encoded)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+""" Measures the cost of sending many small messages to a single
+    connection with outbound coalescing turned on and off.
+
+    Socket writes are counted with a fake stream under a real
+    geventwebsocket WebSocket, so "writes" is the number of write
+    syscalls the connection would have made.
+
+    Usage: PYTHONPATH=. python benchmarks/bench_outbound.py [messages] [size]
+"""
+
+import sys
+import time
+
+import gevent
+from geventwebsocket.websocket import WebSocket
+
+from izaber_flask_wamp.outbound import WAMPOutboundQueue
+
+class CountingStream(object):
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self,data):
+        self.writes += 1
+        self.bytes += len(data)
+
+    def read(self,size):
+        return b''
+
+def run(messages,size,coalesce):
+    stream = CountingStream()
+    ws = WebSocket({},stream,None)
+    outbound = WAMPOutboundQueue(
+                    ws,
+                    depth=messages,
+                    coalesce=coalesce,
+                    coalesce_window=1,
+                )
+    outbound.start()
+
+    frame = u'[36,1,2,{},["%s"]]' % ( 'x' * size )
+
+    cpu_start = time.process_time()
+    wall_start = time.time()
+
+    # Publish in bursts like a busy topic would
+    for i in range(messages):
+        outbound.put(frame)
+        if i % 100 == 99:
+            gevent.sleep(0)
+    while len(outbound):
+        gevent.sleep(0.001)
+
+    cpu = time.process_time() - cpu_start
+    wall = time.time() - wall_start
+    outbound.close()
+
+    return {
+        'coalesce': coalesce,
+        'writes': stream.writes,
+        'bytes': stream.bytes,
+        'cpu_us_per_msg': cpu / messages * 1e6,
+        'wall_s': wall,
+    }
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    print("{} messages of ~{} bytes".format(messages,size))
+    for coalesce in (False,True):
+        result = run(messages,size,coalesce)
+        print("coalesce={coalesce!s:5} writes={writes:7d} "
+              "writes/msg={ratio:.4f} cpu/msg={cpu_us_per_msg:.2f}us "
+              "wall={wall_s:.3f}s".format(
+                    ratio=result['writes']/float(messages),
+                    **result
+              ))
+
+if __name__ == '__main__':
+    main()
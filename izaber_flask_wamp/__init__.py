@@ -16,8 +16,20 @@ from izaber.log import log
 from izaber.paths import paths
 import izaber.flask
 
+from .jsoncodec import *
 from .common import *
+from .timers import *
 from .uri import *
+from .executors import *
+from .outbound import *
+from .conflation import *
+from .retention import *
+from .history import *
+from .filters import *
+from .delta import *
+from .passthrough import *
+from .rawsocket import *
+from .deflate import *
 from .registrations import *
 from .authorizers import *
 from .app import *
@@ -34,6 +46,61 @@ default:
             realm: izaber
             cookie_name: zfwid
             cookie_fname: '{{cookie_value}}.json'
+            match_cache_size: 1024
+            call_timeout: null
+            serializers:
+                - json
+                - msgpack
+            json_codec: auto
+            payload_transparency:
+                enabled: false
+                min_bytes: 4096
+            retention:
+                depth: 1
+                max_bytes: 16777216
+                topics: {}
+            delta:
+                max_topics: 10000
+            history:
+                path: null
+                topics: []
+                segment_bytes: 8388608
+                max_bytes: 268435456
+                max_age: 86400
+                queue_depth: 10000
+                max_open: 64
+            rawsocket:
+                tcp: null
+                unix: null
+                max_length_exp: 15
+            deflate:
+                enabled: false
+                min_bytes: 1024
+                level: 6
+                server_no_context_takeover: false
+                client_no_context_takeover: false
+                server_max_window_bits: 15
+                client_max_window_bits: 15
+                max_message_bytes: 16777216
+            batch_publish:
+                path: null
+                authrole: anonymous
+            outbound:
+                depth: 1000
+                policy: disconnect
+                block_timeout: 1
+                coalesce: false
+                coalesce_window: 2
+                coalesce_bytes: 65536
+            executor:
+                workers: 16
+                queue_depth: 1024
+                greenlets: 1000
+                coroutines: 10000
+                processes: null
+                max_tasks_per_child: null
+                process_queue_depth: 1024
+                process_start_method: spawn
     paths:
         cookies_path: '{{path}}/tmp/'
 """
@@ -99,6 +166,48 @@ def echo_socket(ws):
                 )
     client.run()
 
+def rawsocket_session(transport):
+    """ Runs a WAMP session for a backend service connected over
+        RawSocket. There's no HTTP request so there are no cookies
+    """
+    client = WAMPServiceClient(
+                    app,
+                    transport,
+                    wamp,
+                    {}
+                )
+    client.run()
+
+app.rawsocket_handler = rawsocket_session
+
+def publish_many_endpoint():
+    """ HTTP batch publishing. Takes a JSON list of publications
+        in the form {'topic','args','kwargs','options'}. Every topic
+        must be publishable by the configured authrole
+    """
+    publications = flask.request.get_json(force=True,silent=True)
+    if not isinstance(publications,list):
+        return flask.jsonify({'error':'wamp.error.invalid_argument'}), 400
+
+    session = {
+        'realm': app.realm,
+        'authprovider': 'dynamic',
+        'authrole': config.flask.wamp.batch_publish.authrole,
+        'authmethod': 'anonymous',
+        'session': None,
+    }
+    for publication in publications:
+        if not isinstance(publication,dict) or not publication.get('topic'):
+            return flask.jsonify({'error':'wamp.error.invalid_argument'}), 400
+        perms = app.authorizers.authorize(session,publication['topic'],'publish')
+        if not perms.get('allow'):
+            return flask.jsonify({
+                        'error':'wamp.error.not_authorized',
+                        'topic': publication['topic'],
+                    }), 403
+
+    return flask.jsonify({'publish_ids':app.publish_many(publications)})
+
 @initializer('flask_wamp',before=['paths'])
 def load_config(**kwargs):
     request_initialize('config',**kwargs)
@@ -115,6 +224,27 @@ def load_config(**kwargs):
     app.finalize_wamp_setup(
             realm=config.flask.wamp.realm,
             cookie_name=config.flask.wamp.cookie_name,
+            match_cache_size=config.flask.wamp.match_cache_size,
+            executor=config.flask.wamp.executor,
+            call_timeout=config.flask.wamp.call_timeout,
+            outbound=config.flask.wamp.outbound,
+            retention=config.flask.wamp.retention,
+            delta=config.flask.wamp.delta,
+            history=config.flask.wamp.history,
+            serializers=config.flask.wamp.serializers,
+            json_codec=config.flask.wamp.json_codec,
+            payload_transparency=config.flask.wamp.payload_transparency,
+            rawsocket=config.flask.wamp.rawsocket,
+            deflate=config.flask.wamp.deflate,
+        )
+
+    # Opt-in HTTP endpoint for publishing in bulk
+    if config.flask.wamp.batch_publish.path:
+        izaber.flask.app.add_url_rule(
+            config.flask.wamp.batch_publish.path,
+            'wamp_publish_many',
+            publish_many_endpoint,
+            methods=['POST']
         )
 
     # Register any app we've created as well
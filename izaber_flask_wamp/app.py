@@ -1,14 +1,19 @@
 from izaber import config
+from izaber.log import log
 
 import izaber.flask
 
 from gevent import pywsgi
 from geventwebsocket.handler import WebSocketHandler
+from geventwebsocket.websocket import Stream
 
 from .common import *
 from .registrations import *
 from .authenticators import *
 from .authorizers import *
+from .outbound import *
+from .rawsocket import *
+from .deflate import *
 
 class MyWebSocketHandler(WebSocketHandler):
     """ This little tweaky thing allows us to set cookies upon first connect
@@ -17,6 +22,20 @@ class MyWebSocketHandler(WebSocketHandler):
     def start_response(self, status, headers, exc_info=None):
         # Only run our code if the connection is to websocket
         if self.environ.get('HTTP_UPGRADE') == 'websocket':
+            # Pick the serializer for the connection from the
+            # subprotocols the client offered
+            if str(status).startswith('101'):
+                protocol = negotiate_protocol(
+                                self.environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL'),
+                                self.application.allowed_protocols
+                            )
+                if protocol:
+                    self.environ['wamp.protocol'] = protocol
+                    self.environ['wamp.serializer'] = protocol_serializer(protocol)
+                    if not any( k.lower() == 'sec-websocket-protocol'
+                                for k, v in headers ):
+                        headers.append(('Sec-WebSocket-Protocol',protocol))
+                self.negotiate_deflate(headers)
             cookies = six.moves.http_cookies.SimpleCookie()
             cookies.load(self.environ.get('HTTP_COOKIE',{}))
             cookie_name = self.application.cookie_name
@@ -28,14 +47,44 @@ class MyWebSocketHandler(WebSocketHandler):
                 headers.append(('Set-Cookie',cookie_string))
         super(MyWebSocketHandler,self).start_response(status, headers, exc_info)
 
+    def negotiate_deflate(self,headers):
+        """ Swaps in a compressing websocket if permessage-deflate is
+            enabled and the client offered it
+        """
+        options = getattr(self.application,'deflate_options',None)
+        if not options or not options.get('enabled'):
+            return
+        negotiated = negotiate_deflate(
+                            self.environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS'),
+                            options
+                        )
+        if not negotiated:
+            return
+        params, extension = negotiated
+        retire_websocket(self.websocket)
+        self.websocket = WAMPDeflateWebSocket(
+                            self.environ,
+                            Stream(self),
+                            self,
+                            params,
+                            min_bytes=options.get('min_bytes',DEFAULT_DEFLATE_MIN_BYTES),
+                            level=options.get('level',DEFAULT_DEFLATE_LEVEL),
+                            max_message_bytes=options.get('max_message_bytes',
+                                                    DEFAULT_INFLATE_LIMIT),
+                            stats=self.application.deflate_stats,
+                        )
+        self.environ['wsgi.websocket'] = self.websocket
+        headers.append(('Sec-WebSocket-Extensions',extension))
+
 class FlaskAppWrapper(object):
     def __init__(self,app,users=None):
         self.__dict__.update(dict(
             _app = app,
         ))
 
-        # Used by WS to ensure we allow the wamp protocol to connect
-        app.allowed_protocol = 'wamp.2.json'
+        # The websocket subprotocols (and so serializers) we'll
+        # negotiate with connecting clients
+        app.allowed_protocols = available_protocols()
 
         # Used to verify users. Used by Challenge
         self.authenticators = WAMPAuthenticators()
@@ -46,16 +95,49 @@ class FlaskAppWrapper(object):
 
         # To track subscriptions and registrations
         self.registrations = WAMPRegistrations()
+        self.register_local('wamp.topic.state.get',self.state_get)
+        self.register_local('wamp.publish_many',self.publish_many_procedure)
 
         # Used to verify who can access what resources
         self.authorizers = WAMPAuthorizers()
 
+        # Passed to each client's WAMPOutboundQueue
+        self.outbound_options = {}
+
+        # Frames at least this big have their payload passed through
+        # (None to always decode everything)
+        self.passthrough_bytes = None
+
+        # RawSocket listeners for backend services. rawsocket_handler
+        # is what runs a session over each connection
+        self.rawsocket_options = {}
+        self.rawsocket_servers = []
+        self.rawsocket_handler = None
+
+        # permessage-deflate settings for /ws and the byte counters
+        # across all the compressed connections
+        self.deflate_options = {}
+        self.deflate_stats = WAMPDeflateStats()
+
         # The name of the cookie used for websocket session tracking
         # This helps with reloads of the page
         self.cookie_name = None
 
     def client_add(self,client):
-        self.clients.append(client)
+        if client not in self.clients:
+            self.clients.append(client)
+
+    def client_remove(self,client):
+        """ Called when a client goes away. Cleans up everything the
+            client had registered or subscribed to and forgets about
+            the client itself
+        """
+        self.registrations.reap_client(client)
+        while client in self.clients:
+            try:
+                self.clients.remove(client)
+            except ValueError:
+                break
 
     def run(self, host=None, port=None, debug=None, **options):
         if host is None:
@@ -70,11 +152,140 @@ class FlaskAppWrapper(object):
                         self,
                         handler_class=MyWebSocketHandler
                     )
+        self.start_rawsocket()
         server.serve_forever()
 
-    def finalize_wamp_setup(self,realm=SESSION_REALM,cookie_name=SESSION_COOKIE):
+    def compression_stats(self):
+        """ Totals for all the permessage-deflate connections
+        """
+        return self.deflate_stats.stats()
+
+    def start_rawsocket(self):
+        """ Starts listening on the configured RawSocket addresses. Called
+            by run() but may be used directly when the websocket side is
+            being served some other way
+        """
+        if self.rawsocket_servers or not self.rawsocket_handler:
+            return self.rawsocket_servers
+        options = self.rawsocket_options
+        servers = []
+        for address in ( options.get('tcp'), options.get('unix') ):
+            if not address:
+                continue
+            server = WAMPRawSocketServer(
+                            address,
+                            self.rawsocket_handler,
+                            self.allowed_protocols,
+                            options.get('max_length_exp',DEFAULT_MAX_LENGTH_EXP),
+                        )
+            server.start()
+            log.info("WAMP RawSocket listening on %s",address)
+            servers.append(server)
+        self.rawsocket_servers = servers
+        return servers
+
+    def stop_rawsocket(self):
+        for server in self.rawsocket_servers:
+            server.stop()
+        self.rawsocket_servers = []
+
+    def finalize_wamp_setup(self,realm=SESSION_REALM,cookie_name=SESSION_COOKIE,
+                                match_cache_size=DEFAULT_MATCH_CACHE_SIZE,
+                                executor=None,
+                                call_timeout=None,
+                                outbound=None,
+                                retention=None,
+                                delta=None,
+                                history=None,
+                                serializers=None,
+                                json_codec='auto',
+                                payload_transparency=None,
+                                rawsocket=None,
+                                deflate=None):
         self.realm = realm
         self.cookie_name = cookie_name
+        self.registrations.set_cache_size(match_cache_size)
+        self.authorizers.set_cache_size(match_cache_size)
+        self.registrations.call_timeout = call_timeout
+        self.allowed_protocols = available_protocols(serializers)
+        set_json_codec(json_codec)
+
+        # Forwarding CALL/YIELD payloads without decoding them
+        payload_transparency = payload_transparency or {}
+        self.passthrough_bytes = None
+        if payload_transparency.get('enabled'):
+            self.passthrough_bytes = payload_transparency.get(
+                                        'min_bytes',DEFAULT_PASSTHROUGH_BYTES)
+
+        # Where to accept RawSocket connections from backend services
+        self.rawsocket_options = rawsocket or {}
+
+        # Compression for websocket clients that support it
+        self.deflate_options = deflate or {}
+
+        # Events kept around for subscribers that ask for them
+        retention = retention or {}
+        self.registrations.retention = WAMPRetention(
+            depth=retention.get('depth',DEFAULT_RETENTION_DEPTH),
+            max_bytes=retention.get('max_bytes',DEFAULT_RETENTION_BYTES),
+            topics=retention.get('topics'),
+        )
+
+        # How many topics' states are kept for delta publishes
+        delta = delta or {}
+        self.registrations.deltas.max_topics = delta.get(
+                                        'max_topics',DEFAULT_DELTA_TOPICS)
+
+        # Durable per topic history that clients can catch up from
+        history = history or {}
+        if history.get('path') and history.get('topics'):
+            self.registrations.history = WAMPHistory(
+                path=history['path'],
+                topics=history['topics'],
+                segment_bytes=history.get('segment_bytes',DEFAULT_SEGMENT_BYTES),
+                max_bytes=history.get('max_bytes',DEFAULT_HISTORY_BYTES),
+                max_age=history.get('max_age',DEFAULT_HISTORY_AGE),
+                queue_depth=history.get('queue_depth',DEFAULT_HISTORY_QUEUE),
+                max_open=history.get('max_open',DEFAULT_HISTORY_OPEN),
+            )
+            self.register_local('wamp.topic.history.get',self.history_get)
+
+        # How much each connection may have queued up to send
+        outbound = outbound or {}
+        self.outbound_options = {
+            'depth': outbound.get('depth',DEFAULT_OUTBOUND_DEPTH),
+            'policy': outbound.get('policy',DEFAULT_OUTBOUND_POLICY),
+            'block_timeout': outbound.get('block_timeout',DEFAULT_BLOCK_TIMEOUT),
+            'coalesce': outbound.get('coalesce',False),
+            'coalesce_window': outbound.get('coalesce_window',DEFAULT_COALESCE_WINDOW),
+            'coalesce_bytes': outbound.get('coalesce_bytes',DEFAULT_COALESCE_BYTES),
+        }
+
+        # Pool used to run the local @wamp.register handlers
+        executor = executor or {}
+        self.registrations.set_executor('thread',WAMPThreadPool(
+            workers=executor.get('workers',DEFAULT_WORKERS),
+            queue_depth=executor.get('queue_depth',DEFAULT_QUEUE_DEPTH),
+        ))
+
+        # Handlers registered with options={'executor': 'greenlet'}
+        self.registrations.set_executor('greenlet',WAMPGreenletPool(
+            size=executor.get('greenlets',DEFAULT_GREENLETS),
+        ))
+
+        # Used for handlers that are written as `async def`
+        self.registrations.set_executor('asyncio',WAMPAsyncioExecutor(
+            max_pending=executor.get('coroutines',DEFAULT_COROUTINES),
+        ))
+
+        # CPU bound handlers with options={'executor': 'process'}
+        self.registrations.set_executor('process',WAMPProcessPool(
+            workers=executor.get('processes'),
+            max_tasks_per_child=executor.get('max_tasks_per_child'),
+            max_pending=executor.get('process_queue_depth',DEFAULT_PROCESS_PENDING),
+            start_method=executor.get('process_start_method',
+                                        DEFAULT_PROCESS_START_METHOD),
+        ))
 
     def auth_details(self,ws,authid,authrole='anonymous'):
 
@@ -85,7 +296,8 @@ class FlaskAppWrapper(object):
             u'authrole': authrole,
             u'realm': self.realm,
             u'roles': {u'broker': {u'features': {
-                                                 u'event_retention': False,
+                                                 u'event_history': bool(self.registrations.history),
+                                                 u'event_retention': True,
                                                  u'pattern_based_subscription': True,
                                                  u'payload_encryption_cryptobox': False,
                                                  u'payload_transparency': False,
@@ -97,16 +309,17 @@ class FlaskAppWrapper(object):
                                                  u'subscription_revocation': False
                                                  }},
                        u'dealer': {u'features': {
-                                                 u'call_canceling': False,
+                                                 u'call_canceling': True,
+                                                 u'call_timeout': True,
                                                  u'caller_identification': False,
                                                  u'pattern_based_registration': True,
                                                  u'payload_encryption_cryptobox': False,
                                                  u'payload_transparency': False,
-                                                 u'progressive_call_results': False,
+                                                 u'progressive_call_results': True,
                                                  u'registration_meta_api': False,
                                                  u'registration_revocation': False,
                                                  u'session_meta_api': False,
-                                                 u'shared_registration': False,
+                                                 u'shared_registration': True,
                                                  u'testament_meta_api': False
                                                  }}},
             u'x_cb_node_id': None
@@ -125,12 +338,31 @@ class FlaskAppWrapper(object):
         }
         return self.authorizers.authorize(session,uri,action,options)
 
+    def authorize_invoke(self,invoke,uri,action):
+        """ Used by the meta procedures to check that the session that
+            made the call may access the URI it's asking about. Calls
+            made by the server itself (caller 0) are always allowed
+        """
+        details = invoke.details or {}
+        if not details.get('caller'):
+            return
+        session = {
+            'realm': self.realm,
+            'authprovider': 'dynamic',
+            'authrole': details.get('caller_role'),
+            'authmethod': None,
+            'session': details.get('caller'),
+        }
+        perms = self.authorizers.authorize(session,uri,action)
+        if not perms.get('allow'):
+            raise Exception('wamp.error.not_authorized')
+
     def generate_request_id(self):
         """ We cheat, we just use the millisecond timestamp for the request
         """
         return int(round(time.time() * 1000))
 
-    def register_remote(self,uri,client):
+    def register_remote(self,uri,client,options=None):
         """ Registers a callback URI
         """
         session = {
@@ -145,7 +377,7 @@ class FlaskAppWrapper(object):
             import pprint
             pprint.pprint(client.auth)
             raise Exception("Not Allowed")
-        return self.registrations.register_remote(uri,client)
+        return self.registrations.register_remote(uri,client,options)
 
     def register_local(self,uri,callback,options=None):
         """ Takes a local function and registers it in the callbacks table
@@ -177,8 +409,9 @@ class FlaskAppWrapper(object):
             the function call syncronously when the callback is not specified
         """
         try:
+            options = options or {}
             request = CALL(
-                          options={},
+                          options=options,
                           procedure=uri,
                           args=args or [],
                           kwargs=kwargs or {},
@@ -195,8 +428,17 @@ class FlaskAppWrapper(object):
                     response_queue.put(response)
                 callback = syncronous_callback
                 self.registrations.invoke_local(auth,request,callback)
-                # FIXME: what should the timeout be?
-                message = response_queue.get(block=True,timeout=3600)
+
+                # The dealer will send an error once the call times out
+                # so we only need a fallback in case nothing's set
+                timeout = options.get('timeout')
+                if timeout:
+                    timeout = timeout / 1000.0 + 1
+                elif self.registrations.call_timeout:
+                    timeout = self.registrations.call_timeout + 1
+                else:
+                    timeout = 3600
+                message = response_queue.get(block=True,timeout=timeout)
                 if message == WAMP_RESULT:
                     return message.args[0]
                
@@ -226,10 +468,19 @@ class FlaskAppWrapper(object):
                 return error.error
 
 
-    def unregister(self,uri):
-        """ Remove the uri from the call pool
+    def cancel_call(self,client,request):
+        """ Handles a CANCEL from a caller
         """
-        return self.registrations.unregister(uri)
+        return self.registrations.cancel(
+                    client.session_id,
+                    request.request_id,
+                    request.options.get('mode'),
+                )
+
+    def unregister(self,registration_id,client=None):
+        """ Remove the registration from the call pool
+        """
+        return self.registrations.unregister(registration_id,client)
 
     def subscribe_remote(self,uri,client,options=None):
         """ Registers a callback URI
@@ -251,11 +502,70 @@ class FlaskAppWrapper(object):
         """
         return self.registrations.subscribe_local(uri,callback,options)
 
-    def unsubscribe(self,uri):
-        pass
+    def unsubscribe(self,subscription_id,client=None):
+        """ Remove the subscription from the publication targets
+        """
+        return self.registrations.unsubscribe(subscription_id,client)
 
     def publish(self,request):
-        self.registrations.publish(request)
+        return self.registrations.publish(request)
+
+    def publish_many(self,publications):
+        """ Publishes a list of {'topic','args','kwargs','options'}
+            dicts in one batch. Returns the publication ids
+        """
+        return self.registrations.publish_many([
+            PUBLISH(
+                options=publication.get('options') or {},
+                topic=publication['topic'],
+                args=publication.get('args') or [],
+                kwargs=publication.get('kwargs') or {},
+            )
+            for publication in publications
+        ])
+
+    def publish_many_procedure(self,invoke,publications):
+        """ Meta procedure so remote sessions can batch publish too. The
+            caller must be allowed to publish to every topic
+        """
+        if not isinstance(publications,list):
+            raise Exception('wamp.error.invalid_argument')
+        for publication in publications:
+            if not isinstance(publication,dict) or not publication.get('topic'):
+                raise Exception('wamp.error.invalid_argument')
+            self.authorize_invoke(invoke,publication['topic'],'publish')
+        return self.publish_many(publications)
+
+    def retained_events(self,subscription_id,client=None):
+        return self.registrations.retained_events(subscription_id,client)
+
+    def history_get(self,invoke,topic,after=None,since=None,until=None,limit=None):
+        """ Meta procedure for reading a topic's history. Returns the
+            events published after the publication id `after` and/or
+            with timestamps from `since` up to `until`. The caller must
+            be allowed to subscribe to the topic
+        """
+        self.authorize_invoke(invoke,topic,'subscribe')
+        if not self.registrations.history:
+            raise Exception('wamp.error.history_unavailable')
+        return self.registrations.history.read(topic,after,since,until,limit)
+
+    def state_get(self,invoke,topic):
+        """ Meta procedure returning the current state of a topic that's
+            published with delta=True. Used by subscribers to resync
+            when they notice a gap in the versions. The caller must be
+            allowed to subscribe to the topic
+        """
+        self.authorize_invoke(invoke,topic,'subscribe')
+        state = self.registrations.deltas.get(topic)
+        if not state:
+            raise Exception('wamp.error.no_such_state')
+        return {
+            'topic': state.topic,
+            'version': state.version,
+            'args': state.args,
+            'kwargs': state.kwargs,
+        }
 
     def __getattr__(self,k):
         return getattr(self._app,k)
@@ -1,3 +1,4 @@
+import logging
 import traceback
 
 from swampyer.messages import *
@@ -5,6 +6,8 @@ from swampyer.messages import *
 from izaber.log import log
 
 from .common import *
+from .outbound import *
+from .passthrough import *
 
 class WAMPServiceClient(object):
 
@@ -14,15 +17,37 @@ class WAMPServiceClient(object):
         self.app = app
         self.session_id = secure_rand()
         self._requests_pending = {}
-        self.timeout = 1
         self.wamp = wamp
         self.cookies = cookies
         self.auth = DictObject()
 
+        # Negotiated by the websocket handler when the connection
+        # was upgraded
+        self.serializer = getattr(ws,'environ',{}).get('wamp.serializer','json')
+
+        # Large CALL and YIELD frames may have their payload passed
+        # through without being decoded
+        self.passthrough_bytes = getattr(app,'passthrough_bytes',None)
+
+        self.outbound = WAMPOutboundQueue(
+                                ws,
+                                **getattr(app,'outbound_options',{})
+                            )
+
     def closed(self):
         """ Returns true if closed
         """
-        return self.ws.closed
+        return self.ws.closed or self.outbound.closed
+
+    def outbound_stats(self):
+        return self.outbound.stats()
+
+    def compression_stats(self):
+        """ Returns the permessage-deflate counters or None if the
+            connection isn't compressed
+        """
+        stats = getattr(self.ws,'compression_stats',None)
+        return stats() if stats else None
 
     def dispatch_to_awaiting(self,result):
         """ Send data to the appropriate queues. We use the request_id to key
@@ -33,7 +58,9 @@ class WAMPServiceClient(object):
                 request_id = result.request_id
                 if request_id in self._requests_pending:
                     self._requests_pending[request_id]['callback'](result)
-                    del self._requests_pending[request_id]
+                    # Progressive results mean there's more to come
+                    if not is_progress(result):
+                        del self._requests_pending[request_id]
                 else:
                     self.send_message(result)
             except AttributeError:
@@ -52,16 +79,54 @@ class WAMPServiceClient(object):
 
         # Need to setup the callback
         request_id = request.request_id
+        # Expiry of the request is handled by the dealer through
+        # interrupt() so we only need to remember who to tell
         self._requests_pending[request_id] = {
                                         'callback': callback,
-                                        'timeout': self.timeout, # TODO reap time
                                     }
         self.send_message(request)
 
+    def interrupt(self,request_id,mode='killnowait'):
+        """ Asks the callee to stop working on an invocation. Unless
+            the mode is 'kill', we no longer wait for its response
+        """
+        if mode != 'kill':
+            self._requests_pending.pop(request_id,None)
+        if self.closed() or self.state == STATE_DISCONNECTED:
+            return
+        try:
+            self.send_message(INTERRUPT(
+                request_id = request_id,
+                options = {'mode': mode},
+            ))
+        except Exception as ex:
+            traceback.print_exc()
+
+    def fail_pending(self):
+        """ The callee has gone away so anything it was working on
+            will never complete. Let the callers know
+        """
+        pending = self._requests_pending
+        self._requests_pending = {}
+        for request_id, request in pending.items():
+            # Stands in for the callee's own reply to the INVOCATION.
+            # The dealer passes it on to the caller as an error for
+            # its CALL
+            try:
+                request['callback'](ERROR(
+                    request_code = WAMP_INVOCATION,
+                    request_id = request_id,
+                    details = {},
+                    error = 'wamp.error.canceled',
+                    args = [u'Callee disconnected'],
+                ))
+            except Exception as ex:
+                traceback.print_exc()
+
     def handle_hello(self, hello):
         """ A new customer!
         """
-        self.app.clients.append(self)
+        self.app.client_add(self)
 
         # We only trigger authentications if the app has users
         # setup.
@@ -155,15 +220,44 @@ class WAMPServiceClient(object):
         """ When a client would like to a register a RPC
             function to a URI
         """
-        callback_id = self.app.register_remote(
-                            uri=register.procedure,
-                            client=self
-                        )
+        try:
+            callback_id = self.app.register_remote(
+                                uri=register.procedure,
+                                client=self,
+                                options=register.details,
+                            )
+        except Exception as ex:
+            traceback.print_exc()
+            return self.dispatch_to_awaiting(ERROR(
+                        request_code = WAMP_REGISTER,
+                        request_id = register.request_id,
+                        details = {},
+                        error = u'{}'.format(ex),
+                        args = [],
+                    ))
         self.dispatch_to_awaiting(REGISTERED(
                     request_id=register.request_id,
                     registration_id=callback_id
                 ))
 
+    def handle_unregister(self, request):
+        """ When a client no longer wants to handle calls for a
+            registration it made
+        """
+        try:
+            self.app.unregister(request.registration_id,self)
+        except Exception as ex:
+            return self.dispatch_to_awaiting(ERROR(
+                        request_code = WAMP_UNREGISTER,
+                        request_id = request.request_id,
+                        details = {},
+                        error = u'{}'.format(ex),
+                        args = [],
+                    ))
+        self.dispatch_to_awaiting(UNREGISTERED(
+                    request_id=request.request_id,
+                ))
+
     def handle_call(self, request):
         """ When a client requests that a particular function
             be invoked.
@@ -172,16 +266,30 @@ class WAMPServiceClient(object):
             self.dispatch_to_awaiting(result)
         self.app.call_remote( self, request, on_yield )
 
+    def handle_cancel(self, request):
+        """ The caller no longer wants the result of a call
+        """
+        self.app.cancel_call(self, request)
+
     def handle_subscribe(self, request):
         """ Hey! I want to hear about information on this URI
         """
         request_id = request.request_id
         try:
-            subscription_id = self.app.subscribe_remote(request.topic,self)
+            subscription_id = self.app.subscribe_remote(
+                                    request.topic,
+                                    self,
+                                    request.options
+                                )
             self.send_message(SUBSCRIBED(
                 request_id = request_id,
                 subscription_id=subscription_id
             ))
+
+            # Catch the client up on what it missed
+            if request.options.get('get_retained'):
+                for event in self.app.retained_events(subscription_id,self):
+                    self.send_message(event)
         except Exception as ex:
             traceback.print_exc()
             self.send_message(ERROR(
@@ -192,6 +300,23 @@ class WAMPServiceClient(object):
                         args = [],
                     ))
 
+    def handle_unsubscribe(self, request):
+        """ Stop telling me about this subscription
+        """
+        try:
+            self.app.unsubscribe(request.subscription_id,self)
+        except Exception as ex:
+            return self.send_message(ERROR(
+                        request_code = WAMP_UNSUBSCRIBE,
+                        request_id = request.request_id,
+                        details = {},
+                        error = u'{}'.format(ex),
+                        args = [],
+                    ))
+        self.send_message(UNSUBSCRIBED(
+            request_id = request.request_id,
+        ))
+
     def handle_publish(self, request):
         """ Hey! I have information that someone may want to hear
             about on this particlar URI
@@ -226,12 +351,25 @@ class WAMPServiceClient(object):
         """
         if self.state == STATE_DISCONNECTED:
             raise Exception("WAMP is currently disconnected!")
-        message = message.as_str()
-        log.debug("SND>: {}".format(message))
-        self.ws.send(message)
+        message = encode_message(message,self.serializer)
+        log.debug("SND>: %s",message)
+        self.outbound.put(message)
+
+    def send_messages(self,messages):
+        """ Sends several messages, queuing them up together
+        """
+        if self.state == STATE_DISCONNECTED:
+            raise Exception("WAMP is currently disconnected!")
+        frames = []
+        for message in messages:
+            frame = encode_message(message,self.serializer)
+            log.debug("SND>: %s",frame)
+            frames.append(frame)
+        self.outbound.put_many(frames)
 
     def receive_message(self,message):
-        log.debug("<RCV: {}".format(message.dump()))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("<RCV: {}".format(message.dump()))
         try:
             code_name = message.code_name.lower()
             handler_name = "handle_"+code_name
@@ -242,19 +380,35 @@ class WAMPServiceClient(object):
             self.handle_unknown(message)
 
     def run(self):
+        self.outbound.start()
         self.wamp.do_wamp_connect(self)
         while not self.ws.closed:
             data = self.ws.receive()
             if not data:
                 continue
             try:
-                log.debug("<RCV: {}".format(data))
-                message = WampMessage.loads(data)
+                log.debug("<RCV: %s",data)
+                message = None
+                if self.passthrough_bytes is not None \
+                        and self.serializer == 'json' \
+                        and len(data) >= self.passthrough_bytes:
+                    message = decode_header(data)
+                if message is None:
+                    message = decode_message(data,self.serializer)
                 self.receive_message(message)
             except Exception as ex:
                 # FIXME: Needs more granular exception handling
-                self.wamp.do_wamp_disconnect(self)
+                self.disconnected()
                 raise
+        self.disconnected()
+
+    def disconnected(self):
+        """ Cleans up after the connection has gone away
+        """
+        self.state = STATE_DISCONNECTED
+        self.outbound.close()
+        self.fail_pending()
+        self.app.client_remove(self)
         self.wamp.do_wamp_disconnect(self)
 
 
@@ -4,6 +4,8 @@ from six.moves import queue
 
 from swampyer.messages import *
 
+from .jsoncodec import *
+
 from izaber import config
 
 STATE_DISCONNECTED = 0
@@ -12,6 +14,27 @@ STATE_WEBSOCKET_CONNECTED = 3
 STATE_AUTHENTICATING = 4
 STATE_CONNECTED = 2
 
+# swampyer doesn't know about the advanced profile messages used
+# for call canceling so we add them to its lookup tables
+ADVANCED_MESSAGE_TYPES = dict(
+    CANCEL       = [ CODE('code',49), ID('request_id'), DICT('options') ],
+    INTERRUPT    = [ CODE('code',69), ID('request_id'), DICT('options') ],
+)
+for k,v in ADVANCED_MESSAGE_TYPES.items():
+    if k in MESSAGE_TYPES:
+        continue
+    new_class = type(k, (WampMessage,), {})
+    new_class._fields = v
+    new_class.code_name = k
+    globals()[k] = new_class
+
+    code_id = v[0].default_value()
+    globals()["WAMP_"+k] = code_id
+
+    MESSAGE_TYPES[k] = v
+    MESSAGE_CLASS_LOOKUP[code_id] = new_class
+    MESSAGE_NAME_LOOKUP[code_id] = k
+
 SESSION_COOKIE = 'zfwid'
 SESSION_REALM = 'izaber'
 
@@ -83,6 +106,120 @@ class Listable(object):
         for item in self.data:
             yield item
 
+def is_progress(message):
+    """ Returns True if the message is a progressive YIELD or RESULT
+        which means that there's more to come for the request
+    """
+    if message == WAMP_YIELD:
+        return bool(message.options.get('progress'))
+    if message == WAMP_RESULT:
+        return bool(message.details.get('progress'))
+    return False
+
+# Websocket subprotocols we can speak, in order of preference, along
+# with the swampyer serializer each uses
+WAMP_PROTOCOLS = [
+    ( 'wamp.2.json', 'json' ),
+    ( 'wamp.2.msgpack', 'msgpack' ),
+]
+
+SERIALIZERS = {}
+def get_serializer(name='json'):
+    """ Returns a shared instance of the swampyer serializer. They
+        hold no per message state so there's no need to build a new
+        one for each message. JSON goes through the fastest codec
+        available unless set_json_codec says otherwise
+    """
+    serializer = SERIALIZERS.get(name)
+    if serializer is None:
+        if name == 'json':
+            serializer = load_json_codec()
+        else:
+            serializer = load_serializer(name)
+        SERIALIZERS[name] = serializer
+    return serializer
+
+def set_json_codec(preference='auto'):
+    """ Picks the library used for wamp.2.json: 'auto', 'orjson',
+        'ujson' or 'json' (the stdlib)
+    """
+    SERIALIZERS['json'] = load_json_codec(preference)
+    return SERIALIZERS['json']
+
+def available_protocols(serializers=None):
+    """ Returns the subprotocols whose serializers are installed,
+        optionally limited to the named serializers
+    """
+    protocols = []
+    for protocol, name in WAMP_PROTOCOLS:
+        if serializers is not None and name not in serializers:
+            continue
+        try:
+            SERIALIZER_REGISTRY[name].available()
+        except Exception:
+            continue
+        protocols.append(protocol)
+    return protocols
+
+def negotiate_protocol(requested,allowed):
+    """ Picks the first of the client's requested subprotocols (a
+        comma separated header value) that we allow. Returns None
+        if there's nothing in common
+    """
+    for protocol in (requested or '').split(','):
+        protocol = protocol.strip()
+        if protocol in allowed:
+            return protocol
+    return None
+
+def protocol_serializer(protocol):
+    for candidate, name in WAMP_PROTOCOLS:
+        if candidate == protocol:
+            return name
+    return 'json'
+
+def payload_index(message_class):
+    """ Returns the position of args in the message's fields
+    """
+    for i, field in enumerate(message_class._fields):
+        if field.name == 'args':
+            return i
+    return len(message_class._fields)
+
+def splice_payload(message,raw_payload):
+    """ Encodes the message's header fields and appends the raw JSON
+        args/kwargs text untouched
+    """
+    header = [
+        message[field.name]
+        for field in message._fields[:payload_index(message)]
+    ]
+    data = get_serializer('json').dumps(header)
+    return data[:-1] + u',' + raw_payload + u']'
+
+def encode_message(message,serializer='json'):
+    """ Returns the serialized form of the message. If the message
+        carries a frame_cache (as events being fanned out to many
+        clients do), the result is encoded only once per serializer
+        and reused. Messages still holding the raw JSON payload they
+        arrived with have it passed through as is
+    """
+    raw_payload = getattr(message,'raw_payload',None)
+    if raw_payload is not None and serializer == 'json':
+        return splice_payload(message,raw_payload)
+
+    cache = getattr(message,'frame_cache',None)
+    if cache is None:
+        return get_serializer(serializer).dumps(message.package())
+    try:
+        return cache[serializer]
+    except KeyError:
+        data = cache[serializer] = get_serializer(serializer).dumps(message.package())
+        return data
+
+def decode_message(data,serializer='json'):
+    return WampMessage.load(get_serializer(serializer).loads(data))
+
 rng = random.SystemRandom()
 def secure_rand():
     #return rng.randint(0,sys.maxsize)
@@ -0,0 +1,103 @@
+import time
+import threading
+
+from .common import *
+
+###########################################
+# Rate limited delivery of events
+###########################################
+
+class WAMPConflatedTopic(object):
+    def __init__(self):
+        self.last_sent = 0
+        self.pending = None
+        self.timer = None
+
+class WAMPConflator(object):
+    """ Subscribers that ask for {'conflate_ms': N} get at most one
+        event per topic every N milliseconds. The first event is sent
+        straight away. Anything published during the following window
+        replaces whatever is still waiting so only the newest event is
+        sent when the window closes.
+
+        Flushes are driven by the registrations' timer wheel so the
+        window is rounded to the wheel's resolution.
+    """
+    def __init__(self,timers):
+        self.timers = timers
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.conflated = 0
+
+    def deliver(self,client,subscription_id,event,window_ms):
+        key = ( subscription_id, event.details.get('topic') )
+        window = window_ms / 1000.0
+        now = time.time()
+        with self.lock:
+            topics = self.clients.setdefault(client,{})
+            state = topics.get(key)
+            if state is None:
+                state = topics[key] = WAMPConflatedTopic()
+
+            # Something's already waiting, the new event replaces it
+            if state.pending is not None:
+                state.pending = event
+                self.conflated += 1
+                return
+
+            if now - state.last_sent < window:
+                state.pending = event
+                state.timer = self.timers.schedule(
+                                    state.last_sent + window - now,
+                                    lambda: self.flush(client,key)
+                                )
+                return
+
+            state.last_sent = now
+
+        client.send_message(event)
+
+    def flush(self,client,key):
+        """ Sends the newest event waiting for the window to close
+        """
+        with self.lock:
+            state = self.clients.get(client,{}).get(key)
+            if state is None or state.pending is None:
+                return
+            event = state.pending
+            state.pending = None
+            state.timer = None
+            state.last_sent = time.time()
+
+        if not client.closed():
+            client.send_message(event)
+
+    def discard(self,client,subscription_id=None):
+        """ Forgets about the client's pending events, either for a
+            single subscription or for everything
+        """
+        with self.lock:
+            topics = self.clients.get(client)
+            if not topics:
+                return
+            for key in list(topics):
+                if subscription_id is not None and key[0] != subscription_id:
+                    continue
+                state = topics.pop(key)
+                if state.timer:
+                    state.timer.cancel()
+            if not topics:
+                del self.clients[client]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'subscribers': len(self.clients),
+                'pending': sum(
+                    1
+                    for topics in self.clients.values()
+                    for state in topics.values()
+                    if state.pending is not None
+                ),
+                'conflated': self.conflated,
+            }
@@ -0,0 +1,387 @@
+import zlib
+import threading
+
+from socket import error as socket_error
+
+from geventwebsocket.websocket import WebSocket, Header, \
+                                        MSG_ALREADY_CLOSED, MSG_SOCKET_DEAD
+from geventwebsocket.exceptions import ProtocolError, WebSocketError
+
+from .common import *
+
+###########################################
+# permessage-deflate (RFC 7692) websockets
+###########################################
+
+DEFAULT_DEFLATE_MIN_BYTES = 1024
+DEFAULT_DEFLATE_LEVEL = 6
+DEFAULT_WINDOW_BITS = 15
+DEFAULT_INFLATE_LIMIT = 16777216
+
+DEFLATE_EXTENSION = 'permessage-deflate'
+
+# geventwebsocket counts the reserved bits from zero so its RSV0 is
+# the RFC's RSV1, which marks a compressed message
+RSV_COMPRESSED = Header.RSV0_MASK
+
+# Each compressed message ends with an empty deflate block which
+# is left off the wire
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+DEFLATE_PARAMETERS = [
+    'server_no_context_takeover',
+    'client_no_context_takeover',
+    'server_max_window_bits',
+    'client_max_window_bits',
+]
+
+class WAMPDeflateStats(object):
+    """ Byte counters for compressed connections. Each connection
+        keeps its own and adds to the app wide totals (parent) so the
+        bandwidth saved can be weighed against the CPU spent
+    """
+    def __init__(self,parent=None):
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.compressed = 0         # Messages sent compressed
+        self.skipped = 0            # Messages sent as is
+        self.bytes_in = 0           # Size of compressed messages before
+        self.bytes_out = 0          # ... and after
+        self.inflated = 0           # Compressed messages received
+        self.inflated_in = 0        # Bytes of them on the wire
+        self.inflated_out = 0       # ... and once decompressed
+
+    def sent(self,raw_bytes,wire_bytes,compressed):
+        with self.lock:
+            if compressed:
+                self.compressed += 1
+                self.bytes_in += raw_bytes
+                self.bytes_out += wire_bytes
+            else:
+                self.skipped += 1
+        if self.parent:
+            self.parent.sent(raw_bytes,wire_bytes,compressed)
+
+    def received(self,wire_bytes,raw_bytes):
+        with self.lock:
+            self.inflated += 1
+            self.inflated_in += wire_bytes
+            self.inflated_out += raw_bytes
+        if self.parent:
+            self.parent.received(wire_bytes,raw_bytes)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'compressed': self.compressed,
+                'skipped': self.skipped,
+                'uncompressed_bytes': self.bytes_in,
+                'compressed_bytes': self.bytes_out,
+                'ratio': float(self.bytes_out) / self.bytes_in
+                            if self.bytes_in else None,
+                'inflated': self.inflated,
+                'inflated_compressed_bytes': self.inflated_in,
+                'inflated_uncompressed_bytes': self.inflated_out,
+            }
+
+def parse_extensions(header):
+    """ Splits a Sec-WebSocket-Extensions header into a list of
+        (name, params) offers. params is None when an offer has a
+        parameter more than once
+    """
+    offers = []
+    for offer in (header or '').split(','):
+        parts = [ part.strip() for part in offer.split(';') ]
+        if not parts[0]:
+            continue
+        params = {}
+        for part in parts[1:]:
+            if not part:
+                continue
+            name, _, value = part.partition('=')
+            name = name.strip()
+            value = value.strip().strip('"') if _ else None
+            if params is None or name in params:
+                params = None
+                continue
+            params[name] = value
+        offers.append(( parts[0].lower(), params ))
+    return offers
+
+def window_bits(value,default=None):
+    """ Returns the window size from a *_max_window_bits parameter or
+        None if it isn't valid
+    """
+    if value is None:
+        return default
+    if not value.isdigit():
+        return None
+    bits = int(value)
+    if not 8 <= bits <= 15:
+        return None
+    return bits
+
+def negotiate_deflate(header,options):
+    """ Picks the first permessage-deflate offer in the client's
+        Sec-WebSocket-Extensions header that we can accept. Returns
+        (params, response header value) or None.
+
+        Our own server_max_window_bits and the context takeover
+        settings are applied on top of what the client asked for
+    """
+    our_server_bits = max(9,min(DEFAULT_WINDOW_BITS,
+                        options.get('server_max_window_bits',DEFAULT_WINDOW_BITS)))
+    our_client_bits = max(8,min(DEFAULT_WINDOW_BITS,
+                        options.get('client_max_window_bits',DEFAULT_WINDOW_BITS)))
+
+    for name, offered in parse_extensions(header):
+        if name != DEFLATE_EXTENSION or offered is None:
+            continue
+        if any( k not in DEFLATE_PARAMETERS for k in offered ):
+            continue
+        if offered.get('server_no_context_takeover') is not None \
+                or offered.get('client_no_context_takeover') is not None:
+            continue
+
+        server_bits = DEFAULT_WINDOW_BITS
+        if 'server_max_window_bits' in offered:
+            server_bits = window_bits(offered['server_max_window_bits'])
+        # zlib can't produce raw deflate streams with a 256 byte window
+        if server_bits is None or server_bits < 9:
+            continue
+        client_bits = None
+        if 'client_max_window_bits' in offered:
+            client_bits = window_bits(offered['client_max_window_bits'],
+                                        DEFAULT_WINDOW_BITS)
+            if client_bits is None:
+                continue
+
+        params = {
+            'server_no_context_takeover':
+                'server_no_context_takeover' in offered
+                or bool(options.get('server_no_context_takeover')),
+            'client_no_context_takeover':
+                'client_no_context_takeover' in offered
+                or bool(options.get('client_no_context_takeover')),
+            'server_max_window_bits': min(server_bits,our_server_bits),
+            'client_max_window_bits': min(client_bits,our_client_bits)
+                                        if client_bits else DEFAULT_WINDOW_BITS,
+        }
+
+        response = [ DEFLATE_EXTENSION ]
+        if params['server_no_context_takeover']:
+            response.append('server_no_context_takeover')
+        if params['client_no_context_takeover']:
+            response.append('client_no_context_takeover')
+        if 'server_max_window_bits' in offered \
+                or params['server_max_window_bits'] < DEFAULT_WINDOW_BITS:
+            response.append('server_max_window_bits={}'.format(
+                                params['server_max_window_bits']))
+        if client_bits and params['client_max_window_bits'] < DEFAULT_WINDOW_BITS:
+            response.append('client_max_window_bits={}'.format(
+                                params['client_max_window_bits']))
+        return params, '; '.join(response)
+
+    return None
+
+def retire_websocket(ws):
+    """ Makes sure a websocket object we're replacing never writes
+        to the connection, even when it's garbage collected
+    """
+    ws.closed = True
+    ws.raw_write = None
+    ws.raw_read = None
+    ws.stream = None
+
+class WAMPDeflateWebSocket(WebSocket):
+    """ A websocket with permessage-deflate negotiated. Text and binary
+        messages of at least min_bytes are compressed and flagged with
+        RSV1. Anything smaller is sent as is since it isn't worth the
+        CPU. Compressed messages from the peer are inflated (up to
+        max_message_bytes) before being returned by receive().
+
+        As with the plain websocket, messages must be sent by one
+        writer at a time (the connection's outbound queue) since the
+        compressor's state carries over from message to message
+    """
+    __slots__ = ('params', 'min_bytes', 'level', 'max_message_bytes',
+                 'compressor', 'decompressor', 'deflate_stats')
+
+    def __init__(self,environ,stream,handler,params,
+                    min_bytes=DEFAULT_DEFLATE_MIN_BYTES,
+                    level=DEFAULT_DEFLATE_LEVEL,
+                    max_message_bytes=DEFAULT_INFLATE_LIMIT,
+                    stats=None):
+        super(WAMPDeflateWebSocket,self).__init__(environ,stream,handler)
+        self.params = params
+        self.min_bytes = min_bytes
+        self.level = level
+        self.max_message_bytes = max_message_bytes
+        self.compressor = None
+        self.decompressor = None
+        self.deflate_stats = WAMPDeflateStats(stats)
+
+    def compression_stats(self):
+        return self.deflate_stats.stats()
+
+    def compress(self,data):
+        """ Returns (payload, flags) for an outgoing message
+        """
+        if len(data) < self.min_bytes:
+            self.deflate_stats.sent(len(data),len(data),False)
+            return data, 0
+
+        if self.params['server_no_context_takeover'] or not self.compressor:
+            self.compressor = zlib.compressobj(
+                                    self.level,
+                                    zlib.DEFLATED,
+                                    -self.params['server_max_window_bits']
+                                )
+        payload = self.compressor.compress(data) \
+                    + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if payload.endswith(DEFLATE_TAIL):
+            payload = payload[:-4]
+
+        # Without context takeover each message stands alone so we
+        # can just send the original if compressing didn't help
+        if self.params['server_no_context_takeover'] and len(payload) >= len(data):
+            self.deflate_stats.sent(len(data),len(data),False)
+            return data, 0
+
+        self.deflate_stats.sent(len(data),len(payload),True)
+        return payload, RSV_COMPRESSED
+
+    def decompress(self,payload):
+        if self.params['client_no_context_takeover'] or not self.decompressor:
+            self.decompressor = zlib.decompressobj(-DEFAULT_WINDOW_BITS)
+        try:
+            data = self.decompressor.decompress(
+                        payload + DEFLATE_TAIL,
+                        self.max_message_bytes
+                    )
+        except zlib.error as ex:
+            raise ProtocolError("Bad compressed message: {}".format(ex))
+        if self.decompressor.unconsumed_tail:
+            raise ProtocolError("Compressed message is over {} bytes".format(
+                                    self.max_message_bytes))
+        self.deflate_stats.received(len(payload),len(data))
+        return data
+
+    def encode_frame(self,message):
+        """ Returns the bytes of a single frame carrying the message.
+            Used by the outbound queue when coalescing writes
+        """
+        if isinstance(message,six.text_type):
+            opcode = self.OPCODE_TEXT
+            message = message.encode('utf-8')
+        else:
+            opcode = self.OPCODE_BINARY
+            message = bytes(message)
+        payload, flags = self.compress(message)
+        return Header.encode_header(True,opcode,b'',len(payload),flags) + payload
+
+    def send_frame(self,message,opcode):
+        if opcode not in (self.OPCODE_TEXT,self.OPCODE_BINARY):
+            return super(WAMPDeflateWebSocket,self).send_frame(message,opcode)
+
+        if self.closed:
+            self.current_app.on_close(MSG_ALREADY_CLOSED)
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        if opcode == self.OPCODE_TEXT:
+            message = self._encode_bytes(message)
+        else:
+            message = bytes(message)
+        payload, flags = self.compress(message)
+        header = Header.encode_header(True,opcode,b'',len(payload),flags)
+        try:
+            self.raw_write(header + payload)
+        except socket_error:
+            raise WebSocketError(MSG_SOCKET_DEAD)
+
+    def read_frame(self):
+        """ As WebSocket.read_frame but RSV1 is left for read_message
+            to check
+        """
+        header = Header.decode_header(self.stream)
+
+        if header.flags & ~RSV_COMPRESSED:
+            raise ProtocolError
+
+        if not header.length:
+            return header, b''
+
+        try:
+            payload = self.raw_read(header.length)
+        except Exception:
+            payload = b''
+
+        if len(payload) != header.length:
+            raise WebSocketError('Unexpected EOF reading frame payload')
+
+        if header.mask:
+            payload = header.unmask_payload(payload)
+
+        return header, payload
+
+    def read_message(self):
+        opcode = None
+        compressed = False
+        message = bytearray()
+
+        while True:
+            header, payload = self.read_frame()
+            f_opcode = header.opcode
+
+            # Only the first frame of a data message may be flagged
+            if header.flags and f_opcode not in (self.OPCODE_TEXT,self.OPCODE_BINARY):
+                raise ProtocolError("RSV1 set on opcode={0!r}".format(f_opcode))
+
+            if f_opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+                if opcode:
+                    raise ProtocolError("The opcode in non-fin frame is "
+                                        "expected to be zero, got "
+                                        "{0!r}".format(f_opcode))
+                self.utf8validator.reset()
+                self.utf8validate_last = (True, True, 0, 0)
+                opcode = f_opcode
+                compressed = bool(header.flags)
+
+            elif f_opcode == self.OPCODE_CONTINUATION:
+                if not opcode:
+                    raise ProtocolError("Unexpected frame with opcode=0")
+
+            elif f_opcode == self.OPCODE_PING:
+                self.handle_ping(header, payload)
+                continue
+
+            elif f_opcode == self.OPCODE_PONG:
+                self.handle_pong(header, payload)
+                continue
+
+            elif f_opcode == self.OPCODE_CLOSE:
+                self.handle_close(header, payload)
+                return
+
+            else:
+                raise ProtocolError("Unexpected opcode={0!r}".format(f_opcode))
+
+            if opcode == self.OPCODE_TEXT and not compressed:
+                self.validate_utf8(payload)
+
+            message += payload
+            if len(message) > self.max_message_bytes:
+                raise ProtocolError("Message is over {} bytes".format(
+                                        self.max_message_bytes))
+
+            if header.fin:
+                break
+
+        if compressed:
+            message = self.decompress(bytes(message))
+
+        if opcode == self.OPCODE_TEXT:
+            self.validate_utf8(message)
+            return self._decode_bytes(message)
+        else:
+            return message
@@ -0,0 +1,182 @@
+import itertools
+import threading
+import collections
+
+from .common import *
+
+###########################################
+# Delta encoded publications
+###########################################
+
+# Topics whose last state is kept. Past this, the least recently
+# published topic's state is dropped and its next publish goes out
+# as a full snapshot
+DEFAULT_DELTA_TOPICS = 10000
+
+def pointer_escape(key):
+    return six.text_type(key).replace('~','~0').replace('/','~1')
+
+def pointer_unescape(part):
+    return part.replace('~1','/').replace('~0','~')
+
+def json_diff(old,new,path=''):
+    """ Returns a list of JSON-patch (RFC 6902) style add/remove/replace
+        operations that turn old into new. Dicts are compared key by
+        key, lists of the same length element by element. Anything
+        else that differs is replaced outright
+    """
+    if isinstance(old,dict) and isinstance(new,dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({'op':'remove','path':path+'/'+pointer_escape(key)})
+        for key, value in new.items():
+            key_path = path + '/' + pointer_escape(key)
+            if key not in old:
+                ops.append({'op':'add','path':key_path,'value':value})
+            elif old[key] is not value:
+                ops.extend(json_diff(old[key],value,key_path))
+        return ops
+
+    if isinstance(old,list) and isinstance(new,list) and len(old) == len(new):
+        ops = []
+        for i, value in enumerate(new):
+            if old[i] is not value:
+                ops.extend(json_diff(old[i],value,path+'/'+str(i)))
+        return ops
+
+    if type(old) == type(new) and old == new:
+        return []
+    return [{'op':'replace','path':path,'value':new}]
+
+def apply_patch(state,patch):
+    """ Applies the operations from json_diff to state (in place) and
+        returns the result
+    """
+    for op in patch:
+        path = op['path']
+        if not path:
+            state = op.get('value')
+            continue
+        parts = list(map(pointer_unescape,path.split('/')[1:]))
+        target = state
+        for part in parts[:-1]:
+            if isinstance(target,list):
+                part = int(part)
+            target = target[part]
+        last = parts[-1]
+        if isinstance(target,list):
+            last = int(last)
+        if op['op'] == 'remove':
+            del target[last]
+        else:
+            target[last] = op['value']
+    return state
+
+class WAMPTopicState(object):
+    def __init__(self,topic,version,args,kwargs,lineage):
+        self.topic = topic
+        self.version = version
+        self.args = args
+        self.kwargs = kwargs
+        # Identifies this run of versions. A topic whose state was
+        # dropped starts counting again under a new lineage so that
+        # versions seen before can't be mistaken for the new ones
+        self.lineage = lineage
+
+class WAMPDeltaUpdate(object):
+    """ The result of publishing new state to a topic. The patch from
+        the previous state is only worked out if someone needs it
+    """
+    def __init__(self,previous,current):
+        self.previous = previous
+        self.current = current
+        self._patch = None
+
+    @property
+    def patch(self):
+        if self._patch is None:
+            self._patch = json_diff(self.previous.kwargs,self.current.kwargs)
+        return self._patch
+
+class WAMPDeltaStates(object):
+    """ Keeps the last state published to each topic with
+        options={'delta': True} along with the version of that state
+        each subscriber has seen.
+
+        Subscribers that subscribed with {'delta': True} are sent just
+        the changes when they're known to hold the previous version.
+        Otherwise they get a full snapshot. Each event carries its
+        version (and the base version for patches) so a subscriber
+        that notices a gap can resync by calling wamp.topic.state.get
+    """
+    def __init__(self,max_topics=DEFAULT_DELTA_TOPICS):
+        self.topics = collections.OrderedDict()
+        self.max_topics = max_topics
+        self.evicted = 0
+        self.lineages = itertools.count(1)
+
+        # client => (subscription_id, topic) => (lineage, version)
+        self.delivered = {}
+        self.lock = threading.Lock()
+
+    def update(self,topic,args,kwargs):
+        with self.lock:
+            previous = self.topics.get(topic)
+            if previous:
+                current = WAMPTopicState(topic,previous.version+1,
+                                            args,kwargs or {},
+                                            previous.lineage)
+            else:
+                current = WAMPTopicState(topic,1,args,kwargs or {},
+                                            next(self.lineages))
+            self.topics[topic] = current
+            self.topics.move_to_end(topic)
+            while len(self.topics) > max(self.max_topics,1):
+                self.topics.popitem(last=False)
+                self.evicted += 1
+        return WAMPDeltaUpdate(previous,current)
+
+    def get(self,topic):
+        return self.topics.get(topic)
+
+    def wants_patch(self,client,key,update):
+        """ Returns True if the client holds the state the update's
+            patch applies to
+        """
+        if not update.previous:
+            return False
+        with self.lock:
+            seen = self.delivered.get(client,{}).get(key)
+        previous = update.previous
+        return seen == ( previous.lineage, previous.version )
+
+    def delivered_to(self,client,key,state):
+        with self.lock:
+            self.delivered.setdefault(client,{})[key] \
+                = ( state.lineage, state.version )
+
+    def forget(self,client,subscription_id=None):
+        """ Drops what the client has seen on the subscription, or on
+            all its subscriptions when subscription_id isn't given
+        """
+        with self.lock:
+            if subscription_id is None:
+                self.delivered.pop(client,None)
+                return
+            seen = self.delivered.get(client)
+            if not seen:
+                return
+            for key in [ key for key in seen if key[0] == subscription_id ]:
+                del seen[key]
+            if not seen:
+                del self.delivered[client]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'topics': len(self.topics),
+                'max_topics': self.max_topics,
+                'evicted': self.evicted,
+                'subscribers': len(self.delivered),
+            }
@@ -0,0 +1,398 @@
+import asyncio
+import inspect
+import threading
+import traceback
+import multiprocessing
+import concurrent.futures
+
+import gevent
+import gevent.pool
+import gevent.monkey
+
+from .common import *
+
+###########################################
+# Execution of local handlers
+###########################################
+
+DEFAULT_WORKERS = 16
+DEFAULT_QUEUE_DEPTH = 1024
+DEFAULT_GREENLETS = 1000
+DEFAULT_COROUTINES = 10000
+DEFAULT_PROCESS_PENDING = 1024
+# Forked workers would inherit the gevent hub, locks held by other
+# threads and open sockets, none of which survive the fork intact
+DEFAULT_PROCESS_START_METHOD = 'spawn'
+
+# We want the real thread id even if threading has been monkey patched
+get_thread_ident = gevent.monkey.get_original('threading','get_ident')
+
+class ExExecutorFull(Exception):
+    pass
+
+class WAMPExecutor(object):
+    """ Base class for the things that run local @wamp.register
+        callbacks. The function is invoked with args and kwargs and
+        upon completion on_result(result) or on_error(ex) will
+        be called.
+    """
+    def submit(self,function,args,kwargs,on_result,on_error):
+        raise NotImplementedError()
+
+    def stats(self):
+        return {}
+
+    def shutdown(self):
+        pass
+
+def report_error(on_error,ex):
+    try:
+        on_error(ex)
+    except Exception:
+        traceback.print_exc()
+
+def report_result(result,on_result,on_error):
+    """ Hands the result to on_result. If that blows up (a result that
+        can't be serialized for instance) the exception goes to
+        on_error instead so it never takes down the worker
+    """
+    try:
+        on_result(result)
+    except Exception as ex:
+        traceback.print_exc()
+        report_error(on_error,ex)
+
+def execute(function,args,kwargs,on_result,on_error):
+    """ Runs a single job, routing the outcome to the appropriate
+        callback
+    """
+    try:
+        result = function(*args,**kwargs)
+    except Exception as ex:
+        traceback.print_exc()
+        report_error(on_error,ex)
+        return
+    report_result(result,on_result,on_error)
+
+def default_executor(function,options=None):
+    """ Returns the name of the executor that should be used for
+        the function if the options do not explicitly pick one
+    """
+    if options and options.get('executor'):
+        return options['executor']
+    if inspect.iscoroutinefunction(function) \
+            or inspect.isasyncgenfunction(function):
+        return 'asyncio'
+    return 'thread'
+
+def is_streaming(function):
+    """ Returns True if the function produces its results in chunks
+    """
+    return inspect.isgeneratorfunction(function) \
+            or inspect.isasyncgenfunction(function)
+
+def streaming(function,on_progress=None):
+    """ Wraps a generator (or async generator) function so that each
+        chunk is handed to on_progress as soon as it is yielded. If
+        on_progress is not provided, the chunks are gathered up and
+        returned as a list
+    """
+    if inspect.isasyncgenfunction(function):
+        async def stream(*args,**kwargs):
+            chunks = []
+            async for chunk in function(*args,**kwargs):
+                if on_progress:
+                    on_progress(chunk)
+                else:
+                    chunks.append(chunk)
+            return chunks
+        return stream
+
+    def stream(*args,**kwargs):
+        chunks = []
+        for chunk in function(*args,**kwargs):
+            if on_progress:
+                on_progress(chunk)
+            else:
+                chunks.append(chunk)
+        return chunks
+    return stream
+
+class WAMPThreadPool(WAMPExecutor):
+    """ A fixed number of worker threads pulling jobs off a bounded
+        queue. When the queue is full, submissions are rejected with
+        ExExecutorFull rather than allowing the backlog to grow forever
+    """
+    def __init__(self,workers=DEFAULT_WORKERS,queue_depth=DEFAULT_QUEUE_DEPTH):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.jobs = queue.Queue(maxsize=queue_depth)
+        self.threads = []
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Threads are only created once the first job arrives
+        """
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            with self.lock:
+                self.active += 1
+            try:
+                execute(*job)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+    def submit(self,function,args,kwargs,on_result,on_error):
+        if not self.threads:
+            self.start()
+        try:
+            self.jobs.put_nowait((function,args,kwargs,on_result,on_error))
+        except queue.Full:
+            raise ExExecutorFull('Worker queue is full')
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'active_workers': self.active,
+            'queue_depth': self.jobs.qsize(),
+            'queue_size': self.queue_depth,
+        }
+
+    def shutdown(self):
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        for thread in threads:
+            self.jobs.put(None)
+
+class WAMPGreenletPool(WAMPExecutor):
+    """ Runs handlers as greenlets in a bounded gevent pool. This is
+        best for I/O bound handlers when serving with the gevent
+        server as each in-flight call only costs a greenlet.
+
+        The pool is bound to the hub of the thread that created it.
+        Submissions from other OS threads are handed over to that hub.
+    """
+    def __init__(self,size=DEFAULT_GREENLETS):
+        self.size = size
+        self.pool = gevent.pool.Pool(size)
+        self.hub = gevent.get_hub()
+        self.thread_ident = get_thread_ident()
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+    def spawn(self,job):
+        with self.lock:
+            self.reserved -= 1
+        self.pool.spawn(execute,*job)
+
+    def submit(self,function,args,kwargs,on_result,on_error):
+        # Reserve the slot up front so that spawn never has to
+        # block waiting for space in the pool
+        with self.lock:
+            if len(self.pool) + self.reserved >= self.size:
+                raise ExExecutorFull('Greenlet pool is full')
+            self.reserved += 1
+
+        job = (function,args,kwargs,on_result,on_error)
+        if get_thread_ident() == self.thread_ident:
+            self.spawn(job)
+        else:
+            self.hub.loop.run_callback_threadsafe(self.spawn,job)
+
+    def stats(self):
+        return {
+            'workers': self.size,
+            'active_workers': len(self.pool),
+            'queue_depth': self.reserved,
+            'queue_size': 0,
+        }
+
+    def shutdown(self):
+        if get_thread_ident() == self.thread_ident:
+            self.pool.kill(block=False)
+
+async def await_function(function,args,kwargs):
+    return await function(*args,**kwargs)
+
+class WAMPAsyncioExecutor(WAMPExecutor):
+    """ Runs coroutine handlers on an asyncio event loop in its own
+        thread. A slow handler that awaits on I/O only costs a pending
+        task rather than a blocked thread. The number of in-flight
+        coroutines is capped by max_pending.
+    """
+    def __init__(self,max_pending=DEFAULT_COROUTINES):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def submit(self,function,args,kwargs,on_result,on_error):
+        if not self.loop:
+            self.start()
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise ExExecutorFull('Too many pending coroutines')
+            self.pending += 1
+
+        def on_done(future):
+            with self.lock:
+                self.pending -= 1
+            try:
+                result = future.result()
+            except Exception as ex:
+                traceback.print_exception(type(ex),ex,ex.__traceback__)
+                report_error(on_error,ex)
+                return
+            report_result(result,on_result,on_error)
+
+        future = asyncio.run_coroutine_threadsafe(
+                            await_function(function,args,kwargs),
+                            self.loop
+                        )
+        future.add_done_callback(on_done)
+
+    def stats(self):
+        return {
+            'workers': 1,
+            'active_workers': self.pending,
+            'queue_depth': self.pending,
+            'queue_size': self.max_pending,
+        }
+
+    def shutdown(self):
+        with self.lock:
+            loop = self.loop
+            self.loop = None
+        if loop:
+            loop.call_soon_threadsafe(loop.stop)
+
+class PackagedMessage(object):
+    """ swampyer messages hold a reference to their serializer which
+        cannot be pickled. This carries just the message data across
+        the process boundary so it can be rebuilt on the other side
+    """
+    def __init__(self,message):
+        self.data = message.package()
+
+    def unpackage(self):
+        return WampMessage.load(self.data)
+
+def process_execute(function,args,kwargs):
+    """ Entry point in the worker process
+    """
+    args = [
+        arg.unpackage() if isinstance(arg,PackagedMessage) else arg
+        for arg in args
+    ]
+    return function(*args,**kwargs)
+
+class WAMPProcessPool(WAMPExecutor):
+    """ Sends CPU bound handlers to a pool of worker processes so they
+        don't hold the GIL while the router is trying to work.
+
+        The handler must be a module level function and its args and
+        kwargs must be picklable. The return value must be picklable
+        as well.
+
+        Workers are started with the 'spawn' method by default rather
+        than forked from the router, which is running a gevent hub and
+        other threads that a forked child can't safely carry on with.
+        Handlers are imported fresh in each worker as a result.
+    """
+    def __init__(self,workers=None,max_tasks_per_child=None,
+                        max_pending=DEFAULT_PROCESS_PENDING,
+                        start_method=DEFAULT_PROCESS_START_METHOD):
+        self.workers = workers
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_pending = max_pending
+        self.start_method = start_method
+        self.pending = 0
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.pool:
+                return
+            options = {
+                'max_workers': self.workers,
+                'mp_context': multiprocessing.get_context(self.start_method),
+            }
+            if self.max_tasks_per_child:
+                options['max_tasks_per_child'] = self.max_tasks_per_child
+            self.pool = concurrent.futures.ProcessPoolExecutor(**options)
+
+    def submit(self,function,args,kwargs,on_result,on_error):
+        if not self.pool:
+            self.start()
+
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise ExExecutorFull('Too many pending process jobs')
+            self.pending += 1
+
+        def on_done(future):
+            with self.lock:
+                self.pending -= 1
+            try:
+                result = future.result()
+            except Exception as ex:
+                traceback.print_exception(type(ex),ex,ex.__traceback__)
+                report_error(on_error,ex)
+                return
+            report_result(result,on_result,on_error)
+
+        args = [
+            PackagedMessage(arg) if isinstance(arg,WampMessage) else arg
+            for arg in args
+        ]
+        try:
+            future = self.pool.submit(process_execute,function,args,kwargs)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+        future.add_done_callback(on_done)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'active_workers': min(self.pending,self.workers or self.pending),
+            'queue_depth': self.pending,
+            'queue_size': self.max_pending,
+        }
+
+    def shutdown(self):
+        with self.lock:
+            pool = self.pool
+            self.pool = None
+        if pool:
+            pool.shutdown(wait=False)
@@ -0,0 +1,90 @@
+import json
+import numbers
+import operator
+
+from .common import *
+
+###########################################
+# Content based subscription filters
+###########################################
+
+FILTER_OPERATORS = {
+    'eq': operator.eq,
+    'in': lambda value, choices: value in choices,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+
+RANGE_OPERATORS = [ 'gt', 'gte', 'lt', 'lte' ]
+
+def is_number(value):
+    return isinstance(value,numbers.Number) and not isinstance(value,bool)
+
+class WAMPEventFilter(object):
+    """ A filter on the kwargs of a published event. The spec maps
+        kwarg names to conditions and an event must satisfy all of
+        them to be delivered. A condition is either a plain value to
+        compare against or a dict of operators:
+
+            {
+                'status': 'online',
+                'zone': {'in': ['north','south']},
+                'temperature': {'gte': 10, 'lt': 30},
+            }
+
+        Events that don't have the kwarg never match.
+    """
+    def __init__(self,spec):
+        if not isinstance(spec,dict) or not spec:
+            raise Exception('wamp.error.invalid_argument: filter must be a dict')
+        self.spec = spec
+        self.key = json.dumps(spec,sort_keys=True,default=str)
+        self.tests = []
+        for name, condition in spec.items():
+            if not isinstance(condition,dict):
+                condition = {'eq': condition}
+            for op, operand in condition.items():
+                if op not in FILTER_OPERATORS:
+                    raise Exception(
+                        "wamp.error.invalid_argument: unknown filter "
+                        "operator '{}'".format(op))
+                if op == 'in':
+                    if not isinstance(operand,(list,tuple)):
+                        raise Exception(
+                            "wamp.error.invalid_argument: 'in' needs a list")
+                    try:
+                        operand = frozenset(operand)
+                    except TypeError:
+                        operand = list(operand)
+                if op in RANGE_OPERATORS and not is_number(operand):
+                    raise Exception(
+                        "wamp.error.invalid_argument: '{}' needs a "
+                        "number".format(op))
+                self.tests.append(( name, op, FILTER_OPERATORS[op], operand ))
+
+    def matches(self,kwargs):
+        if not kwargs:
+            return False
+        for name, op, test, operand in self.tests:
+            if name not in kwargs:
+                return False
+            value = kwargs[name]
+            if op in RANGE_OPERATORS and not is_number(value):
+                return False
+            try:
+                if not test(value,operand):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+class WAMPFilterGroup(object):
+    """ All the subscribers to a subscription that share the same
+        filter. The filter is only checked once per publish for
+        the whole group
+    """
+    def __init__(self,event_filter):
+        self.filter = event_filter
+        self.clients = set()
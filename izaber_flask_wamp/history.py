@@ -0,0 +1,528 @@
+import os
+import mmap
+import time
+import array
+import bisect
+import struct
+import threading
+import traceback
+import collections
+
+from six.moves.urllib.parse import quote
+
+from .common import *
+from .uri import *
+
+###########################################
+# Disk backed per topic event history
+###########################################
+
+DEFAULT_SEGMENT_BYTES = 8*1024*1024
+DEFAULT_HISTORY_BYTES = 256*1024*1024
+DEFAULT_HISTORY_AGE = 86400 # seconds
+DEFAULT_HISTORY_QUEUE = 10000
+DEFAULT_HISTORY_LIMIT = 1000
+DEFAULT_TRIM_INTERVAL = 1.0
+
+# Topics whose logs are kept open for appending. Each holds a file
+# handle and a mapping, so the least recently written are closed
+# (and reopened when they're next written to) past this
+DEFAULT_HISTORY_OPEN = 64
+
+# Each record in a segment's log is: publish_id, timestamp, length
+# followed by the json encoded [args, kwargs]
+RECORD_HEADER = struct.Struct('<QdI')
+
+# Each entry in a segment's index is: publish_id, timestamp, offset
+# and length of the record in the log
+INDEX_ENTRY = struct.Struct('<QdQI')
+
+class WAMPHistorySegment(object):
+    """ One piece of a topic's history. The log is a preallocated file
+        that is memory mapped while it's being appended to. Once full
+        it's sealed (trimmed to size) and only ever read from again.
+
+        The index is kept in memory as compact arrays and mirrored to
+        a small .idx file next to the log so we don't have to scan the
+        log to find anything.
+    """
+    def __init__(self,path,number):
+        self.number = number
+        self.log_path = os.path.join(path,'{:010d}.log'.format(number))
+        self.idx_path = os.path.join(path,'{:010d}.idx'.format(number))
+        self.publish_ids = array.array('Q')
+        self.timestamps = array.array('d')
+        self.offsets = array.array('Q')
+        self.lengths = array.array('I')
+        # Publication ids are random so they're looked up by hash
+        self.slots = {}
+        self.position = 0
+        self.mm = None
+        self.index_file = None
+
+    def __len__(self):
+        return len(self.publish_ids)
+
+    def add_entry(self,publish_id,timestamp,offset,length):
+        self.slots[publish_id] = len(self.publish_ids)
+        self.publish_ids.append(publish_id)
+        self.timestamps.append(timestamp)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def create(self,size):
+        with open(self.log_path,'w+b') as f:
+            f.truncate(size)
+            self.mm = mmap.mmap(f.fileno(),size)
+        self.index_file = open(self.idx_path,'wb')
+
+    def resume(self,size):
+        """ Reopens a sealed segment for appending
+        """
+        size = max(size,self.position)
+        with open(self.log_path,'r+b') as f:
+            f.truncate(size)
+            self.mm = mmap.mmap(f.fileno(),size)
+        self.index_file = open(self.idx_path,'ab')
+
+    def load(self):
+        """ Reads an existing segment's index. Records that made it into
+            the log but not the index (we were stopped between the two
+            writes) are recovered by scanning the rest of the log. The
+            segment is left sealed
+        """
+        data = b''
+        if os.path.exists(self.idx_path):
+            with open(self.idx_path,'rb') as f:
+                data = f.read()
+        data = data[:len(data)-len(data)%INDEX_ENTRY.size]
+        for entry in INDEX_ENTRY.iter_unpack(data):
+            self.add_entry(*entry)
+        if self.offsets:
+            self.position = self.offsets[-1] \
+                                + RECORD_HEADER.size + self.lengths[-1]
+
+        recovered = []
+        size = os.path.getsize(self.log_path)
+        with open(self.log_path,'r+b') as f:
+            if size > self.position + RECORD_HEADER.size:
+                mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+                try:
+                    while self.position + RECORD_HEADER.size <= size:
+                        publish_id, timestamp, length = \
+                            RECORD_HEADER.unpack_from(mm,self.position)
+                        end = self.position + RECORD_HEADER.size + length
+                        if not length or end > size:
+                            break
+                        entry = (publish_id,timestamp,self.position,length)
+                        self.add_entry(*entry)
+                        recovered.append(INDEX_ENTRY.pack(*entry))
+                        self.position = end
+                finally:
+                    mm.close()
+            f.truncate(self.position)
+
+        idx_size = -1
+        if os.path.exists(self.idx_path):
+            idx_size = os.path.getsize(self.idx_path)
+        if recovered or idx_size != len(data):
+            with open(self.idx_path,'wb') as f:
+                f.write(data)
+                f.write(b''.join(recovered))
+
+    def append(self,publish_id,timestamp,payload):
+        """ Returns False if the record doesn't fit
+        """
+        length = len(payload)
+        start = self.position + RECORD_HEADER.size
+        end = start + length
+        if end > len(self.mm):
+            return False
+        RECORD_HEADER.pack_into(self.mm,self.position,publish_id,timestamp,length)
+        self.mm[start:end] = payload
+        self.index_file.write(INDEX_ENTRY.pack(
+                                publish_id,timestamp,self.position,length))
+        self.add_entry(publish_id,timestamp,self.position,length)
+        self.position = end
+        return True
+
+    def flush(self):
+        if self.index_file:
+            self.index_file.flush()
+
+    def seal(self):
+        """ No more appends. Give back the preallocated space we
+            didn't use
+        """
+        if self.mm:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+            with open(self.log_path,'r+b') as f:
+                f.truncate(self.position)
+        if self.index_file:
+            self.index_file.close()
+            self.index_file = None
+
+    def read(self,start,end):
+        """ Returns (publish_id, timestamp, payload) for the records
+            in slots start up to (but not including) end
+        """
+        if start >= end:
+            return []
+        mm = self.mm
+        f = None
+        if not mm:
+            f = open(self.log_path,'rb')
+            mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        try:
+            records = []
+            for slot in range(start,end):
+                offset = self.offsets[slot] + RECORD_HEADER.size
+                records.append((
+                    self.publish_ids[slot],
+                    self.timestamps[slot],
+                    mm[offset:offset+self.lengths[slot]],
+                ))
+            return records
+        finally:
+            if f:
+                mm.close()
+                f.close()
+
+    def remove(self):
+        self.seal()
+        for path in (self.log_path,self.idx_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+class WAMPTopicLog(object):
+    """ The append-only history of a single topic, split into segments
+        so that old events can be dropped a whole file at a time
+    """
+    def __init__(self,path,topic,segment_bytes=DEFAULT_SEGMENT_BYTES,
+                                    max_bytes=DEFAULT_HISTORY_BYTES,
+                                    max_age=DEFAULT_HISTORY_AGE):
+        self.path = path
+        self.topic = topic
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segments = []
+        self.active = None
+        self.last_timestamp = 0
+        self.trimmed = 0
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for fname in sorted(os.listdir(path)):
+            if not fname.endswith('.log'):
+                continue
+            segment = WAMPHistorySegment(path,int(fname[:-4]))
+            segment.load()
+            if len(segment):
+                self.segments.append(segment)
+                self.last_timestamp = segment.timestamps[-1]
+            else:
+                segment.remove()
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    @property
+    def size(self):
+        return sum(segment.position for segment in self.segments)
+
+    def append(self,publish_id,timestamp,payload):
+        with self.lock:
+            # Keep timestamps in order so range reads can bisect
+            timestamp = max(timestamp,self.last_timestamp)
+            self.last_timestamp = timestamp
+            if self.active and not self.active.mm:
+                self.active.resume(self.segment_bytes)
+            if not self.active \
+                    or not self.active.append(publish_id,timestamp,payload):
+                self.roll(len(payload))
+                self.active.append(publish_id,timestamp,payload)
+
+    def roll(self,needed):
+        """ Seals the active segment and starts a new one large enough
+            to hold at least the next record
+        """
+        if self.active:
+            self.active.seal()
+        number = self.segments[-1].number + 1 if self.segments else 0
+        segment = WAMPHistorySegment(self.path,number)
+        segment.create(max(self.segment_bytes,RECORD_HEADER.size+needed))
+        self.segments.append(segment)
+        self.active = segment
+
+    def flush(self):
+        with self.lock:
+            if self.active:
+                self.active.flush()
+
+    def release(self):
+        """ Closes the files held open for appending. The active
+            segment picks up where it left off on the next append
+        """
+        with self.lock:
+            if self.active:
+                self.active.seal()
+
+    def trim(self,now):
+        """ Drops the oldest segments once they're too old or we're
+            holding too much. The segment being appended to is only
+            dropped when everything in it has expired
+        """
+        with self.lock:
+            cutoff = now - self.max_age if self.max_age else None
+            while self.segments:
+                oldest = self.segments[0]
+                expired = cutoff is not None and oldest.timestamps[-1] < cutoff
+                oversize = self.max_bytes and self.size > self.max_bytes \
+                                and oldest is not self.active
+                if not expired and not oversize:
+                    break
+                if oldest is self.active:
+                    self.active = None
+                oldest.remove()
+                self.segments.pop(0)
+                self.trimmed += len(oldest)
+
+    def read(self,after=None,since=None,until=None,limit=DEFAULT_HISTORY_LIMIT):
+        """ Returns up to limit (publish_id, timestamp, payload) records
+            oldest first. Records may be selected as those published
+            after a particular publish_id and/or within a time range
+        """
+        with self.lock:
+            first_segment = 0
+            first_slot = 0
+            if after is not None:
+                for i in reversed(range(len(self.segments))):
+                    slot = self.segments[i].slots.get(after)
+                    if slot is None:
+                        continue
+                    first_slot = slot + 1
+                    first_segment = i
+                    break
+                else:
+                    raise Exception('wamp.error.history_unavailable')
+
+            records = []
+            for segment in self.segments[first_segment:]:
+                start = first_slot
+                first_slot = 0
+                if since is not None:
+                    start = max(start,bisect.bisect_left(segment.timestamps,since))
+                end = len(segment)
+                if until is not None:
+                    end = bisect.bisect_left(segment.timestamps,until)
+                end = min(end,start+limit-len(records))
+                records.extend(segment.read(start,end))
+                if len(records) >= limit or end < len(segment):
+                    break
+            return records
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.seal()
+            self.active = None
+
+class WAMPHistory(object):
+    """ Keeps a durable log of everything published on the configured
+        topics so that clients returning from a disconnect can catch
+        up on what they missed without the publisher resending it.
+
+        append() is called on the publish path so all it does is encode
+        the event and hand it to a background thread that does the
+        writing. If the writer falls too far behind, events are dropped
+        from the history (but still delivered) rather than slowing
+        down the fan-out.
+    """
+    def __init__(self,path,topics=None,
+                        segment_bytes=DEFAULT_SEGMENT_BYTES,
+                        max_bytes=DEFAULT_HISTORY_BYTES,
+                        max_age=DEFAULT_HISTORY_AGE,
+                        queue_depth=DEFAULT_HISTORY_QUEUE,
+                        max_open=DEFAULT_HISTORY_OPEN):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.patterns = WAMPURIList()
+        for topic in topics or []:
+            self.patterns.append(WAMPURI(topic))
+
+        self.logs = {}
+        self.logs_lock = threading.Lock()
+        # Logs holding files open for appending, least recently
+        # written first
+        self.open_logs = collections.OrderedDict()
+        self.max_open = max_open
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.last_trim = 0
+        self.appended = 0
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def records(self,topic):
+        """ Returns True if we keep history for the topic
+        """
+        return bool(self.patterns.match(topic))
+
+    def append(self,topic,publish_id,args,kwargs):
+        if not self.records(topic):
+            return
+        if not self.thread:
+            self.start()
+
+        # Encoded here rather than in the writer thread as the
+        # publisher is free to change args and kwargs once we return
+        try:
+            payload = get_serializer('json').dumps([args,kwargs])
+            if not isinstance(payload,bytes):
+                payload = payload.encode('utf-8')
+        except Exception:
+            traceback.print_exc()
+            self.dropped += 1
+            return
+
+        try:
+            self.queue.put_nowait((topic,publish_id,time.time(),payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def topic_log(self,topic):
+        with self.logs_lock:
+            topic_log = self.logs.get(topic)
+            if not topic_log:
+                topic_log = WAMPTopicLog(
+                                os.path.join(
+                                    self.path,
+                                    quote(topic,safe='')
+                                ),
+                                topic,
+                                self.segment_bytes,
+                                self.max_bytes,
+                                self.max_age
+                            )
+                self.logs[topic] = topic_log
+            return topic_log
+
+    def write(self,item):
+        topic, publish_id, timestamp, payload = item
+        topic_log = self.topic_log(topic)
+        topic_log.append(publish_id,timestamp,payload)
+        self.appended += 1
+
+        with self.logs_lock:
+            self.open_logs[topic] = topic_log
+            self.open_logs.move_to_end(topic)
+            released = []
+            while len(self.open_logs) > max(self.max_open,1):
+                released.append(self.open_logs.popitem(last=False)[1])
+        for idle_log in released:
+            idle_log.release()
+        return topic_log
+
+    def run(self):
+        """ The writer thread. Writes whatever has queued up, then
+            flushes the indexes of the logs it touched
+        """
+        while True:
+            batch = [ self.queue.get() ]
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            touched = set()
+            for item in batch:
+                try:
+                    touched.add(self.write(item))
+                except Exception:
+                    traceback.print_exc()
+            for topic_log in touched:
+                topic_log.flush()
+
+            now = time.time()
+            if now - self.last_trim > DEFAULT_TRIM_INTERVAL:
+                self.last_trim = now
+                self.trim(now)
+
+            for item in batch:
+                self.queue.task_done()
+
+    def trim(self,now=None):
+        now = now or time.time()
+        with self.logs_lock:
+            logs = list(self.logs.values())
+        for topic_log in logs:
+            try:
+                topic_log.trim(now)
+            except Exception:
+                traceback.print_exc()
+
+    def flush(self):
+        """ Waits for everything that's been queued to be written
+        """
+        if self.thread:
+            self.queue.join()
+
+    def read(self,topic,after=None,since=None,until=None,
+                        limit=DEFAULT_HISTORY_LIMIT):
+        """ Returns the events published on topic as a list of dicts
+            oldest first
+        """
+        if not self.records(topic):
+            raise Exception('wamp.error.history_unavailable')
+        limit = min(limit or DEFAULT_HISTORY_LIMIT,DEFAULT_HISTORY_LIMIT)
+        events = []
+        for publish_id, timestamp, payload in self.topic_log(topic).read(
+                                                    after,since,until,limit):
+            args, kwargs = get_serializer('json').loads(payload.decode('utf-8'))
+            events.append({
+                'publish_id': publish_id,
+                'timestamp': timestamp,
+                'topic': topic,
+                'args': args,
+                'kwargs': kwargs,
+            })
+        return events
+
+    def stats(self):
+        with self.logs_lock:
+            logs = list(self.logs.values())
+            open_logs = len(self.open_logs)
+        return {
+            'topics': len(logs),
+            'open_topics': open_logs,
+            'events': sum(len(topic_log) for topic_log in logs),
+            'bytes': sum(topic_log.size for topic_log in logs),
+            'trimmed': sum(topic_log.trimmed for topic_log in logs),
+            'appended': self.appended,
+            'dropped': self.dropped,
+            'queue_depth': self.queue.qsize(),
+        }
+
+    def close(self):
+        self.flush()
+        with self.logs_lock:
+            for topic_log in self.logs.values():
+                topic_log.close()
+            self.open_logs.clear()
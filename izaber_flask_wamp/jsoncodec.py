@@ -0,0 +1,131 @@
+import decimal
+
+from datetime import date, datetime
+
+from swampyer.messages import SERIALIZER_REGISTRY
+
+###########################################
+# Pluggable JSON codecs for wamp.2.json
+###########################################
+
+# This module is star imported into the package so keep datetime and
+# friends from leaking out with it
+__all__ = [
+    'JSON_CODECS',
+    'json_default',
+    'WAMPJSONCodec',
+    'WAMPOrjsonCodec',
+    'WAMPUjsonCodec',
+    'JSON_CODEC_CLASSES',
+    'load_json_codec',
+]
+
+JSON_CODECS = [ 'orjson', 'ujson', 'json' ]
+
+def json_default(obj):
+    """ Handles the same types as swampyer's WampJSONEncoder so the
+        fast codecs accept everything the stdlib one does
+    """
+    if isinstance(obj,decimal.Decimal):
+        return float(obj)
+    elif isinstance(obj,memoryview):
+        return json_default(bytes(obj))
+    elif isinstance(obj,(datetime,date)):
+        return obj.isoformat()
+    elif isinstance(obj,bytes):
+        return obj.decode()
+    raise TypeError("Object of type {} is not JSON serializable".format(
+                        type(obj).__name__))
+
+class WAMPJSONCodec(object):
+    """ The stdlib json module, through swampyer's serializer so the
+        output is exactly what swampyer itself would produce.
+
+        The faster codecs hand anything they can't cope with (ints over
+        64 bits, NaN, non string keys and the like) back to this one
+    """
+    name = 'json'
+    binary = False
+
+    def __init__(self):
+        self.fallback = SERIALIZER_REGISTRY['json']()
+
+    def dumps(self,data):
+        return self.fallback.dumps(data)
+
+    def loads(self,data):
+        return self.fallback.loads(data)
+
+class WAMPOrjsonCodec(WAMPJSONCodec):
+    name = 'orjson'
+
+    def __init__(self):
+        super(WAMPOrjsonCodec,self).__init__()
+        import orjson
+        self.orjson = orjson
+        self.options = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(self,data):
+        try:
+            return self.orjson.dumps(
+                        data,
+                        default=json_default,
+                        option=self.options
+                    ).decode('utf-8')
+        except TypeError:
+            return self.fallback.dumps(data)
+
+    def loads(self,data):
+        try:
+            return self.orjson.loads(data)
+        except ValueError:
+            return self.fallback.loads(data)
+
+class WAMPUjsonCodec(WAMPJSONCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        super(WAMPUjsonCodec,self).__init__()
+        import ujson
+        self.ujson = ujson
+
+    def dumps(self,data):
+        try:
+            return self.ujson.dumps(
+                        data,
+                        default=json_default,
+                        ensure_ascii=False,
+                        escape_forward_slashes=False
+                    )
+        except (TypeError,ValueError,OverflowError):
+            return self.fallback.dumps(data)
+
+    def loads(self,data):
+        try:
+            return self.ujson.loads(data)
+        except ValueError:
+            return self.fallback.loads(data)
+
+JSON_CODEC_CLASSES = {
+    'orjson': WAMPOrjsonCodec,
+    'ujson': WAMPUjsonCodec,
+    'json': WAMPJSONCodec,
+}
+
+def load_json_codec(preference='auto'):
+    """ Returns the requested codec, or with 'auto' the fastest one
+        that's installed. Falls back to the stdlib if the requested
+        library isn't available
+    """
+    if preference in (None,'auto'):
+        candidates = JSON_CODECS
+    else:
+        if preference not in JSON_CODEC_CLASSES:
+            raise Exception("Unknown JSON codec '{}'".format(preference))
+        candidates = [ preference, 'json' ]
+    for name in candidates:
+        try:
+            return JSON_CODEC_CLASSES[name]()
+        except ImportError:
+            continue
+    return WAMPJSONCodec()
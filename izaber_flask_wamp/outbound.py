@@ -0,0 +1,289 @@
+import time
+import threading
+import traceback
+import collections
+
+import gevent
+import gevent.event
+from geventwebsocket.websocket import Header, WebSocket
+
+from izaber.log import log
+
+from .common import *
+from .executors import get_thread_ident
+
+###########################################
+# Per connection outbound message queues
+###########################################
+
+DEFAULT_OUTBOUND_DEPTH = 1000
+# A full queue means the peer has fallen well behind. Blocking there
+# would stall whoever is sending (a publisher's whole fan-out) on that
+# one peer, and dropping frames could lose a RESULT or ERROR a caller
+# is waiting on. So by default the peer is disconnected and left to
+# reconnect. Those that do choose to block only wait briefly
+DEFAULT_OUTBOUND_POLICY = 'disconnect'
+DEFAULT_BLOCK_TIMEOUT = 1
+
+# A full queue isn't held against the peer until the writer has had
+# this long (seconds) to drain it without managing to write anything.
+# A producer on the writer's own hub can fill the queue before the
+# writer has even run, however fast the peer is
+DEFAULT_WRITER_GRACE = 0.05
+DEFAULT_COALESCE_WINDOW = 2 # milliseconds
+DEFAULT_COALESCE_BYTES = 65536
+
+OUTBOUND_POLICIES = [
+    'block',        # Wait for space (up to block_timeout without the
+                    # writer making progress, then disconnect)
+    'drop_oldest',  # Throw away the oldest queued frame
+    'disconnect',   # Give up on the peer
+]
+
+def websocket_frame(frame):
+    """ Returns the bytes of a single unmasked websocket frame
+        carrying the data
+    """
+    if isinstance(frame,six.text_type):
+        opcode = WebSocket.OPCODE_TEXT
+        frame = frame.encode('utf-8')
+    else:
+        opcode = WebSocket.OPCODE_BINARY
+    return Header.encode_header(True,opcode,b'',len(frame),0) + frame
+
+class WAMPOutboundQueue(object):
+    """ Frames destined for a single websocket are queued here and
+        written out by a dedicated writer greenlet. This means a slow
+        peer only slows down its own writer rather than whoever is
+        publishing or returning results to it.
+
+        put() may be called from any thread. The writer greenlet runs
+        on the hub of the thread that called start().
+    """
+    def __init__(self,ws,depth=DEFAULT_OUTBOUND_DEPTH,
+                        policy=DEFAULT_OUTBOUND_POLICY,
+                        block_timeout=DEFAULT_BLOCK_TIMEOUT,
+                        coalesce=False,
+                        coalesce_window=DEFAULT_COALESCE_WINDOW,
+                        coalesce_bytes=DEFAULT_COALESCE_BYTES):
+        if policy not in OUTBOUND_POLICIES:
+            raise Exception("Unknown outbound policy '{}'".format(policy))
+        self.ws = ws
+        self.depth = depth
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        # When coalescing, frames queued within coalesce_window
+        # milliseconds (or until coalesce_bytes have built up) are
+        # written to the socket with a single write
+        self.coalesce = coalesce and hasattr(ws,'raw_write')
+        self.coalesce_window = coalesce_window / 1000.0
+        self.coalesce_bytes = coalesce_bytes
+        self.queued_bytes = 0
+        self.writes = 0
+
+        self.frames = collections.deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.writer = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def start(self):
+        """ Starts the writer greenlet. Until this is called, put()
+            writes directly to the socket
+        """
+        self.hub = gevent.get_hub()
+        self.thread_ident = get_thread_ident()
+        self.ready = gevent.event.Event()
+        self.wakeup = self.hub.loop.async_()
+        self.wakeup.start(self.ready.set)
+        self.writer = gevent.spawn(self.run)
+
+    def close(self):
+        self.closed = True
+        if self.writer:
+            self.wakeup.send()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'max_depth': self.depth,
+            'high_water': self.high_water,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'writes': self.writes,
+            'policy': self.policy,
+        }
+
+    def wait_for_space(self,timeout,needed=1):
+        """ Yields to the writer until there's room for `needed` more
+            frames. Gives up (returning False) once the writer has gone
+            `timeout` seconds without writing anything, which means the
+            peer really isn't keeping up
+        """
+        writes = self.writes
+        give_up = time.time() + timeout
+        while len(self.frames) + needed > self.depth and not self.closed:
+            if self.writes != writes:
+                writes = self.writes
+                give_up = time.time() + timeout
+            elif time.time() > give_up:
+                return False
+            if get_thread_ident() == self.thread_ident:
+                gevent.sleep(0.001)
+            else:
+                time.sleep(0.001)
+        return not self.closed
+
+    def writer_grace(self):
+        """ How long the writer gets to make room before the peer is
+            considered slow
+        """
+        if self.policy == 'block':
+            return self.block_timeout
+        return DEFAULT_WRITER_GRACE
+
+    def put(self,frame):
+        if self.closed:
+            raise Exception("WAMP is currently disconnected!")
+
+        if not self.writer:
+            self.ws.send(frame)
+            self.sent += 1
+            self.writes += 1
+            return
+
+        # Before the policy applies, the writer gets a chance to drain
+        # what's been queued. Only a peer it can't write to is slow
+        if len(self.frames) >= self.depth:
+            if not self.wait_for_space(self.writer_grace()):
+                if self.closed:
+                    return
+                if self.policy != 'drop_oldest':
+                    return self.overflow()
+
+        with self.lock:
+            if self.policy == 'drop_oldest':
+                while len(self.frames) >= self.depth:
+                    self.queued_bytes -= len(self.frames.popleft())
+                    self.dropped += 1
+            self.frames.append(frame)
+            self.queued_bytes += len(frame)
+            self.high_water = max(self.high_water,len(self.frames))
+
+        self.wakeup.send()
+
+    def put_many(self,frames):
+        """ Queues several frames at once so the writer picks them up
+            (and when coalescing, writes them) together
+        """
+        if self.closed:
+            raise Exception("WAMP is currently disconnected!")
+
+        if not self.writer:
+            for frame in frames:
+                self.put(frame)
+            return
+
+        # Batches are admitted a queue's worth at a time, letting the
+        # writer drain between them. Only when it stops making progress
+        # does the policy sort out what's left
+        for i in range(0,len(frames),self.depth):
+            chunk = frames[i:i+self.depth]
+            if not self.wait_for_space(self.writer_grace(),len(chunk)):
+                for frame in frames[i:]:
+                    if self.closed:
+                        break
+                    self.put(frame)
+                return
+
+            with self.lock:
+                self.frames.extend(chunk)
+                self.queued_bytes += sum(len(frame) for frame in chunk)
+                self.high_water = max(self.high_water,len(self.frames))
+
+            self.wakeup.send()
+
+    def overflow(self):
+        """ The peer can't keep up. Drop the connection
+        """
+        log.warning("Outbound queue overflowed, disconnecting peer")
+        with self.lock:
+            self.dropped += len(self.frames) + 1
+            self.frames.clear()
+            self.queued_bytes = 0
+        self.close()
+
+    def next_frames(self):
+        """ Waits for and returns the frames that should be written next
+        """
+        while not self.frames and not self.closed:
+            self.ready.clear()
+            if self.frames:
+                break
+            self.ready.wait()
+
+        # Give the producers a moment to add more to the batch
+        if self.coalesce and self.queued_bytes < self.coalesce_bytes \
+                and not self.closed:
+            gevent.sleep(self.coalesce_window)
+
+        with self.lock:
+            if not self.frames:
+                return []
+            if not self.coalesce:
+                frame = self.frames.popleft()
+                self.queued_bytes -= len(frame)
+                return [ frame ]
+
+            frames = []
+            size = 0
+            while self.frames and ( not frames or size < self.coalesce_bytes ):
+                frame = self.frames.popleft()
+                size += len(frame)
+                frames.append(frame)
+            self.queued_bytes -= size
+            return frames
+
+    def write(self,frames):
+        """ Writes the frames out to the websocket. When coalescing,
+            all the websocket frames are assembled into a single buffer
+            and written with one call
+        """
+        if not self.coalesce:
+            for frame in frames:
+                self.ws.send(frame)
+                self.writes += 1
+            self.sent += len(frames)
+            return
+
+        # Transports other than websockets bring their own framing
+        encode_frame = getattr(self.ws,'encode_frame',websocket_frame)
+        self.ws.raw_write(b''.join(map(encode_frame,frames)))
+        self.writes += 1
+        self.sent += len(frames)
+
+    def run(self):
+        """ The writer greenlet
+        """
+        try:
+            while not self.closed:
+                frames = self.next_frames()
+                if frames:
+                    self.write(frames)
+        except Exception as ex:
+            traceback.print_exc()
+        finally:
+            self.closed = True
+            self.wakeup.close()
+            if not self.ws.closed:
+                try:
+                    self.ws.close()
+                except Exception:
+                    pass
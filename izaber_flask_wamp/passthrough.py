@@ -0,0 +1,119 @@
+import re
+import json
+
+from .common import *
+
+###########################################
+# Payload passthrough for routed calls
+###########################################
+
+DEFAULT_PASSTHROUGH_BYTES = 4096
+
+class WAMPRawPayload(object):
+    """ Mixin for messages whose args and kwargs are being carried
+        as the raw JSON text they arrived in (raw_payload). They are
+        only decoded if something actually looks at them. Otherwise
+        encode_message splices the raw text straight into the
+        outgoing frame
+    """
+    raw_payload = None
+
+    def materialize(self):
+        raw_payload = self.raw_payload
+        if raw_payload is None:
+            return
+        self.raw_payload = None
+        payload = get_serializer('json').loads(u'[' + raw_payload + u']')
+        self.__dict__['_args'] = payload[0] if len(payload) > 0 else []
+        self.__dict__['_kwargs'] = payload[1] if len(payload) > 1 else {}
+
+    def get_args(self):
+        self.materialize()
+        return self.__dict__.get('_args')
+
+    def set_args(self,value):
+        self.materialize()
+        self.__dict__['_args'] = value
+
+    def get_kwargs(self):
+        self.materialize()
+        return self.__dict__.get('_kwargs')
+
+    def set_kwargs(self,value):
+        self.materialize()
+        self.__dict__['_kwargs'] = value
+
+    args = property(get_args,set_args)
+    kwargs = property(get_kwargs,set_kwargs)
+
+# The messages that can carry their payload through the router
+RAW_PAYLOAD_CLASSES = {}
+for base in (CALL, INVOCATION, YIELD, RESULT):
+    RAW_PAYLOAD_CLASSES[base] = type(base.__name__,(WAMPRawPayload,base),{})
+
+# Lazily decoded messages and the number of fields before args
+LAZY_HEADERS = {
+    WAMP_CALL: ( RAW_PAYLOAD_CLASSES[CALL], payload_index(CALL) ),
+    WAMP_YIELD: ( RAW_PAYLOAD_CLASSES[YIELD], payload_index(YIELD) ),
+}
+
+json_decoder = json.JSONDecoder()
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+MESSAGE_START = re.compile(r'[ \t\n\r]*\[[ \t\n\r]*(\d+)')
+
+def decode_header(data):
+    """ Decodes only the header fields (code, request id, options and
+        procedure) of a JSON CALL or YIELD frame, keeping the args and
+        kwargs as raw text. Returns None for anything else so it can
+        be decoded normally
+    """
+    if isinstance(data,bytes):
+        data = data.decode('utf-8')
+    match = MESSAGE_START.match(data)
+    if not match:
+        return None
+    code = int(match.group(1))
+    if code not in LAZY_HEADERS:
+        return None
+    message_class, header_fields = LAZY_HEADERS[code]
+
+    try:
+        fields = [ code ]
+        index = match.end()
+        for i in range(header_fields-1):
+            index = WHITESPACE.match(data,index).end()
+            if data[index] != ',':
+                return None
+            index = WHITESPACE.match(data,index+1).end()
+            value, index = json_decoder.raw_decode(data,index)
+            fields.append(value)
+    except (ValueError,IndexError):
+        return None
+
+    # What remains is either nothing or ", args[, kwargs]"
+    end = len(data.rstrip())
+    if not data[index:end].endswith(']'):
+        return None
+    raw_payload = data[index:end-1].strip()
+    message = message_class().unpackage(fields)
+    if raw_payload:
+        if raw_payload[0] != ',':
+            return None
+        message.raw_payload = raw_payload[1:].strip()
+    return message
+
+def forward_payload(source,message_class,**kwargs):
+    """ Builds a message_class message carrying source's args and
+        kwargs. If source still has its raw payload, so will the new
+        message
+    """
+    raw_payload = getattr(source,'raw_payload',None)
+    if raw_payload is None:
+        return message_class(
+                    args=source.args,
+                    kwargs=source.kwargs,
+                    **kwargs
+                )
+    message = RAW_PAYLOAD_CLASSES[message_class](**kwargs)
+    message.raw_payload = raw_payload
+    return message
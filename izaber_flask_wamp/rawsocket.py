@@ -0,0 +1,261 @@
+import os
+import stat
+import struct
+import socket
+import traceback
+
+import gevent.server
+import gevent.socket
+
+from izaber.log import log
+
+from .common import *
+
+###########################################
+# WAMP RawSocket transport (TCP and Unix)
+###########################################
+
+RAWSOCKET_MAGIC = 0x7F
+DEFAULT_MAX_LENGTH_EXP = 15 # 2**24 bytes, the protocol's maximum
+
+# Serializer ids used in the handshake
+RAWSOCKET_SERIALIZERS = {
+    1: 'wamp.2.json',
+    2: 'wamp.2.msgpack',
+}
+
+# Handshake error codes
+RAWSOCKET_ERROR_SERIALIZER = 1
+RAWSOCKET_ERROR_LENGTH = 2
+RAWSOCKET_ERROR_RESERVED = 3
+RAWSOCKET_ERROR_CONNECTIONS = 4
+
+# Message types in the frame header
+RAWSOCKET_REGULAR = 0
+RAWSOCKET_PING = 1
+RAWSOCKET_PONG = 2
+
+FRAME_HEADER = struct.Struct('>I')
+
+def frame_header(message_type,length):
+    return FRAME_HEADER.pack(( message_type << 24 ) | length)
+
+def handshake_reply(length_exp,serializer_id):
+    return bytes(bytearray([
+                RAWSOCKET_MAGIC,
+                ( ( length_exp - 9 ) << 4 ) | serializer_id,
+                0, 0
+            ]))
+
+def handshake_error(code):
+    return bytes(bytearray([ RAWSOCKET_MAGIC, code << 4, 0, 0 ]))
+
+def read_exactly(reader,length):
+    """ Returns exactly length bytes from the stream or None if the
+        peer went away first
+    """
+    data = reader.read(length)
+    if data is None or len(data) < length:
+        return None
+    return data
+
+def rawsocket_handshake(sock,reader,allowed_protocols,max_length_exp):
+    """ Runs the server side of the opening handshake. Returns the
+        (protocol, peer's maximum message length) or None if the
+        connection was refused
+    """
+    request = read_exactly(reader,4)
+    if request is None:
+        return None
+    request = bytearray(request)
+    if request[0] != RAWSOCKET_MAGIC:
+        # Not WAMP. The spec says to just drop the connection
+        return None
+    if request[2] or request[3]:
+        sock.sendall(handshake_error(RAWSOCKET_ERROR_RESERVED))
+        return None
+
+    serializer_id = request[1] & 0x0F
+    protocol = RAWSOCKET_SERIALIZERS.get(serializer_id)
+    if protocol not in allowed_protocols:
+        sock.sendall(handshake_error(RAWSOCKET_ERROR_SERIALIZER))
+        return None
+
+    peer_max_length = 2 ** ( ( request[1] >> 4 ) + 9 )
+    sock.sendall(handshake_reply(max_length_exp,serializer_id))
+    return protocol, peer_max_length
+
+class WAMPRawSocket(object):
+    """ Wraps an established RawSocket connection with the same
+        interface as the websocket object WAMPServiceClient normally
+        works with (send, receive, close, closed and environ).
+
+        Each message is preceded by a 4 byte header holding the
+        message type and a 24 bit length. There's no masking or
+        per-frame flags to deal with
+    """
+    def __init__(self,sock,reader,protocol,peer_max_length,max_length):
+        self.sock = sock
+        self.reader = reader
+        self.closed = False
+        self.peer_max_length = peer_max_length
+        self.max_length = max_length
+        self.environ = {
+            'wamp.protocol': protocol,
+            'wamp.serializer': protocol_serializer(protocol),
+            'wamp.transport': 'rawsocket',
+        }
+
+    def encode_frame(self,data):
+        """ Returns the bytes to write for a single message
+        """
+        if isinstance(data,six.text_type):
+            data = data.encode('utf-8')
+        if len(data) > self.peer_max_length:
+            raise Exception(
+                "wamp.error.payload_size_exceeded: {} bytes is over the "
+                "peer's limit of {}".format(len(data),self.peer_max_length))
+        return frame_header(RAWSOCKET_REGULAR,len(data)) + data
+
+    def raw_write(self,data):
+        if self.closed:
+            raise Exception('Connection closed')
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self.close()
+            raise
+
+    def send(self,data):
+        self.raw_write(self.encode_frame(data))
+
+    def receive(self):
+        """ Returns the next message, answering any PINGs on the way.
+            Returns None once the connection has closed
+        """
+        while not self.closed:
+            try:
+                header = read_exactly(self.reader,4)
+                if header is None:
+                    break
+                value = FRAME_HEADER.unpack(header)[0]
+                message_type = value >> 24
+                length = value & 0xFFFFFF
+                if message_type > RAWSOCKET_PONG or length > self.max_length:
+                    log.warning("Dropping RawSocket peer: bad frame header")
+                    break
+                data = read_exactly(self.reader,length) if length else b''
+                if data is None:
+                    break
+            except socket.error:
+                break
+
+            if message_type == RAWSOCKET_REGULAR:
+                return data
+            if message_type == RAWSOCKET_PING:
+                try:
+                    self.raw_write(frame_header(RAWSOCKET_PONG,length) + data)
+                except Exception:
+                    break
+        self.close()
+        return None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+def unix_listener(path,backlog=128):
+    """ Binds a listening Unix domain socket at path. A stale socket
+        file left over from a previous run is replaced
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+    listener = gevent.socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(backlog)
+    return listener
+
+class WAMPRawSocketServer(object):
+    """ Accepts RawSocket connections on a TCP 'host:port' address or
+        a Unix socket path and hands each established connection to
+        session(transport), which is expected to run the WAMP session
+        until the transport closes
+    """
+    def __init__(self,address,session,allowed_protocols,
+                    max_length_exp=DEFAULT_MAX_LENGTH_EXP):
+        if not 0 <= max_length_exp <= 15:
+            raise Exception('max_length_exp must be between 0 and 15')
+        self.address = address
+        self.session = session
+        self.allowed_protocols = allowed_protocols
+        self.max_length_exp = max_length_exp
+        self.max_length = 2 ** ( max_length_exp + 9 )
+        self.unix_path = None
+
+        if isinstance(address,six.string_types) and ':' not in address:
+            self.unix_path = address
+            listener = unix_listener(address)
+        elif isinstance(address,six.string_types):
+            host, port = address.rsplit(':',1)
+            listener = ( host.strip('[]'), int(port) )
+        else:
+            listener = address
+        self.server = gevent.server.StreamServer(listener,self.handle)
+
+    @property
+    def server_address(self):
+        return self.server.address
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+        if self.unix_path:
+            try:
+                os.unlink(self.unix_path)
+            except OSError:
+                pass
+
+    def handle(self,sock,address):
+        reader = sock.makefile('rb')
+        try:
+            if self.unix_path is None:
+                sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            negotiated = rawsocket_handshake(
+                                sock,
+                                reader,
+                                self.allowed_protocols,
+                                self.max_length_exp + 9
+                            )
+            if not negotiated:
+                return
+            protocol, peer_max_length = negotiated
+            transport = WAMPRawSocket(
+                                sock,
+                                reader,
+                                protocol,
+                                peer_max_length,
+                                self.max_length
+                            )
+            self.session(transport)
+        except Exception as ex:
+            traceback.print_exc()
+        finally:
+            try:
+                reader.close()
+                sock.close()
+            except socket.error:
+                pass
@@ -1,12 +1,269 @@
+import random
+import inspect
+import itertools
 import threading
+import traceback
+import collections
+
+from izaber.log import log
 
 from .uri import *
+from .timers import *
+from .conflation import *
+from .executors import *
+from .retention import *
+from .history import *
+from .filters import *
+from .delta import *
+from .passthrough import *
+
+INVOKE_POLICIES = [
+    None, # Legacy behaviour: duplicates allowed, first one is used
+    'single',
+    'roundrobin',
+    'random',
+    'first',
+    'last',
+    'least_loaded',
+]
+
+class WAMPProcedure(object):
+    """ Tracks all the registrations that share the same procedure
+        URI and match scheme along with how calls should be spread
+        across them
+    """
+    def __init__(self,policy=None):
+        if policy not in INVOKE_POLICIES:
+            raise Exception("Unknown invocation policy '{}'".format(policy))
+        self.policy = policy
+        self.entries = []
+        self.counter = 0
+
+    def choose(self,candidates):
+        """ Picks one of the candidate registrations based upon the
+            policy of the procedure
+        """
+        policy = self.policy
+        if policy == 'roundrobin':
+            self.counter += 1
+            return candidates[self.counter % len(candidates)]
+        elif policy == 'random':
+            return random.choice(candidates)
+        elif policy == 'last':
+            return candidates[-1]
+        elif policy == 'least_loaded':
+            return min(candidates,key=lambda c: c['inflight'])
+        return candidates[0]
+
+GROUP_POLICIES = [
+    'roundrobin',
+    'least_outstanding',
+]
+
+def outstanding(client):
+    """ How many frames are waiting to be written to the client
+    """
+    outbound = getattr(client,'outbound',None)
+    if outbound is None:
+        return 0
+    return len(outbound)
+
+class WAMPSubscriberGroup(object):
+    """ Sessions that subscribed with the same {'group': name} share
+        the work. Each event only goes to one member of the group
+    """
+    def __init__(self,name,policy=None):
+        policy = policy or 'roundrobin'
+        if policy not in GROUP_POLICIES:
+            raise Exception("Unknown group policy '{}'".format(policy))
+        self.name = name
+        self.policy = policy
+        self.clients = set()
+        self.counter = 0
+
+    def choose(self,candidates):
+        """ Picks one of the (client, options) candidates. The starting
+            point rotates so ties are spread around the group
+        """
+        candidates = [ c for c in candidates if not c[0].closed() ]
+        if not candidates:
+            return None
+        self.counter += 1
+        start = self.counter % len(candidates)
+        candidates = candidates[start:] + candidates[:start]
+        if self.policy == 'least_outstanding':
+            return min(candidates,key=lambda c: outstanding(c[0]))
+        return candidates[0]
+
+def send_event(client,event):
+    client.send_message(event)
+
+class WAMPPendingCall(object):
+    """ A call that has been dispatched to a handler but hasn't
+        finished yet. Ensures that the caller receives exactly one
+        final message, even when the call times out or is canceled
+        while the handler is still working on it
+    """
+    def __init__(self,registrations,key,handler,request,callback):
+        self.registrations = registrations
+        self.key = key
+        self.handler = handler
+        self.request = request
+        self.callback = callback
+        self.done = False
+        self.timer = None
+        # Set for remote handlers. The request_id of the INVOCATION
+        # sent to the callee, and how to send it an INTERRUPT
+        self.invocation_id = None
+        self.interrupt = None
+
+    def finish(self):
+        """ Releases everything held for the call. Must be called
+            with the registrations lock held
+        """
+        self.done = True
+        self.handler['inflight'] -= 1
+        if self.registrations.calls.get(self.key) is self:
+            del self.registrations.calls[self.key]
+        if self.timer:
+            self.timer.cancel()
+
+    def deliver(self,message):
+        final = not is_progress(message)
+        with self.registrations.lock:
+            if self.done:
+                return
+            if final:
+                self.finish()
+        try:
+            self.callback(message)
+        except Exception as ex:
+            if not final or message == WAMP_ERROR:
+                raise
+            # The call is already finished so this is the last chance
+            # to let the caller know (the result couldn't be encoded
+            # for instance)
+            traceback.print_exc()
+            self.callback(ERROR(
+                request_code = WAMP_CALL,
+                request_id = self.request.request_id,
+                details = {},
+                error = self.request.procedure,
+                args = [u'Call failed: {}'.format(ex)],
+            ))
+
+    def abort(self,error,mode='killnowait'):
+        """ Ends the call early. With 'kill', the callee is asked to
+            stop and the caller gets whatever error the callee replies
+            with. 'killnowait' interrupts the callee and replies right
+            away while 'skip' just replies and leaves the callee be
+        """
+        if self.done:
+            return
+        if self.interrupt and mode != 'skip':
+            self.interrupt(mode)
+            if mode == 'kill':
+                return
+        self.deliver(ERROR(
+            request_code = WAMP_CALL,
+            request_id = self.request.request_id,
+            details = {},
+            error = error,
+            args = [],
+        ))
+
+def procedure_key(entry):
+    return ( entry.uri, entry.options.get('match') )
 
 class WAMPRegistrations(object):
     def __init__(self):
         self.registered = WAMPURIList()
         self.subscribed = WAMPURIList()
 
+        # Reverse indexes so that removing a registration or all the
+        # entries belonging to a client doesn't need to scan the tables
+        self.registrations_by_id = {}
+        self.subscriptions_by_id = {}
+        self.client_registrations = {}
+        self.client_subscriptions = {}
+
+        # (uri, match) => the shared remote subscription for the pattern
+        self.topic_subscriptions = {}
+
+        # Events published with retain=True
+        self.retention = WAMPRetention()
+
+        # Durable log of events on some topics, when configured
+        self.history = None
+
+        # (uri, match) => WAMPProcedure for shared registrations
+        self.procedures = {}
+        self.lock = threading.Lock()
+
+        # (caller session, request_id) => WAMPPendingCall. Calls that
+        # have not completed yet that may be canceled or timed out
+        self.calls = {}
+        self.timers = WAMPTimerWheel()
+
+        # callee => counter for the request_ids of the INVOCATIONs we
+        # send it. Callers' request_ids are only unique per caller so
+        # they can't be used to tell the callee's invocations apart
+        self.invocation_ids = {}
+
+        # Rate limits events to subscribers that asked for conflate_ms
+        self.conflator = WAMPConflator(self.timers)
+
+        # Last state of topics published with delta=True
+        self.deltas = WAMPDeltaStates()
+
+        # Default number of seconds a call may take when the caller
+        # does not provide a timeout. None means wait forever
+        self.call_timeout = None
+
+        # Local handlers are run by one of these. The executor is
+        # chosen through the 'executor' registration option
+        self.executors = {
+            'thread': WAMPThreadPool(),
+            'greenlet': WAMPGreenletPool(),
+            'asyncio': WAMPAsyncioExecutor(),
+            'process': WAMPProcessPool(),
+        }
+
+    def set_executor(self,name,executor):
+        """ Installs (or replaces) the executor used for local
+            handlers registered with options={'executor': name}
+        """
+        previous = self.executors.get(name)
+        self.executors[name] = executor
+        if previous:
+            previous.shutdown()
+
+    def executor_for(self,handler):
+        name = handler.get('executor') or 'thread'
+        try:
+            return self.executors[name]
+        except KeyError:
+            raise Exception("Unknown executor '{}'".format(name))
+
+    def executor_stats(self):
+        return {
+            name: executor.stats()
+            for name, executor in self.executors.items()
+        }
+
+    def set_cache_size(self,cache_size):
+        """ Sets how many URI lookups are remembered by the match
+            caches for both registrations and subscriptions
+        """
+        self.registered.set_cache_size(cache_size)
+        self.subscribed.set_cache_size(cache_size)
+
+    def cache_stats(self):
+        return {
+            'registered': self.registered.cache_stats(),
+            'subscribed': self.subscribed.cache_stats(),
+        }
+
     def register_local(self,uri,callback,options=None):
         """ Registers a local function for handling requests.
             This is the end function of using the @wamp.register
@@ -17,8 +274,10 @@ class WAMPRegistrations(object):
                         'type': 'local',
                         'callback': callback,
                         'registration_id': registration_id,
+                        'executor': default_executor(callback,options),
+                        'inflight': 0,
                     },options)
-        self.registered.append(reg_uri)
+        self.add_registration(reg_uri)
         return registration_id
 
     def register_remote(self,uri,client,options=None):
@@ -26,34 +285,120 @@ class WAMPRegistrations(object):
             callback on a uri
         """
         registration_id = secure_rand()
-        self.registered.append(
+        self.add_registration(
             WAMPURI(uri,{
                 'type': 'remote',
                 'client': client,
                 'registration_id': registration_id,
+                'inflight': 0,
             },options)
         )
         return registration_id
 
-    def unregister(self,registration_id):
-        """ Removes a URI as a callback target
+    def add_registration(self,reg_uri):
+        """ Adds the registration to the procedure it belongs to. The
+            first registration of a procedure decides the invocation
+            policy and later registrations must agree with it
         """
-        self.registered.remove(lambda r: r['registration_id'] == registration_id)
+        key = procedure_key(reg_uri)
+        policy = reg_uri.options.get('invoke')
+
+        # Registrations from dead clients shouldn't block new ones
+        procedure = self.procedures.get(key)
+        if procedure:
+            for entry in list(procedure.entries):
+                client = entry.get('client')
+                if client and client.closed():
+                    self.reap_client(client)
+
+        procedure = self.procedures.get(key)
+        if procedure:
+            if procedure.policy == 'single' \
+                    or procedure.policy != policy:
+                raise Exception('wamp.error.procedure_already_exists')
+        else:
+            procedure = WAMPProcedure(policy)
+            self.procedures[key] = procedure
+
+        procedure.entries.append(reg_uri)
+        self.registered.append(reg_uri)
+        self.registrations_by_id[reg_uri['registration_id']] = reg_uri
+        client = reg_uri.get('client')
+        if client:
+            self.client_registrations.setdefault(client,set()).add(reg_uri)
+
+    def remove_registration(self,entry):
+        """ Removes the registration from the table and all indexes
+        """
+        if not self.registered.discard(entry):
+            return
+        self.registrations_by_id.pop(entry['registration_id'],None)
+
+        client = entry.get('client')
+        if client:
+            owned = self.client_registrations.get(client)
+            if owned:
+                owned.discard(entry)
+                if not owned:
+                    del self.client_registrations[client]
+
+        key = procedure_key(entry)
+        procedure = self.procedures.get(key)
+        if procedure:
+            if entry in procedure.entries:
+                procedure.entries.remove(entry)
+            if not procedure.entries:
+                del self.procedures[key]
+
+    def unregister(self,registration_id,client=None):
+        """ Removes a URI as a callback target. If the client is
+            provided, the registration must belong to that client
+        """
+        entry = self.registrations_by_id.get(registration_id)
+        if not entry or ( client and entry.get('client') != client ):
+            raise Exception('wamp.error.no_such_registration')
+        self.remove_registration(entry)
         return registration_id
 
+    def choose_handler(self,uri):
+        """ Finds the registration that should service a call to
+            the uri. Registrations belonging to closed clients are
+            skipped (and reaped) rather than failing the call
+        """
+        while True:
+            handlers = self.registered.match(uri)
+            if not handlers:
+                raise Exception('uri does not exist')
+
+            # The first matched handler decides which procedure
+            # we're dealing with
+            procedure = self.procedures.get(procedure_key(handlers[0]))
+            if not procedure:
+                return handlers[0]
+
+            candidates = []
+            closed = []
+            for entry in procedure.entries:
+                client = entry.get('client')
+                if client and client.closed():
+                    closed.append(client)
+                else:
+                    candidates.append(entry)
+
+            if candidates:
+                with self.lock:
+                    handler = procedure.choose(candidates)
+            for client in closed:
+                self.reap_client(client)
+            if candidates:
+                return handler
+
     def invoke(self,client,request,callback):
         """ Runs the RPC code associated with the URI
         """
         uri = request.procedure
-        args = request.args
-        kwargs = request.kwargs
 
-        handlers = self.registered.match(uri)
-        if not handlers:
-            raise Exception('uri does not exist')
-
-        # Use the first matched handler
-        handler = handlers[0]
+        handler = self.choose_handler(uri)
 
         # We will disclose the identity by default
         # FIXME: we want to parallel the autobahn flexibility with
@@ -63,83 +408,18 @@ class WAMPRegistrations(object):
             'progress': 0,
             'caller': client.session_id,
             'caller_authid': client.auth.get('authid'),
-            'caller_role': client.auth.get('role'),
+            'caller_role': client.auth.get('authrole') or client.auth.get('role'),
             'enc_algo': None,
         }
 
-        if handler['type'] == 'local':
-            def thread_run():
-                try:
-                    registration_id = handler['registration_id']
-                    invoke = INVOCATION(
-                        request_id=request.request_id,
-                        registration_id=registration_id,
-                        details=details
-                    )
-                    result = handler['callback'](invoke,*args,**kwargs)
-                    callback(RESULT(
-                        request_id = request.request_id,
-                        details = details,
-                        args = [ result ],
-                        kwargs = {}
-                    ))
-                except Exception as ex:
-                    import traceback
-                    traceback.print_exc()
-                    callback(ERROR(
-                        request_code = WAMP_INVOCATION,
-                        request_id = request.request_id,
-                        details = details,
-                        error = uri,
-                        args = [u'Call failed: {}'.format(ex)],
-                    ))
-
-            thread_process = threading.Thread(target=thread_run)
-            thread_process.daemon = True
-            thread_process.start()
-        elif handler['type'] == 'remote':
-            def on_yield(result):
-                if result == WAMP_YIELD:
-                    callback(RESULT(
-                        request_id = request.request_id,
-                        details = details,
-                        args = result.args,
-                        kwargs = result.kwargs
-                    ))
-                else:
-                    callback(result)
-
-            registration_id = handler['registration_id']
-            handler_client = handler['client']
-            if handler_client.closed():
-                self.reap_client(handler_client)
-                raise Exception('uri does not exist')
-            handler_client.send_and_await_response(
-                INVOCATION(
-                    request_id=request.request_id,
-                    registration_id=registration_id,
-                    details=details,
-                    args=args,
-                    kwargs=kwargs
-                ),
-                on_yield
-            )
-        else:
-            raise Exception('Unknown handler type')
+        self.dispatch(handler,request,details,callback)
 
     def invoke_local(self,auth,request,callback):
         """ Runs the RPC code associated with the URI
         """
         uri = request.procedure
-        args = request.args
-        kwargs = request.kwargs
-
-        handlers = self.registered.match(uri)
-        if not handlers:
-            raise Exception('uri does not exist')
 
-        # Use the first matched handler
-        handler = handlers[0]
+        handler = self.choose_handler(uri)
 
         # We will disclose the identity by default
         # FIXME: we want to parallel the autobahn flexibility with
@@ -157,102 +437,423 @@ class WAMPRegistrations(object):
             'enc_algo': None,
         }
 
+        self.dispatch(handler,request,details,callback)
+
+    def dispatch(self,handler,request,details,callback):
+        """ Hands the request off to the handler that was chosen
+        """
         if handler['type'] == 'local':
-            def thread_run():
-                try:
-                    registration_id = handler['registration_id']
-                    invoke = INVOCATION(
-                        request_id=request.request_id,
-                        registration_id=registration_id,
-                        details=details
-                    )
-                    result = handler['callback'](invoke,*args,**kwargs)
+            dispatcher = self.dispatch_local
+        elif handler['type'] == 'remote':
+            dispatcher = self.dispatch_remote
+        else:
+            raise Exception('Unknown handler type')
+
+        key = ( details['caller'], request.request_id )
+        pending = WAMPPendingCall(self,key,handler,request,callback)
+
+        # Keep track of how many calls the handler is working on
+        # so the least_loaded policy has something to go by
+        with self.lock:
+            handler['inflight'] += 1
+            self.calls[key] = pending
+
+        # CALL timeouts are in milliseconds
+        timeout = request.options.get('timeout')
+        if timeout:
+            timeout = timeout / 1000.0
+        else:
+            timeout = self.call_timeout
+        if timeout:
+            pending.timer = self.timers.schedule(
+                timeout,
+                lambda: pending.abort('wamp.error.timeout')
+            )
+
+        try:
+            if handler['type'] == 'remote':
+                pending.invocation_id = self.next_invocation_id(handler['client'])
+                pending.interrupt = dispatcher(handler,request,details,
+                                                pending.deliver,
+                                                pending.invocation_id)
+            else:
+                dispatcher(handler,request,details,pending.deliver)
+        except Exception:
+            with self.lock:
+                if not pending.done:
+                    pending.finish()
+            raise
+
+    def next_invocation_id(self,client):
+        """ Returns a fresh request_id for an INVOCATION to the client
+        """
+        counter = self.invocation_ids.get(client)
+        if counter is None:
+            counter = self.invocation_ids.setdefault(client,itertools.count(1))
+        return next(counter)
+
+    def cancel(self,session_id,request_id,mode=None):
+        """ Cancels a call the session made that is still in progress.
+            Returns True if there was something to cancel
+        """
+        pending = self.calls.get(( session_id, request_id ))
+        if not pending:
+            return False
+        pending.abort('wamp.error.canceled',mode or 'killnowait')
+        return True
+
+    def pending_calls(self):
+        return len(self.calls)
+
+    def dispatch_local(self,handler,request,details,callback):
+        """ Runs a local @wamp.register callback on its executor
+        """
+        uri = request.procedure
+        registration_id = handler['registration_id']
+        invoke = INVOCATION(
+            request_id=request.request_id,
+            registration_id=registration_id,
+            details=details
+        )
+
+        # Generator handlers stream each chunk back as a progressive
+        # result if the caller asked for it. Otherwise the chunks are
+        # returned together as a list
+        function = handler['callback']
+        progressive = False
+        if is_streaming(function):
+            on_progress = None
+            if request.options.get('receive_progress'):
+                progressive = True
+                def on_progress(chunk):
                     callback(RESULT(
                         request_id = request.request_id,
-                        details = details,
-                        args = [ result ],
+                        details = dict(details,progress=True),
+                        args = [ chunk ],
                         kwargs = {}
                     ))
-                except Exception as ex:
-                    import traceback
-                    traceback.print_exc()
-                    callback(ERROR(
-                        request_code = WAMP_INVOCATION,
-                        request_id = request.request_id,
-                        details = details,
-                        error = uri,
-                        args = [u'Call failed: {}'.format(ex)],
-                    ))
+            function = streaming(function,on_progress)
 
-            thread_process = threading.Thread(target=thread_run)
-            thread_process.daemon = True
-            thread_process.start()
-        elif handler['type'] == 'remote':
-            def on_yield(result):
-                if result == WAMP_YIELD:
-                    callback(RESULT(
-                        request_id = request.request_id,
-                        details = details,
-                        args = result.args,
-                        kwargs = result.kwargs
-                    ))
-                else:
-                    callback(result)
+        def on_result(result):
+            callback(RESULT(
+                request_id = request.request_id,
+                details = details,
+                args = [] if progressive else [ result ],
+                kwargs = {}
+            ))
 
-            registration_id = handler['registration_id']
-            handler_client = handler['client']
-            if handler_client.closed():
-                self.reap_client(handler_client)
-                raise Exception('uri does not exist')
-            handler_client.send_and_await_response(
-                INVOCATION(
-                    request_id = request.request_id,
-                    registration_id = registration_id,
-                    details = details,
-                    args = args,
-                    kwargs = kwargs
-                ),
-                on_yield
+        def on_error(ex):
+            callback(ERROR(
+                request_code = WAMP_CALL,
+                request_id = request.request_id,
+                details = details,
+                error = uri,
+                args = [u'Call failed: {}'.format(ex)],
+            ))
+
+        executor = self.executor_for(handler)
+        try:
+            executor.submit(
+                function,
+                [invoke] + list(request.args),
+                request.kwargs,
+                on_result,
+                on_error
             )
-        else:
-            raise Exception('Unknown handler type')
+        except ExExecutorFull as ex:
+            callback(ERROR(
+                request_code = WAMP_CALL,
+                request_id = request.request_id,
+                details = details,
+                error = 'wamp.error.no_available_callee',
+                args = [u'Call rejected: {}'.format(ex)],
+            ))
+
+    def dispatch_remote(self,handler,request,details,callback,invocation_id):
+        """ Sends an INVOCATION to the client that registered the URI.
+            The callee's replies carry invocation_id and are sent on to
+            the caller under the request_id of its CALL
+        """
+        receive_progress = bool(request.options.get('receive_progress'))
+
+        def on_yield(result):
+            if result == WAMP_YIELD:
+                result_details = details
+                if is_progress(result):
+                    # Callees shouldn't send progress unless asked
+                    # but if they do, the caller isn't expecting it
+                    if not receive_progress:
+                        return
+                    result_details = dict(details,progress=True)
+                callback(forward_payload(
+                    result,
+                    RESULT,
+                    request_id = request.request_id,
+                    details = result_details,
+                ))
+            elif result == WAMP_ERROR:
+                callback(ERROR(
+                    request_code = WAMP_CALL,
+                    request_id = request.request_id,
+                    details = result.details,
+                    error = result.error,
+                    args = result.args,
+                    kwargs = result.kwargs,
+                ))
+            else:
+                callback(result)
+
+        invocation_details = details
+        if receive_progress:
+            invocation_details = dict(details,receive_progress=True)
+
+        registration_id = handler['registration_id']
+        handler_client = handler['client']
+        if handler_client.closed():
+            self.reap_client(handler_client)
+            raise Exception('uri does not exist')
+        handler_client.send_and_await_response(
+            forward_payload(
+                request,
+                INVOCATION,
+                request_id = invocation_id,
+                registration_id = registration_id,
+                details = invocation_details,
+            ),
+            on_yield
+        )
+
+        def interrupt(mode):
+            handler_client.interrupt(invocation_id,mode)
+        return interrupt
 
     def subscribe_local(self,uri,callback,options=None):
         """ Registers a local function to be invoked when the URI
             matches a particular pattern
         """
         subscription_id = secure_rand()
+        # Plain functions are called inline when the event is
+        # published. Coroutines (or those that ask for an executor)
+        # get handed off to be run elsewhere
+        executor = None
+        if ( options and options.get('executor') ) \
+                or inspect.iscoroutinefunction(callback):
+            executor = default_executor(callback,options)
+
         sub_uri = WAMPURI(uri,{
                 'subscription_id': subscription_id,
                 'type': 'local',
                 'callback': callback,
+                'executor': executor,
             },options)
-        self.subscribed.append(sub_uri)
+        self.add_subscription(sub_uri)
         return subscription_id
 
     def subscribe_remote(self,uri,client,options=None):
         """ Registers a remote function to be invoked when the URI
             matches a particular pattern
+
+            All sessions subscribed to the same topic pattern share the
+            same subscription and subscription_id so that an event
+            only needs to be built and serialized once per pattern
         """
-        subscription_id = secure_rand()
-        sub_uri = WAMPURI(uri,{
-                        'subscription_id': subscription_id,
-                        'type': 'remote',
-                        'client': client,
-                    },options)
+        options = options or {}
+        event_filter = None
+        if options.get('filter'):
+            event_filter = WAMPEventFilter(options['filter'])
+        group_policy = options.get('group_policy')
+        if group_policy is not None and group_policy not in GROUP_POLICIES:
+            raise Exception("Unknown group policy '{}'".format(group_policy))
+
+        key = ( uri, options.get('match') )
+        sub_uri = self.topic_subscriptions.get(key)
+        if not sub_uri:
+            sub_uri = WAMPURI(uri,{
+                            'subscription_id': secure_rand(),
+                            'type': 'remote',
+                            'subscribers': collections.OrderedDict(),
+                            'filters': collections.OrderedDict(),
+                            'groups': collections.OrderedDict(),
+                        },options)
+            self.topic_subscriptions[key] = sub_uri
+            self.add_subscription(sub_uri)
+
+        # The first member of a queue group decides how work is spread
+        name = options.get('group')
+        queue_group = sub_uri['groups'].get(name) if name is not None else None
+        if queue_group and group_policy \
+                and group_policy != queue_group.policy \
+                and queue_group.clients - {client}:
+            raise Exception('wamp.error.group_policy_mismatch')
+
+        # Each session may have its own options for the subscription.
+        # Sessions with identical filters are grouped so each filter
+        # only needs to be checked once per publish
+        self.ungroup_subscriber(sub_uri,client)
+        if event_filter:
+            filter_group = sub_uri['filters'].get(event_filter.key)
+            if not filter_group:
+                filter_group = sub_uri['filters'][event_filter.key] \
+                             = WAMPFilterGroup(event_filter)
+            filter_group.clients.add(client)
+        if name is not None:
+            queue_group = sub_uri['groups'].get(name)
+            if not queue_group:
+                queue_group = sub_uri['groups'][name] \
+                            = WAMPSubscriberGroup(name,group_policy)
+            queue_group.clients.add(client)
+        sub_uri['subscribers'][client] = options
+        self.client_subscriptions.setdefault(client,set()).add(sub_uri)
+        return sub_uri['subscription_id']
+
+    def add_subscription(self,sub_uri):
         self.subscribed.append(sub_uri)
-        return subscription_id
+        self.subscriptions_by_id[sub_uri['subscription_id']] = sub_uri
+
+    def remove_subscription(self,entry):
+        """ Removes the subscription from the table and all indexes
+        """
+        if not self.subscribed.discard(entry):
+            return
+        self.subscriptions_by_id.pop(entry['subscription_id'],None)
+
+        key = ( entry.uri, entry.options.get('match') )
+        if self.topic_subscriptions.get(key) is entry:
+            del self.topic_subscriptions[key]
+
+        for client in list(entry.get('subscribers',())):
+            self.remove_subscriber(entry,client)
+
+    def ungroup_subscriber(self,entry,client):
+        """ Removes the session from whichever filter and queue
+            groups it's in
+        """
+        for groups in (entry['filters'],entry['groups']):
+            for key, group in list(groups.items()):
+                if client in group.clients:
+                    group.clients.discard(client)
+                    if not group.clients:
+                        del groups[key]
+
+    def subscriber_filter(self,entry,client):
+        for group in list(entry.get('filters',{}).values()):
+            if client in group.clients:
+                return group.filter
+        return None
 
-    def unsubscribe(self,subscription_id):
-        """ Removes a URI as a subscriber target
+    def event_recipients(self,entry,kwargs):
+        """ Returns the (client, options) of the subscribers whose
+            filters (if any) the event's kwargs pass. Of those in a
+            queue group, only one member per group is picked
         """
-        self.subscribed.remove(lambda r: r['subscription_id'] == subscription_id)
+        subscribers = list(entry['subscribers'].items())
+        filters = entry['filters']
+        if filters:
+            rejected = set()
+            for group in list(filters.values()):
+                if not group.filter.matches(kwargs):
+                    rejected.update(group.clients)
+            if rejected:
+                subscribers = [
+                    ( client, options )
+                    for client, options in subscribers
+                    if client not in rejected
+                ]
+
+        groups = entry['groups']
+        if not groups:
+            return subscribers
+
+        recipients = []
+        members = collections.OrderedDict()
+        for client, options in subscribers:
+            name = options.get('group')
+            if name is None:
+                recipients.append(( client, options ))
+            else:
+                members.setdefault(name,[]).append(( client, options ))
+        for name, candidates in members.items():
+            group = groups.get(name)
+            chosen = group.choose(candidates) if group else candidates[0]
+            if chosen:
+                recipients.append(chosen)
+        return recipients
+
+    def remove_subscriber(self,entry,client):
+        """ Takes a single session off of a shared subscription. The
+            subscription goes away with its last subscriber
+        """
+        subscribers = entry['subscribers']
+        subscribers.pop(client,None)
+        self.ungroup_subscriber(entry,client)
+        self.conflator.discard(client,entry['subscription_id'])
+        self.deltas.forget(client,entry['subscription_id'])
+
+        owned = self.client_subscriptions.get(client)
+        if owned:
+            owned.discard(entry)
+            if not owned:
+                del self.client_subscriptions[client]
+
+        if not subscribers:
+            self.remove_subscription(entry)
+
+    def unsubscribe(self,subscription_id,client=None):
+        """ Removes a URI as a subscriber target. If the client is
+            provided, only that client's interest in the subscription
+            is removed
+        """
+        entry = self.subscriptions_by_id.get(subscription_id)
+        if not entry:
+            raise Exception('wamp.error.no_such_subscription')
+        if client:
+            if client not in entry.get('subscribers',()):
+                raise Exception('wamp.error.no_such_subscription')
+            self.remove_subscriber(entry,client)
+        else:
+            self.remove_subscription(entry)
         return subscription_id
 
     def publish(self,request):
         """ Send the publication to all subscribers
             (If there are any...)
         """
+        return self.route_publication(request,send_event)
+
+    def publish_many(self,requests):
+        """ Publishes a batch of PUBLISH requests. Subscribers are only
+            matched once per distinct topic and each session's events
+            are handed to it together so they can be written out in
+            one go. Returns the publication ids in order
+        """
+        batches = collections.OrderedDict()
+        def queue_event(client,event):
+            batches.setdefault(client,[]).append(event)
+
+        matches = {}
+        publish_ids = [
+            self.route_publication(request,queue_event,matches)
+            for request in requests
+        ]
+
+        for client, events in batches.items():
+            if client.closed():
+                continue
+            send_messages = getattr(client,'send_messages',None)
+            if send_messages:
+                send_messages(events)
+            else:
+                for event in events:
+                    client.send_message(event)
+
+        return publish_ids
+
+    def route_publication(self,request,send,matches=None):
+        """ Works out who should receive the publication and hands
+            the events for remote sessions to send(client,event).
+            matches may be a dict used to remember the subscriptions
+            that match each topic
+        """
         uri = request.topic
         publish_id = secure_rand()
 
@@ -260,30 +861,134 @@ class WAMPRegistrations(object):
             'topic': uri
         }
 
-        subscribers = self.subscribed.match(uri)
-        for subscriber in subscribers:
+        if request.options.get('retain'):
+            self.retention.retain(uri,publish_id,request.args,request.kwargs)
+
+        if self.history:
+            self.history.append(uri,publish_id,request.args,request.kwargs)
+
+        # Full events for delta publishes are snapshots of the state
+        delta = None
+        if request.options.get('delta'):
+            delta = self.deltas.update(uri,request.args,request.kwargs)
+            details['version'] = delta.current.version
+            details['state'] = 'snapshot'
+
+        if matches is None:
+            subscriptions = self.subscribed.match(uri)
+        else:
+            subscriptions = matches.get(uri)
+            if subscriptions is None:
+                subscriptions = matches[uri] = self.subscribed.match(uri)
+        for subscription in subscriptions:
+            # Don't bother building the event if every subscriber
+            # has filtered it out
+            if subscription['type'] == 'remote':
+                recipients = self.event_recipients(subscription,request.kwargs)
+                if not recipients:
+                    continue
+
             publish_event = EVENT(
-                subscription_id = subscriber['subscription_id'],
+                subscription_id = subscription['subscription_id'],
                 publish_id = publish_id,
                 args = request.args,
                 kwargs = request.kwargs,
                 details = details,
             )
-            if subscriber['type'] == 'local':
-                subscriber['callback'](publish_event)
-            elif subscriber['type'] == 'remote':
-                client = subscriber['client']
-                if client.closed():
-                    self.reap_client(client)
-                    continue
-                client.send_message(publish_event)
+            if subscription['type'] == 'local':
+                if subscription['executor']:
+                    self.submit_event(subscription,publish_event)
+                else:
+                    subscription['callback'](publish_event)
+            elif subscription['type'] == 'remote':
+                # Every session gets exactly the same frame
+                publish_event.frame_cache = {}
+                patch_event = None
+                for client, options in recipients:
+                    if client.closed():
+                        self.reap_client(client)
+                        continue
+                    if options.get('conflate_ms'):
+                        self.conflator.deliver(
+                            client,
+                            subscription['subscription_id'],
+                            publish_event,
+                            options['conflate_ms']
+                        )
+                        continue
+
+                    # Sessions that already have the previous state
+                    # only need to be told what changed
+                    if delta and options.get('delta'):
+                        key = ( subscription['subscription_id'], uri )
+                        if self.deltas.wants_patch(client,key,delta):
+                            if patch_event is None:
+                                patch_event = EVENT(
+                                    subscription_id = subscription['subscription_id'],
+                                    publish_id = publish_id,
+                                    args = request.args,
+                                    kwargs = {},
+                                    details = dict(
+                                        details,
+                                        state = 'delta',
+                                        base = delta.previous.version,
+                                        patch = delta.patch,
+                                    ),
+                                )
+                                patch_event.frame_cache = {}
+                            send(client,patch_event)
+                        else:
+                            send(client,publish_event)
+                        self.deltas.delivered_to(client,key,delta.current)
+                        continue
+
+                    send(client,publish_event)
 
         return publish_id
 
+    def retained_events(self,subscription_id,client=None):
+        """ Returns EVENTs for everything retained on topics that
+            match the subscription (and the client's filter)
+        """
+        entry = self.subscriptions_by_id.get(subscription_id)
+        if not entry:
+            return []
+        event_filter = self.subscriber_filter(entry,client)
+        return [
+            EVENT(
+                subscription_id = subscription_id,
+                publish_id = retained.publish_id,
+                args = retained.args,
+                kwargs = retained.kwargs,
+                details = {
+                    'topic': retained.topic,
+                    'retained': True,
+                },
+            )
+            for retained in self.retention.matching(entry)
+            if not event_filter or event_filter.matches(retained.kwargs)
+        ]
+
+    def submit_event(self,subscriber,event):
+        """ Hands an event over to the subscriber's executor. There's
+            nobody to report the outcome to so we only log failures
+        """
+        def ignore(result):
+            pass
+        try:
+            self.executor_for(subscriber).submit(
+                subscriber['callback'],[event],{},ignore,ignore
+            )
+        except ExExecutorFull as ex:
+            log.warning("Dropped event for {}: {}".format(subscriber.uri,ex))
+
     def reap_client(self,client):
         """ Removes a client from all registrations and subcriptions
             Usually used when a client disconnects
         """
-        self.registered.remove(lambda r: r.get('client') == client)
-        self.subscribed.remove(lambda r: r.get('client') == client)
+        for entry in list(self.client_registrations.get(client,())):
+            self.remove_registration(entry)
+        for entry in list(self.client_subscriptions.get(client,())):
+            self.remove_subscriber(entry,client)
+        self.invocation_ids.pop(client,None)
 
@@ -0,0 +1,101 @@
+import copy
+import json
+import threading
+import collections
+
+from .common import *
+
+###########################################
+# Event retention
+###########################################
+
+DEFAULT_RETENTION_DEPTH = 1
+DEFAULT_RETENTION_BYTES = 16*1024*1024
+
+class WAMPRetainedEvent(object):
+    """ Holds its own copy of the payload since the publisher may keep
+        changing args and kwargs long after it was retained
+    """
+    def __init__(self,topic,publish_id,args,kwargs):
+        self.topic = topic
+        self.publish_id = publish_id
+        self.args = copy.deepcopy(args)
+        self.kwargs = copy.deepcopy(kwargs)
+        try:
+            self.size = len(json.dumps([args,kwargs],default=str))
+        except Exception:
+            self.size = 0
+
+class WAMPRetention(object):
+    """ Keeps the last few events published on each topic (where the
+        publisher asked for them to be retained) so that new
+        subscribers can catch up without having to ask for the
+        current state.
+
+        Each topic keeps up to `depth` events (overridable per topic).
+        Once the total size of retained events goes over max_bytes,
+        events are evicted starting from the topic that was published
+        to least recently.
+    """
+    def __init__(self,depth=DEFAULT_RETENTION_DEPTH,
+                        max_bytes=DEFAULT_RETENTION_BYTES,
+                        topics=None):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.topic_depths = dict(topics or {})
+        self.topics = collections.OrderedDict()
+        self.size = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def depth_for(self,topic):
+        return self.topic_depths.get(topic,self.depth)
+
+    def retain(self,topic,publish_id,args,kwargs):
+        depth = self.depth_for(topic)
+        if depth <= 0:
+            return
+
+        event = WAMPRetainedEvent(topic,publish_id,args,kwargs)
+        with self.lock:
+            events = self.topics.pop(topic,None)
+            if events is None:
+                events = collections.deque()
+            self.topics[topic] = events
+
+            events.append(event)
+            self.size += event.size
+            while len(events) > depth:
+                self.size -= events.popleft().size
+
+            # Over budget? Throw out the stalest events first
+            while self.size > self.max_bytes and self.topics:
+                stale_topic, stale = next(iter(self.topics.items()))
+                self.size -= stale.popleft().size
+                self.evicted += 1
+                if not stale:
+                    del self.topics[stale_topic]
+
+    def matching(self,subscription):
+        """ Returns the retained events for all topics that match
+            the subscription's WAMPURI, oldest first
+        """
+        with self.lock:
+            if subscription.scheme == 'exact':
+                events = self.topics.get(subscription.uri)
+                return list(events or [])
+
+            matched = []
+            for topic, events in self.topics.items():
+                if subscription.match(topic):
+                    matched.extend(events)
+            return matched
+
+    def stats(self):
+        return {
+            'topics': len(self.topics),
+            'events': sum(len(events) for events in self.topics.values()),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'evicted': self.evicted,
+        }
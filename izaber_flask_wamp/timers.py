@@ -0,0 +1,92 @@
+import time
+import threading
+import traceback
+
+###########################################
+# Timer wheel for expiring pending requests
+###########################################
+
+DEFAULT_RESOLUTION = 0.1
+DEFAULT_SLOTS = 512
+
+class WAMPTimer(object):
+    def __init__(self,callback,rounds):
+        self.callback = callback
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class WAMPTimerWheel(object):
+    """ A hashed timer wheel. Scheduling and cancelling are O(1) and
+        each tick only looks at the timers in one slot, so keeping
+        thousands of pending call timeouts around is cheap.
+
+        Timers fire on the wheel's own thread within one resolution
+        period of their deadline.
+    """
+    def __init__(self,resolution=DEFAULT_RESOLUTION,slots=DEFAULT_SLOTS):
+        self.resolution = resolution
+        self.slots = [ [] for i in range(slots) ]
+        self.position = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def schedule(self,delay,callback):
+        """ Calls callback after delay seconds. Returns a WAMPTimer
+            that can be cancelled
+        """
+        if not self.thread:
+            self.start()
+
+        ticks = max(int(round(delay/self.resolution)),1)
+        with self.lock:
+            slot = ( self.position + ticks ) % len(self.slots)
+            timer = WAMPTimer(callback,( ticks - 1 ) // len(self.slots))
+            self.slots[slot].append(timer)
+        return timer
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def tick(self):
+        """ Advance the wheel by one slot and fire anything due
+        """
+        with self.lock:
+            self.position = ( self.position + 1 ) % len(self.slots)
+            slot = self.slots[self.position]
+            due = []
+            remaining = []
+            for timer in slot:
+                if timer.cancelled:
+                    continue
+                if timer.rounds > 0:
+                    timer.rounds -= 1
+                    remaining.append(timer)
+                else:
+                    due.append(timer)
+            self.slots[self.position] = remaining
+
+        for timer in due:
+            try:
+                timer.callback()
+            except Exception:
+                traceback.print_exc()
+
+    def run(self):
+        next_tick = time.time() + self.resolution
+        while True:
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.tick()
+            next_tick += self.resolution
@@ -1,7 +1,11 @@
 import re
+import threading
+import collections
 
 from .common import *
 
+DEFAULT_MATCH_CACHE_SIZE = 1024
+
 ###########################################
 # Handling of URIs
 ###########################################
@@ -98,9 +102,322 @@ class WAMPURI(object):
     def get(self,k,default=None):
         return self.payload.get(k,default)
 
+    def index_path(self):
+        """ Returns a tuple of (kind, segments, key) describing where this
+            URI should live in a WAMPURIIndex.
+
+            kind is one of 'exact', 'prefix', 'wildcard' or 'regex'.
+            segments are the complete leading dot separated segments that
+            any matching URI must start with (for 'wildcard', all of the
+            pattern's segments with '' standing in for the wildcards).
+            key is the exact uri for 'exact' and the trailing partial
+            segment for 'prefix'
+        """
+        if self.scheme == 'exact':
+            return 'exact', [], self.uri
+
+        elif self.options.get('match') == 'wildcard':
+            return 'wildcard', self.match_uri.split('.'), None
+
+        elif self.scheme == 'prefix':
+            segments = self.match_uri.split('.')
+            return 'prefix', segments[:-1], segments[-1]
+
+        # For regex matches, we can only depend on the segments before
+        # the first wildcard. The final segment is never complete since
+        # '**' style matches are prefixes
+        literal = []
+        segments = self.match_uri.split('.')
+        for segment in segments[:-1]:
+            if '*' in segment:
+                break
+            literal.append(segment)
+        return 'regex', literal, None
+
+class WAMPURITrieNode(object):
+    """ A single dot segment in the WAMPURIIndex's trie
+    """
+    def __init__(self):
+        self.children = {}
+        self.prefixes = {}
+        self.regexes = []
+
+        # Wildcard patterns get an edge of their own that stands for
+        # the empty segment, and are listed on the node where they end
+        self.wildcard = None
+        self.patterns = []
+
+    def empty(self):
+        return not ( self.children or self.prefixes or self.regexes
+                        or self.wildcard or self.patterns )
+
+    def child(self,segment):
+        if segment == '':
+            return self.wildcard
+        return self.children.get(segment)
+
+    def add_child(self,segment):
+        if segment == '':
+            if not self.wildcard:
+                self.wildcard = WAMPURITrieNode()
+            return self.wildcard
+        return self.children.setdefault(segment,WAMPURITrieNode())
+
+    def remove_child(self,segment):
+        if segment == '':
+            self.wildcard = None
+        else:
+            del self.children[segment]
+
+class WAMPURIIndex(object):
+    """ Routing index for a collection of WAMPURI objects. Exact URIs
+        are found via a dict, prefix and pattern URIs are placed in a
+        trie keyed by dot segments so that a lookup only needs to walk
+        as deep as the URI being matched. Regexes are only evaluated
+        for the trie nodes visited along the way.
+
+        Wildcard patterns live in a trie of their own where the empty
+        segment is an edge that consumes one or more of the URI's
+        segments, so they're matched without any regexes at all.
+
+        Results are returned in the order the entries were added (or
+        in the order provided to rebuild)
+    """
+    def __init__(self,data=None):
+        self.rebuild(data or [])
+
+    def rebuild(self,data):
+        self.exact = {}
+        self.root = WAMPURITrieNode()
+        self.wildcards = WAMPURITrieNode()
+        self.positions = {}
+        self.counter = 0
+        for item in data:
+            self.add(item)
+
+    def add(self,item):
+        self.positions[item] = self.counter
+        self.counter += 1
+
+        kind, segments, key = item.index_path()
+        if kind == 'exact':
+            self.exact.setdefault(key,[]).append(item)
+            return
+
+        node = self.wildcards if kind == 'wildcard' else self.root
+        for segment in segments:
+            node = node.add_child(segment)
+
+        if kind == 'prefix':
+            node.prefixes.setdefault(key,[]).append(item)
+        elif kind == 'wildcard':
+            node.patterns.append(item)
+        else:
+            node.regexes.append(item)
+
+    def discard(self,item):
+        if item not in self.positions:
+            return
+        del self.positions[item]
+
+        kind, segments, key = item.index_path()
+        if kind == 'exact':
+            entries = self.exact[key]
+            entries.remove(item)
+            if not entries:
+                del self.exact[key]
+            return
+
+        path = [self.wildcards if kind == 'wildcard' else self.root]
+        for segment in segments:
+            path.append(path[-1].child(segment))
+
+        node = path[-1]
+        if kind == 'prefix':
+            entries = node.prefixes[key]
+            entries.remove(item)
+            if not entries:
+                del node.prefixes[key]
+        elif kind == 'wildcard':
+            node.patterns.remove(item)
+        else:
+            node.regexes.remove(item)
+
+        # Prune any branches that no longer hold anything
+        for i in range(len(segments),0,-1):
+            if not path[i].empty():
+                break
+            path[i-1].remove_child(segments[i-1])
+
+    def match_wildcards(self,segments):
+        """ Returns the wildcard patterns matching the URI's segments.
+            Each (node, depth) pair is visited at most once however
+            many ways the wildcards could be lined up to reach it
+        """
+        matches = []
+        count = len(segments)
+        pending = [(self.wildcards,0)]
+        seen = set()
+        while pending:
+            node, depth = pending.pop()
+            if ( id(node), depth ) in seen:
+                continue
+            seen.add(( id(node), depth ))
+            if depth == count:
+                matches.extend(node.patterns)
+                continue
+            child = node.children.get(segments[depth])
+            if child:
+                pending.append((child,depth+1))
+            if node.wildcard:
+                for end in range(depth+1,count+1):
+                    pending.append((node.wildcard,end))
+        return matches
+
+    def match(self,uri):
+        matches = list(self.exact.get(uri,[]))
+
+        segments = uri.split('.')
+        depth = 0
+        node = self.root
+        while node:
+            if depth < len(segments):
+                segment = segments[depth]
+                for partial, entries in node.prefixes.items():
+                    if segment.startswith(partial):
+                        matches.extend(entries)
+            for entry in node.regexes:
+                if entry.match(uri):
+                    matches.append(entry)
+            if depth >= len(segments):
+                break
+            node = node.children.get(segments[depth])
+            depth += 1
+
+        if not self.wildcards.empty():
+            matches.extend(self.match_wildcards(segments))
+
+        if len(matches) > 1:
+            positions = self.positions
+            matches.sort(key=lambda m: positions[m])
+        return matches
+
 class WAMPURIList(Listable):
+    """ An ordered collection of WAMPURIs that can be quickly matched
+        against. Entries are kept in an ordered dict rather than a list
+        so that single entries can be discarded without rebuilding
+        the whole collection.
+
+        Entries are added and removed from any thread (as clients come
+        and go) while others are matching, so changes to the entries
+        and index, along with lookups in the index, happen under lock
+    """
+    def __init__(self,data=None,cache_size=DEFAULT_MATCH_CACHE_SIZE):
+        self.lock = threading.RLock()
+        super(WAMPURIList,self).__init__(data)
+        self.index = WAMPURIIndex(self.data)
+
+        # LRU of uri => (generation, matches). Any change to the list
+        # bumps the generation so stale results are never returned
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self.generation += 1
+
+    @property
+    def data(self):
+        with self.lock:
+            return list(self.entries)
+
+    @data.setter
+    def data(self,data):
+        with self.lock:
+            self.entries = collections.OrderedDict(
+                                (item,None) for item in data
+                            )
+
+    def append(self,item):
+        with self.lock:
+            self.entries[item] = None
+            self.index.add(item)
+            self.invalidate()
+
+    def discard(self,item):
+        """ Removes a single entry. Returns True if it was found
+        """
+        with self.lock:
+            if item not in self.entries:
+                return False
+            del self.entries[item]
+            self.index.discard(item)
+            self.invalidate()
+            return True
+
+    def remove(self,filter_function):
+        with self.lock:
+            removed = super(WAMPURIList,self).remove(filter_function)
+            for item in removed:
+                self.index.discard(item)
+            self.invalidate()
+            return removed
+
+    def sort(self,key):
+        with self.lock:
+            self.data = sorted(self.entries,key=key)
+            self.index.rebuild(self.data)
+            self.invalidate()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for item in self.data:
+            yield item
+
+    def set_cache_size(self,cache_size):
+        with self.cache_lock:
+            self.cache_size = cache_size
+            while len(self.cache) > max(cache_size,0):
+                self.cache.popitem(last=False)
+
+    def cache_stats(self):
+        """ Returns the hit/miss counters for the match cache
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.cache),
+            'cache_size': self.cache_size,
+            'generation': self.generation,
+        }
+
     def match(self,uri):
-        return list(self.filter(
-            lambda u: u.match(uri)
-        ))
+        if self.cache_size <= 0:
+            with self.lock:
+                return self.index.match(uri)
+
+        generation = self.generation
+        with self.cache_lock:
+            cached = self.cache.get(uri)
+            if cached and cached[0] == generation:
+                self.cache.move_to_end(uri)
+                self.hits += 1
+                return list(cached[1])
+            self.misses += 1
+
+        with self.lock:
+            generation = self.generation
+            matches = self.index.match(uri)
+
+        with self.cache_lock:
+            self.cache[uri] = (generation, matches)
+            self.cache.move_to_end(uri)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
 
+        return list(matches)
@@ -1,3 +1,5 @@
+import copy
+
 from .app import *
 
 class IZaberFlaskLocalWAMP(object):
@@ -13,6 +15,8 @@ class IZaberFlaskLocalWAMP(object):
 
     def register(self,uri,options=None):
         """ A method to use a decorator to register a callback
+            The callback may also be an `async def` coroutine function
+            in which case it is run on the asyncio executor
         """
         def actual_register_decorator(f):
             self.app.register_local(uri, f, options)
@@ -21,6 +25,8 @@ class IZaberFlaskLocalWAMP(object):
 
     def subscribe(self,uri,options=None):
         """ A method to use a decorator to subscribe a callback
+            The callback may also be an `async def` coroutine function
+            in which case it is run on the asyncio executor
         """
         def actual_subscribe_decorator(f):
             self.app.subscribe_local(uri, f, options)
@@ -28,13 +34,38 @@ class IZaberFlaskLocalWAMP(object):
         return actual_subscribe_decorator
 
     def publish(self,topic,options=None,args=None,kwargs=None):
-        self.app.publish(PUBLISH(
-            options=options or {},
+        """ Publishes an event. With options={'delta': True} the kwargs
+            are treated as the topic's state and subscribers that ask
+            for it only receive what changed since the last publish
+        """
+        options = options or {}
+        kwargs = kwargs or {}
+
+        # The router holds on to delta state to diff against so it
+        # can't share the dict the caller will go on to modify
+        if options.get('delta'):
+            kwargs = copy.deepcopy(kwargs)
+
+        return self.app.publish(PUBLISH(
+            options=options,
             topic=topic,
             args=args or [],
-            kwargs=kwargs or {}
+            kwargs=kwargs
         ))
 
+    def publish_many(self,publications):
+        """ Publishes a list of {'topic','args','kwargs','options'}
+            dicts. Subscribers are matched once per topic and each
+            session gets its events written together
+        """
+        batch = []
+        for publication in publications:
+            publication = dict(publication)
+            if ( publication.get('options') or {} ).get('delta'):
+                publication['kwargs'] = copy.deepcopy(publication.get('kwargs') or {})
+            batch.append(publication)
+        return self.app.publish_many(batch)
+
     def wamp_connect(self):
         """ A decorator to attach to when someone connects
         """
@@ -17,6 +17,10 @@ setup(name='izaber_flask_wamp',
           'Flask-Sockets',
           'swampyer',
       ],
+      extras_require={
+          'msgpack': ['msgpack'],
+          'fast': ['orjson'],
+      },
       setup_requires=["pytest-runner",],
       tests_require=["pytest",],
       dependency_links=[],
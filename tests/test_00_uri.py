@@ -66,3 +66,143 @@ def test_matching():
     assert len(match_list.match('a')) == 2
     assert len(match_list.match('a.b')) == 3
 
+def test_index():
+
+    # The index should always agree with a plain linear scan
+    patterns = [
+        ('a', None),
+        ('a.b', None),
+        ('a*', None),
+        ('a.b*', None),
+        ('a.*', None),
+        ('a**', None),
+        ('a.b**', None),
+        ('a.*.b', None),
+        ('*.c', None),
+        ('a.*.b', {'match':'exact'}),
+        ('a.b', {'match':'prefix'}),
+        ('a.', {'match':'prefix'}),
+        ('a..b', {'match':'wildcard'}),
+        ('..c', {'match':'wildcard'}),
+        ('a.', {'match':'wildcard'}),
+        ('a..b.', {'match':'wildcard'}),
+        ('', {'match':'wildcard'}),
+        ('*', None),
+    ]
+    uris = [ '', 'a', 'b', 'ab', 'a.b', 'a.bc', 'a.b.c', 'a.c.b',
+             'a.c.d.b', 'a.*.b', 'x.c', 'x.y.c', 'b.a', 'a.', 'a..b',
+             'a.c.b.d', 'a.b.b.b', 'c', '..c' ]
+
+    match_list = WAMPURIList()
+    entries = []
+    for uri, options in patterns:
+        entry = WAMPURI(uri,options=options)
+        entries.append(entry)
+        match_list.append(entry)
+
+    def linear(uri):
+        return [ e for e in match_list if e.match(uri) ]
+
+    for uri in uris:
+        assert match_list.match(uri) == linear(uri)
+
+    # Removals should keep the index consistent
+    match_list.remove(lambda e: e.uri in ('a.b*','a..b','a'))
+    for uri in uris:
+        assert match_list.match(uri) == linear(uri)
+
+    # As should reordering the list
+    match_list.sort(key=lambda e: e.uri)
+    for uri in uris:
+        assert match_list.match(uri) == linear(uri)
+
+def test_wildcard_index():
+
+    # Wildcards are followed through the trie rather than tested
+    # one by one, so the number of patterns doesn't matter
+    match_list = WAMPURIList(cache_size=0)
+    for n in range(10000):
+        match_list.append(WAMPURI('dev..s{}'.format(n),options={'match':'wildcard'}))
+    match_list.append(WAMPURI('dev..s5.',options={'match':'wildcard'}))
+
+    tested = []
+    def counting(self,uri,match=WAMPURI.match):
+        tested.append(self)
+        return match(self,uri)
+    WAMPURI.match, original = counting, WAMPURI.match
+    try:
+        matches = match_list.match('dev.x.s5')
+        assert [ m.uri for m in matches ] == ['dev..s5']
+        matches = match_list.match('dev.x.y.s5.z')
+        assert [ m.uri for m in matches ] == ['dev..s5.']
+        assert match_list.match('prod.x.s5') == []
+        assert tested == []
+    finally:
+        WAMPURI.match = original
+
+def test_match_cache():
+
+    match_list = WAMPURIList(cache_size=2)
+    match_list.append(WAMPURI('a.b'))
+    match_list.append(WAMPURI('a*'))
+
+    assert len(match_list.match('a.b')) == 2
+    assert len(match_list.match('a.b')) == 2
+    stats = match_list.cache_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+    # Changes to the list must never serve stale results
+    match_list.append(WAMPURI('a.b',options={'match':'prefix'}))
+    assert len(match_list.match('a.b')) == 3
+    match_list.remove(lambda e: e.uri == 'a*')
+    assert len(match_list.match('a.b')) == 2
+    assert match_list.cache_stats()['misses'] == 3
+
+    # And the cache stays bounded
+    match_list.match('a.c')
+    match_list.match('a.d')
+    assert match_list.cache_stats()['size'] == 2
+
+
+def test_uri_list_threads():
+
+    import threading
+
+    # Matching while other threads add and remove entries
+    uri_list = WAMPURIList(cache_size=0)
+    for i in range(50):
+        uri_list.append(WAMPURI('a.b.c{}'.format(i),options={'match':'prefix'}))
+
+    errors = []
+    stop = threading.Event()
+    def churn(n):
+        try:
+            while not stop.is_set():
+                entries = [
+                    WAMPURI('a.b.c',options={'match':'prefix'}),
+                    WAMPURI('a..c{}'.format(n),options={'match':'wildcard'}),
+                    WAMPURI('a.b.c{}'.format(n)),
+                ]
+                for entry in entries:
+                    uri_list.append(entry)
+                for entry in entries:
+                    uri_list.discard(entry)
+        except Exception as ex:
+            errors.append(ex)
+    def matcher():
+        try:
+            while not stop.is_set():
+                uri_list.match('a.b.c1')
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [ threading.Thread(target=churn,args=(i,)) for i in range(3) ]
+    threads += [ threading.Thread(target=matcher) for i in range(3) ]
+    for thread in threads:
+        thread.start()
+    stop.wait(0.5)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
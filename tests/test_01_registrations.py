@@ -214,3 +214,444 @@ def test_subscriptions():
     regs.reap_client(client)
     assert len(regs.subscribed) == 0
 
+
+class ClosableMockClient(MockClient):
+    def __init__(self,name):
+        super(ClosableMockClient,self).__init__()
+        self.name = name
+        self.is_closed = False
+        self.invocations = []
+
+    def closed(self):
+        return self.is_closed
+
+    def send_and_await_response(self,send_message,on_yield):
+        self.invocations.append(send_message)
+        on_yield(YIELD(
+                    request_id=send_message.request_id,
+                    options={},
+                    args=[self.name],
+                    kwargs={}
+                ))
+
+def test_shared_registrations():
+
+    regs = WAMPRegistrations()
+
+    class Caller(object):
+        session_id = 1
+        auth = {}
+
+    def call(uri):
+        data_capture = {}
+        regs.invoke(Caller(),CALL(
+                          options={},
+                          procedure=uri,
+                          args=[],
+                          kwargs={}
+                        ),lambda r: data_capture.setdefault('result',r))
+        return data_capture['result'].args[0]
+
+    # Round robin across callees
+    a = ClosableMockClient('a')
+    b = ClosableMockClient('b')
+    regs.register_remote('rr',a,{'invoke':'roundrobin'})
+    regs.register_remote('rr',b,{'invoke':'roundrobin'})
+    assert sorted([call('rr'),call('rr')]) == ['a','b']
+
+    # Mismatched policies are refused
+    try:
+        regs.register_remote('rr',ClosableMockClient('c'),{'invoke':'first'})
+        assert False
+    except Exception as ex:
+        assert str(ex) == 'wamp.error.procedure_already_exists'
+
+    # Closed clients get skipped rather than failing the call
+    a.is_closed = True
+    assert call('rr') == 'b'
+    assert call('rr') == 'b'
+    assert len(regs.registered) == 1
+
+    # First and last
+    regs.register_remote('first',a,{'invoke':'first'})
+    c = ClosableMockClient('c')
+    d = ClosableMockClient('d')
+    regs.register_remote('last',c,{'invoke':'last'})
+    regs.register_remote('last',d,{'invoke':'last'})
+    assert call('last') == 'd'
+
+    # Single only ever allows one registration unless the
+    # original has gone away
+    regs.register_remote('single',c,{'invoke':'single'})
+    try:
+        regs.register_remote('single',d,{'invoke':'single'})
+        assert False
+    except Exception as ex:
+        assert str(ex) == 'wamp.error.procedure_already_exists'
+    c.is_closed = True
+    regs.register_remote('single',d,{'invoke':'single'})
+    assert call('single') == 'd'
+
+    # Everyone's gone
+    b.is_closed = True
+    try:
+        call('rr')
+        assert False
+    except Exception as ex:
+        assert str(ex) == 'uri does not exist'
+
+def test_least_loaded():
+
+    regs = WAMPRegistrations()
+
+    class Caller(object):
+        session_id = 1
+        auth = {}
+
+    class SlowClient(ClosableMockClient):
+        def send_and_await_response(self,send_message,on_yield):
+            self.invocations.append((send_message,on_yield))
+
+    a = SlowClient('a')
+    b = SlowClient('b')
+    regs.register_remote('ll',a,{'invoke':'least_loaded'})
+    regs.register_remote('ll',b,{'invoke':'least_loaded'})
+
+    for i in range(4):
+        regs.invoke(Caller(),CALL(
+                          options={},
+                          procedure='ll',
+                          args=[],
+                          kwargs={}
+                        ),lambda r: None)
+    assert len(a.invocations) == 2
+    assert len(b.invocations) == 2
+
+    # Once a finishes its work, it should get the next ones
+    for message, on_yield in a.invocations:
+        on_yield(YIELD(request_id=message.request_id,options={},args=[],kwargs={}))
+    a.invocations = []
+    regs.invoke(Caller(),CALL(
+                      options={},
+                      procedure='ll',
+                      args=[],
+                      kwargs={}
+                    ),lambda r: None)
+    assert len(a.invocations) == 1
+
+def test_progressive_results():
+
+    from six.moves import queue
+
+    regs = WAMPRegistrations()
+
+    class Caller(object):
+        session_id = 1
+        auth = {}
+
+    def chunky_call(invoke,count):
+        for i in range(count):
+            yield i
+    regs.register_local('chunky',chunky_call)
+
+    # With receive_progress each chunk arrives on its own
+    responses = queue.Queue()
+    regs.invoke(Caller(),CALL(
+                      options={'receive_progress':True},
+                      procedure='chunky',
+                      args=[3],
+                      kwargs={}
+                    ),responses.put)
+    for i in range(3):
+        result = responses.get(timeout=5)
+        assert result.details['progress']
+        assert result.args[0] == i
+    result = responses.get(timeout=5)
+    assert not result.details.get('progress')
+    assert result.args == []
+
+    # Without we get everything in one go
+    regs.invoke(Caller(),CALL(
+                      options={},
+                      procedure='chunky',
+                      args=[3],
+                      kwargs={}
+                    ),responses.put)
+    assert responses.get(timeout=5).args[0] == [0,1,2]
+
+    # Remote callees can send progressive yields as well
+    class ProgressiveClient(ClosableMockClient):
+        def send_and_await_response(self,send_message,on_yield):
+            assert send_message.details['receive_progress']
+            for i in range(2):
+                on_yield(YIELD(
+                            request_id=send_message.request_id,
+                            options={'progress':True},
+                            args=[i],
+                            kwargs={}
+                        ))
+            on_yield(YIELD(
+                        request_id=send_message.request_id,
+                        options={},
+                        args=['DONE'],
+                        kwargs={}
+                    ))
+
+    regs.register_remote('remote.chunky',ProgressiveClient('a'))
+    results = []
+    regs.invoke(Caller(),CALL(
+                      options={'receive_progress':True},
+                      procedure='remote.chunky',
+                      args=[],
+                      kwargs={}
+                    ),results.append)
+    assert [ r.args[0] for r in results ] == [0,1,'DONE']
+    assert [ bool(r.details.get('progress')) for r in results ] == [True,True,False]
+
+def test_client_indexes():
+
+    regs = WAMPRegistrations()
+
+    a = ClosableMockClient('a')
+    b = ClosableMockClient('b')
+
+    a_regs = [ regs.register_remote('a.{}'.format(i),a) for i in range(5) ]
+    a_subs = [ regs.subscribe_remote('a.{}'.format(i),a) for i in range(5) ]
+    b_reg = regs.register_remote('b',b)
+    b_sub = regs.subscribe_remote('b',b)
+
+    # Only the owner may unregister or unsubscribe
+    for unsubscriber, entry_id in ((regs.unregister,b_reg),(regs.unsubscribe,b_sub)):
+        try:
+            unsubscriber(entry_id,a)
+            assert False
+        except Exception as ex:
+            assert str(ex).startswith('wamp.error.no_such_')
+
+    assert regs.unregister(a_regs[0],a) == a_regs[0]
+    assert regs.unsubscribe(a_subs[0],a) == a_subs[0]
+    assert len(regs.registered) == 5
+    assert len(regs.subscribed) == 5
+
+    # Reaping only touches what the client owns
+    regs.reap_client(a)
+    assert len(regs.registered) == 1
+    assert len(regs.subscribed) == 1
+    assert a not in regs.client_registrations
+    assert a not in regs.client_subscriptions
+    assert list(regs.registrations_by_id) == [b_reg]
+    assert list(regs.subscriptions_by_id) == [b_sub]
+    assert regs.registered.match('a.1') == []
+
+def test_shared_subscriptions():
+
+    regs = WAMPRegistrations()
+
+    a = ClosableMockClient('a')
+    b = ClosableMockClient('b')
+    c = ClosableMockClient('c')
+
+    # Same pattern, same subscription
+    a_id = regs.subscribe_remote('topic',a)
+    b_id = regs.subscribe_remote('topic',b)
+    c_id = regs.subscribe_remote('topic',c,{'match':'prefix'})
+    assert a_id == b_id
+    assert a_id != c_id
+    assert len(regs.subscribed) == 2
+
+    regs.publish(PUBLISH(
+                    options={},
+                    topic='topic',
+                    args=['BARK'],
+                    kwargs={}
+                ))
+
+    # Everyone subscribed to the same pattern gets the same event
+    # which is only ever encoded once
+    assert a.received_message is b.received_message
+    assert a.received_message.subscription_id == a_id
+    assert c.received_message.subscription_id == c_id
+    assert encode_message(a.received_message) is encode_message(b.received_message)
+
+    # Unsubscribing one session leaves the others alone
+    regs.unsubscribe(a_id,a)
+    assert len(regs.subscribed) == 2
+    regs.reap_client(b)
+    assert len(regs.subscribed) == 1
+    assert a_id not in regs.subscriptions_by_id
+
+
+def test_subscription_filters():
+
+    regs = WAMPRegistrations()
+
+    online = ClosableMockClient('online')
+    also_online = ClosableMockClient('also_online')
+    north = ClosableMockClient('north')
+    warm = ClosableMockClient('warm')
+    everything = ClosableMockClient('everything')
+
+    sub_id = regs.subscribe_remote('device',online,{'filter':{'status':'online'}})
+    regs.subscribe_remote('device',also_online,{'filter':{'status':'online'}})
+    regs.subscribe_remote('device',north,{'filter':{'zone':{'in':['north','n']}}})
+    regs.subscribe_remote('device',warm,{'filter':{'temp':{'gte':10,'lt':30}}})
+    regs.subscribe_remote('device',everything)
+
+    # Identical filters are grouped
+    entry = regs.subscriptions_by_id[sub_id]
+    assert len(entry['filters']) == 3
+
+    def publish(**kwargs):
+        for client in (online,also_online,north,warm,everything):
+            client.received_message = None
+        regs.publish(PUBLISH(
+                        options={},
+                        topic='device',
+                        args=[],
+                        kwargs=kwargs
+                    ))
+        return set(
+            client.name
+            for client in (online,also_online,north,warm,everything)
+            if client.received_message
+        )
+
+    assert publish(status='online',zone='south',temp=5) \
+                == {'online','also_online','everything'}
+    assert publish(status='offline',zone='n',temp=29.5) \
+                == {'north','warm','everything'}
+    assert publish(temp='hot') == {'everything'}
+    assert publish(temp=True) == {'everything'}
+    assert publish(zone=['north']) == {'everything'}
+
+    # Nobody left who wants the event, so it's never built
+    regs.reap_client(everything)
+    assert publish(status='offline') == set()
+
+    # Leaving tidies up the group
+    regs.unsubscribe(sub_id,online)
+    assert len(entry['filters']) == 3
+    regs.unsubscribe(sub_id,also_online)
+    assert len(entry['filters']) == 2
+
+    # Bad filters are refused
+    for bad in ({'temp':{'near':10}},{'temp':{'gt':'ten'}},{'zone':{'in':'north'}},['x']):
+        try:
+            regs.subscribe_remote('device',online,{'filter':bad})
+            assert False
+        except Exception as ex:
+            assert 'invalid_argument' in str(ex)
+    assert online not in entry['subscribers']
+
+def test_queue_groups():
+
+    regs = WAMPRegistrations()
+
+    workers = [ ClosableMockClient('worker{}'.format(i)) for i in range(3) ]
+    for worker in workers:
+        regs.subscribe_remote('jobs',worker,{'group':'workers'})
+    auditor = ClosableMockClient('auditor')
+    sub_id = regs.subscribe_remote('jobs',auditor)
+
+    received = {}
+    def publish(count):
+        for i in range(count):
+            for client in workers + [auditor]:
+                client.received_message = None
+            regs.publish(PUBLISH(
+                            options={},
+                            topic='jobs',
+                            args=[i],
+                            kwargs={}
+                        ))
+            got = [ c.name for c in workers if c.received_message ]
+            assert len(got) == 1
+            received[got[0]] = received.get(got[0],0) + 1
+
+            # Subscribers outside the group see everything
+            assert auditor.received_message.args == [i]
+
+    # Round robin by default
+    publish(30)
+    assert received == {'worker0':10,'worker1':10,'worker2':10}
+
+    # Closed members are skipped
+    workers[0].is_closed = True
+    received.clear()
+    publish(10)
+    assert set(received) == {'worker1','worker2'}
+    regs.reap_client(workers[0])
+    assert len(regs.subscriptions_by_id[sub_id]['groups']['workers'].clients) == 2
+
+    # Policies can't be changed out from under the group
+    try:
+        regs.subscribe_remote('jobs',ClosableMockClient('x'),
+                                {'group':'workers','group_policy':'least_outstanding'})
+        assert False
+    except Exception as ex:
+        assert 'group_policy_mismatch' in str(ex)
+
+def test_least_outstanding_groups():
+
+    regs = WAMPRegistrations()
+
+    class Outbound(object):
+        def __init__(self,depth):
+            self.depth = depth
+        def __len__(self):
+            return self.depth
+
+    busy = ClosableMockClient('busy')
+    busy.outbound = Outbound(100)
+    idle = ClosableMockClient('idle')
+    idle.outbound = Outbound(0)
+    for client in (busy,idle):
+        regs.subscribe_remote('jobs',client,
+                            {'group':'workers','group_policy':'least_outstanding'})
+
+    for i in range(10):
+        regs.publish(PUBLISH(options={},topic='jobs',args=[i],kwargs={}))
+    assert busy.received_message is None
+    assert idle.received_message.args == [9]
+
+def test_publish_many():
+
+    regs = WAMPRegistrations()
+
+    class BatchClient(ClosableMockClient):
+        def __init__(self,name):
+            super(BatchClient,self).__init__(name)
+            self.batches = []
+        def send_messages(self,messages):
+            self.batches.append(messages)
+
+    a = BatchClient('a')
+    b = ClosableMockClient('b')
+    regs.subscribe_remote('topic',a,{'match':'prefix'})
+    regs.subscribe_remote('topic.one',b)
+
+    lookups = []
+    match = regs.subscribed.match
+    def counting_match(uri):
+        lookups.append(uri)
+        return match(uri)
+    regs.subscribed.match = counting_match
+
+    publish_ids = regs.publish_many([
+        PUBLISH(options={},topic='topic.one',args=[i],kwargs={})
+        for i in range(10)
+    ] + [
+        PUBLISH(options={},topic='topic.two',args=['two'],kwargs={})
+    ])
+    assert len(set(publish_ids)) == 11
+
+    # Each topic is only matched once
+    assert lookups == ['topic.one','topic.two']
+
+    # Clients that can take a batch get everything in one go
+    assert len(a.batches) == 1
+    assert [ e.args[0] for e in a.batches[0] ] == list(range(10)) + ['two']
+    assert a.batches[0][0].publish_id == publish_ids[0]
+
+    # Everyone else gets them one at a time
+    assert b.received_message.args == [9]
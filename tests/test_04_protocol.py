@@ -7,6 +7,7 @@ from izaber_flask_wamp.registrations import *
 from izaber_flask_wamp.app import *
 from izaber_flask_wamp.client import *
 from izaber_flask_wamp.authenticators import *
+from izaber_flask_wamp.authorizers import *
 
 class MockApp(object):
     realm = 'izaber'
@@ -84,3 +85,29 @@ def test_connect():
     assert message == WAMP_ERROR
 
 
+
+def test_disconnect():
+
+    class DisconnectingWamp(MockWamp):
+        def do_wamp_disconnect(self,*args):
+            pass
+
+    app = FlaskAppWrapper(MockApp())
+    ws = MockWebsocket()
+    ws.closed = False
+    app.authorizers.append(WAMPAuthorizeEverything('com.example.*'))
+    client = WAMPServiceClient(app,ws,DisconnectingWamp(),{})
+
+    client.receive_message(HELLO(realm='izaber',details={}))
+    client.receive_message(HELLO(realm='izaber',details={}))
+    client.receive_message(SUBSCRIBE(request_id=1,options={},topic='com.example.topic'))
+    client.receive_message(REGISTER(request_id=2,options={},procedure='com.example.procedure'))
+    assert app.clients == [client]
+    assert client in app.registrations.client_subscriptions
+
+    # Once it's gone, nothing should be holding on to the client
+    client.disconnected()
+    assert app.clients == []
+    assert not app.registrations.client_subscriptions.get(client)
+    assert not app.registrations.client_registrations.get(client)
+    assert client not in app.registrations.invocation_ids
@@ -70,3 +70,76 @@ def test_auth():
 
 
 
+
+def test_topic_state_permissions():
+    app = FlaskAppWrapper(MockApp())
+    app.authorizers.append(WAMPAuthorizeEverything('public.*'))
+    app.registrations.deltas.update('public.x',[],{'v':1})
+    app.registrations.deltas.update('secret.x',[],{'v':2})
+
+    def invoke(caller):
+        return INVOCATION(
+                    request_id=1,
+                    registration_id=1,
+                    details={'caller':caller,'caller_role':'anonymous'},
+                )
+
+    # Remote sessions only see what they could subscribe to
+    assert app.state_get(invoke(1234),'public.x')['kwargs'] == {'v':1}
+    try:
+        app.state_get(invoke(1234),'secret.x')
+        assert False
+    except Exception as ex:
+        assert str(ex) == 'wamp.error.not_authorized'
+
+    # The server itself isn't restricted
+    assert app.state_get(invoke(0),'secret.x')['kwargs'] == {'v':2}
+
+def test_topic_history_permissions(tmp_path):
+    app = FlaskAppWrapper(MockApp())
+    app.authorizers.append(WAMPAuthorizeEverything('public.*'))
+    app.registrations.history = WAMPHistory(
+                                    str(tmp_path),
+                                    topics=['public.x','secret.x']
+                                )
+    for topic in ('public.x','secret.x'):
+        app.publish(PUBLISH(options={},topic=topic,args=[1],kwargs={}))
+    app.registrations.history.flush()
+
+    def invoke(caller):
+        return INVOCATION(
+                    request_id=1,
+                    registration_id=1,
+                    details={'caller':caller,'caller_role':'anonymous'},
+                )
+
+    assert len(app.history_get(invoke(1234),'public.x')) == 1
+    try:
+        app.history_get(invoke(1234),'secret.x')
+        assert False
+    except Exception as ex:
+        assert str(ex) == 'wamp.error.not_authorized'
+    assert len(app.history_get(invoke(0),'secret.x')) == 1
+    app.registrations.history.close()
+
+def test_publish_many_permissions():
+    app = FlaskAppWrapper(MockApp())
+    app.authorizers.append(WAMPAuthorizeEverything('public.*'))
+    invoke = INVOCATION(
+                request_id=1,
+                registration_id=1,
+                details={'caller':1234,'caller_role':'anonymous'},
+            )
+
+    ids = app.publish_many_procedure(invoke,[{'topic':'public.x'}])
+    assert len(ids) == 1
+
+    # One topic the caller can't publish to and nothing goes out
+    try:
+        app.publish_many_procedure(invoke,[
+            {'topic':'public.x'},
+            {'topic':'secret.x'},
+        ])
+        assert False
+    except Exception as ex:
+        assert str(ex) == 'wamp.error.not_authorized'
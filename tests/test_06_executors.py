@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+
+import threading
+
+from six.moves import queue
+
+from swampyer.messages import *
+
+from izaber_flask_wamp.executors import *
+from izaber_flask_wamp.registrations import *
+
+def square_call(invoke,a):
+    # Needs to live at module level so the process pool can find it
+    return [invoke.details['procedure'], a*a]
+
+PARENT_STATE = []
+
+def parent_state_call(invoke):
+    # A spawned worker imports this module afresh so it never sees
+    # what the parent process added
+    return list(PARENT_STATE)
+
+def test_thread_pool():
+
+    pool = WAMPThreadPool(workers=1,queue_depth=1)
+    results = queue.Queue()
+
+    # Hold the only worker so we can fill the queue up
+    release = threading.Event()
+    started = threading.Event()
+    def blocker():
+        started.set()
+        release.wait()
+        return 'released'
+
+    pool.submit(blocker,[],{},results.put,results.put)
+    started.wait(5)
+    assert pool.stats()['active_workers'] == 1
+
+    pool.submit(lambda a: a*2,[2],{},results.put,results.put)
+    assert pool.stats()['queue_depth'] == 1
+
+    # The queue is full so we should get rejected
+    try:
+        pool.submit(lambda: None,[],{},results.put,results.put)
+        assert False
+    except ExExecutorFull:
+        pass
+
+    release.set()
+    assert results.get(timeout=5) == 'released'
+    assert results.get(timeout=5) == 4
+
+    # Errors are passed along to on_error
+    errors = queue.Queue()
+    def explode():
+        raise Exception('Whoops')
+    pool.submit(explode,[],{},results.put,errors.put)
+    assert str(errors.get(timeout=5)) == 'Whoops'
+
+    pool.shutdown()
+
+def test_failing_callbacks():
+
+    pool = WAMPThreadPool(workers=2,queue_depth=10)
+    results = queue.Queue()
+    errors = queue.Queue()
+
+    # on_result blowing up (an unencodable result for instance) is
+    # reported through on_error and doesn't kill the workers
+    def unencodable(result):
+        raise TypeError('Object of type set is not JSON serializable')
+    for i in range(4):
+        pool.submit(lambda: set([1]),[],{},unencodable,errors.put)
+    for i in range(4):
+        assert isinstance(errors.get(timeout=5),TypeError)
+
+    pool.submit(lambda a: a*2,[2],{},results.put,results.put)
+    assert results.get(timeout=5) == 4
+    assert all( thread.is_alive() for thread in pool.threads )
+    pool.shutdown()
+
+    # Callers still get an answer when their RESULT can't be sent
+    regs = WAMPRegistrations()
+    regs.set_executor('thread',WAMPThreadPool(workers=1,queue_depth=1))
+    regs.register_local('bad',lambda invoke: set([1]))
+    responses = queue.Queue()
+    def send(message):
+        if message == WAMP_RESULT:
+            raise TypeError('Object of type set is not JSON serializable')
+        responses.put(message)
+    regs.invoke_local({'authid':'test','role':'test'},CALL(
+                          options={},
+                          procedure='bad',
+                          args=[],
+                          kwargs={}
+                        ),send)
+    error = responses.get(timeout=5)
+    assert error == WAMP_ERROR
+    assert 'not JSON serializable' in error.args[0]
+
+    # As do callers whose handler raised
+    def broken(invoke):
+        raise ValueError('broken')
+    regs.register_local('broken',broken)
+    regs.invoke_local({'authid':'test','role':'test'},CALL(
+                          request_id=3,
+                          options={},
+                          procedure='broken',
+                          args=[],
+                          kwargs={}
+                        ),responses.put)
+    error = responses.get(timeout=5)
+    assert error == WAMP_ERROR
+    assert error.request_code == WAMP_CALL
+    assert error.request_id == 3
+
+def test_rejected_invoke():
+
+    regs = WAMPRegistrations()
+    regs.set_executor('thread',WAMPThreadPool(workers=1,queue_depth=1))
+
+    release = threading.Event()
+    started = threading.Event()
+    def slow_call(invoke):
+        started.set()
+        release.wait()
+        return 'DONE'
+    regs.register_local('slow',slow_call)
+
+    responses = queue.Queue()
+    auth = {'authid':'test','role':'test'}
+    def call():
+        regs.invoke_local(auth,CALL(
+                              options={},
+                              procedure='slow',
+                              args=[],
+                              kwargs={}
+                            ),responses.put)
+
+    # One running, one waiting and then the third should bounce
+    call()
+    started.wait(5)
+    call()
+    call()
+    rejected = responses.get(timeout=5)
+    assert rejected == WAMP_ERROR
+    assert rejected.error == 'wamp.error.no_available_callee'
+    assert rejected.request_code == WAMP_CALL
+
+    release.set()
+    assert responses.get(timeout=5).args[0] == 'DONE'
+    assert responses.get(timeout=5).args[0] == 'DONE'
+
+def test_greenlet_pool():
+
+    import gevent
+
+    regs = WAMPRegistrations()
+    regs.set_executor('greenlet',WAMPGreenletPool(size=2))
+
+    def sleepy_call(invoke,a):
+        gevent.sleep(0.01)
+        return a
+    regs.register_local('sleepy',sleepy_call,{'executor':'greenlet'})
+
+    responses = []
+    auth = {'authid':'test','role':'test'}
+    for i in range(3):
+        regs.invoke_local(auth,CALL(
+                              options={},
+                              procedure='sleepy',
+                              args=[i],
+                              kwargs={}
+                            ),responses.append)
+
+    # Third call won't fit into the pool
+    assert len(responses) == 1
+    assert responses[0] == WAMP_ERROR
+    assert regs.executor_stats()['greenlet']['active_workers'] == 2
+
+    gevent.sleep(0.1)
+    assert sorted(r.args[0] for r in responses[1:]) == [0,1]
+
+def test_asyncio_handlers():
+
+    import asyncio
+
+    regs = WAMPRegistrations()
+
+    async def async_call(invoke,a):
+        await asyncio.sleep(0.01)
+        return a + 1
+    regs.register_local('async.call',async_call)
+
+    async def async_fail(invoke):
+        raise Exception('Whoops')
+    regs.register_local('async.fail',async_fail)
+
+    responses = queue.Queue()
+    auth = {'authid':'test','role':'test'}
+    regs.invoke_local(auth,CALL(
+                          options={},
+                          procedure='async.call',
+                          args=[1],
+                          kwargs={}
+                        ),responses.put)
+    assert responses.get(timeout=5).args[0] == 2
+
+    regs.invoke_local(auth,CALL(
+                          options={},
+                          procedure='async.fail',
+                          args=[],
+                          kwargs={}
+                        ),responses.put)
+    assert responses.get(timeout=5) == WAMP_ERROR
+
+    # Coroutine subscribers get the event on the loop as well
+    events = queue.Queue()
+    async def async_event(event):
+        events.put(event.args[0])
+    regs.subscribe_local('async.topic',async_event)
+    regs.publish(PUBLISH(
+                    options={},
+                    topic='async.topic',
+                    args=['BARK'],
+                    kwargs={}
+                ))
+    assert events.get(timeout=5) == 'BARK'
+
+def test_process_pool():
+
+    PARENT_STATE.append('router')
+    regs = WAMPRegistrations()
+    regs.set_executor('process',WAMPProcessPool(workers=1))
+    regs.register_local('square',square_call,{'executor':'process'})
+
+    responses = queue.Queue()
+    auth = {'authid':'test','role':'test'}
+    regs.invoke_local(auth,CALL(
+                          options={},
+                          procedure='square',
+                          args=[7],
+                          kwargs={}
+                        ),responses.put)
+    assert responses.get(timeout=30).args[0] == ['square',49]
+
+    # Workers don't inherit the router's memory
+    regs.register_local('state',parent_state_call,{'executor':'process'})
+    regs.invoke_local(auth,CALL(
+                          options={},
+                          procedure='state',
+                          args=[],
+                          kwargs={}
+                        ),responses.put)
+    assert responses.get(timeout=30).args[0] == []
+
+    regs.executors['process'].shutdown()
+
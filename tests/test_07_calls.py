@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+import time
+import threading
+
+from six.moves import queue
+
+from swampyer.messages import *
+
+from izaber_flask_wamp.timers import *
+from izaber_flask_wamp.registrations import *
+from izaber_flask_wamp.client import *
+
+class Caller(object):
+    session_id = 1
+    auth = {}
+
+class SilentClient(object):
+    """ A callee that never gets back to us
+    """
+    def __init__(self):
+        self.invocations = []
+        self.interrupts = []
+
+    def closed(self):
+        return False
+
+    def send_and_await_response(self,send_message,on_yield):
+        self.invocations.append((send_message,on_yield))
+
+    def interrupt(self,request_id,mode):
+        self.interrupts.append((request_id,mode))
+
+def test_timer_wheel():
+
+    wheel = WAMPTimerWheel(resolution=0.01,slots=4)
+    fired = queue.Queue()
+
+    wheel.schedule(0.02,lambda: fired.put('short'))
+    # Longer than a full rotation of the wheel
+    wheel.schedule(0.1,lambda: fired.put('long'))
+    cancelled = wheel.schedule(0.03,lambda: fired.put('cancelled'))
+    cancelled.cancel()
+
+    assert fired.get(timeout=5) == 'short'
+    assert fired.get(timeout=5) == 'long'
+    time.sleep(0.05)
+    assert fired.empty()
+
+def test_call_timeout():
+
+    regs = WAMPRegistrations()
+    regs.timers = WAMPTimerWheel(resolution=0.01)
+
+    release = threading.Event()
+    def slow_call(invoke):
+        release.wait()
+        return 'LATE'
+    regs.register_local('slow',slow_call)
+
+    responses = queue.Queue()
+    regs.invoke(Caller(),CALL(
+                      options={'timeout':50},
+                      procedure='slow',
+                      args=[],
+                      kwargs={}
+                    ),responses.put)
+    response = responses.get(timeout=5)
+    assert response == WAMP_ERROR
+    assert response.error == 'wamp.error.timeout'
+    assert regs.pending_calls() == 0
+
+    # The late result must not make it to the caller
+    release.set()
+    time.sleep(0.05)
+    assert responses.empty()
+
+    # Remote callees get interrupted when they take too long
+    client = SilentClient()
+    regs.register_remote('silent',client)
+    regs.invoke(Caller(),CALL(
+                      options={'timeout':50},
+                      procedure='silent',
+                      args=[],
+                      kwargs={}
+                    ),responses.put)
+    assert responses.get(timeout=5).error == 'wamp.error.timeout'
+    assert client.interrupts[0][1] == 'killnowait'
+
+def test_call_cancel():
+
+    regs = WAMPRegistrations()
+    client = SilentClient()
+    regs.register_remote('silent',client)
+
+    def call(request_id):
+        responses = []
+        regs.invoke(Caller(),CALL(
+                          request_id=request_id,
+                          options={},
+                          procedure='silent',
+                          args=[],
+                          kwargs={}
+                        ),responses.append)
+        return responses
+
+    # skip doesn't bother the callee
+    responses = call(1)
+    assert regs.cancel(Caller.session_id,1,'skip')
+    assert responses[0].error == 'wamp.error.canceled'
+    assert client.interrupts == []
+
+    # killnowait interrupts and replies immediately
+    responses = call(2)
+    assert regs.cancel(Caller.session_id,2,'killnowait')
+    assert responses[0].error == 'wamp.error.canceled'
+    assert client.interrupts == [(2,'killnowait')]
+
+    # kill waits for the callee to respond
+    responses = call(3)
+    assert regs.cancel(Caller.session_id,3,'kill')
+    assert responses == []
+    message, on_yield = client.invocations[-1]
+    on_yield(ERROR(
+                request_code = WAMP_INVOCATION,
+                request_id = message.request_id,
+                details = {},
+                error = 'wamp.error.canceled',
+                args = [],
+            ))
+    assert responses[0].error == 'wamp.error.canceled'
+
+    # Nothing left to cancel
+    assert not regs.cancel(Caller.session_id,3)
+    assert regs.pending_calls() == 0
+
+def test_invocation_ids():
+
+    class OtherCaller(object):
+        session_id = 2
+        auth = {}
+
+    regs = WAMPRegistrations()
+    client = SilentClient()
+    regs.register_remote('silent',client)
+
+    # Two callers using the same request_id
+    responses = {}
+    for caller in (Caller(),OtherCaller()):
+        responses[caller.session_id] = []
+        regs.invoke(caller,CALL(
+                          request_id=7,
+                          options={},
+                          procedure='silent',
+                          args=[],
+                          kwargs={}
+                        ),responses[caller.session_id].append)
+
+    # The callee sees two distinct invocations
+    first, second = [ message for message, on_yield in client.invocations ]
+    assert first.request_id != second.request_id
+
+    # Canceling one caller's call only interrupts that invocation
+    assert regs.cancel(OtherCaller.session_id,7,'killnowait')
+    assert client.interrupts == [(second.request_id,'killnowait')]
+    assert responses[Caller.session_id] == []
+
+    # And the callee's replies go back under the caller's request_id
+    on_yield = client.invocations[0][1]
+    on_yield(ERROR(
+                request_code = WAMP_INVOCATION,
+                request_id = first.request_id,
+                details = {},
+                error = 'com.example.error',
+                args = [],
+            ))
+    response = responses[Caller.session_id][0]
+    assert response.request_code == WAMP_CALL
+    assert response.request_id == 7
+    assert response.error == 'com.example.error'
+    assert regs.pending_calls() == 0
+
+def test_callee_disconnect():
+
+    class MockWebsocket(object):
+        closed = False
+        def send(self,data):
+            pass
+
+    callee = WAMPServiceClient(None,MockWebsocket(),None,{})
+    responses = []
+    callee.send_and_await_response(INVOCATION(
+                                        request_id=5,
+                                        registration_id=1,
+                                        details={},
+                                    ),responses.append)
+    callee.fail_pending()
+    assert responses[0].error == 'wamp.error.canceled'
+    assert callee._requests_pending == {}
+
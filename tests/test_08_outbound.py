@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+import time
+import gevent
+
+from izaber_flask_wamp.outbound import *
+
+class SlowWebsocket(object):
+    def __init__(self,delay=0):
+        self.delay = delay
+        self.closed = False
+        self.sent = []
+
+    def send(self,data):
+        if self.delay:
+            gevent.sleep(self.delay)
+        self.sent.append(data)
+
+    def close(self):
+        self.closed = True
+
+def test_outbound_writer():
+
+    # Without the writer running, we just write through
+    ws = SlowWebsocket()
+    outbound = WAMPOutboundQueue(ws)
+    outbound.put('a')
+    assert ws.sent == ['a']
+
+    # With the writer, the frames are sent in order by the greenlet
+    outbound.start()
+    for i in range(5):
+        outbound.put(str(i))
+    assert outbound.stats()['depth'] == 5
+    gevent.sleep(0.01)
+    assert ws.sent == ['a','0','1','2','3','4']
+    assert outbound.stats()['depth'] == 0
+    assert outbound.stats()['sent'] == 6
+    outbound.close()
+
+def test_outbound_policies():
+
+    # Older frames get thrown away when the peer can't keep up. The
+    # writer takes the first one before it gets stuck
+    ws = SlowWebsocket(delay=0.2)
+    outbound = WAMPOutboundQueue(ws,depth=2,policy='drop_oldest')
+    outbound.start()
+    for i in range(6):
+        outbound.put(str(i))
+    assert outbound.stats()['dropped'] == 3
+    gevent.sleep(1)
+    assert ws.sent == ['0','4','5']
+    outbound.close()
+
+    # Or we give up on them entirely
+    ws = SlowWebsocket(delay=0.2)
+    outbound = WAMPOutboundQueue(ws,depth=2,policy='disconnect')
+    outbound.start()
+    for i in range(5):
+        if outbound.closed:
+            break
+        outbound.put(str(i))
+    assert outbound.closed
+    gevent.sleep(0.3)
+    assert ws.closed
+
+    # Blocking waits for the writer to make room
+    ws = SlowWebsocket(delay=0.01)
+    outbound = WAMPOutboundQueue(ws,depth=1,policy='block')
+    outbound.start()
+    for i in range(3):
+        outbound.put(str(i))
+    gevent.sleep(0.1)
+    assert ws.sent == ['0','1','2']
+    assert outbound.stats()['dropped'] == 0
+    outbound.close()
+
+def test_outbound_coalesce():
+
+    class FakeStream(object):
+        def __init__(self):
+            self.writes = []
+        def write(self,data):
+            self.writes.append(data)
+        def read(self,size):
+            return b''
+
+    from geventwebsocket.websocket import WebSocket
+    stream = FakeStream()
+    ws = WebSocket({},stream,None)
+
+    outbound = WAMPOutboundQueue(ws,coalesce=True,coalesce_window=5)
+    outbound.start()
+    for i in range(10):
+        outbound.put(u'[36,1,2,{},["%d"]]' % i)
+    outbound.put(b'\x01\x02')
+    gevent.sleep(0.05)
+
+    # Everything went out in a single write
+    assert len(stream.writes) == 1
+    assert outbound.stats()['writes'] == 1
+    assert outbound.stats()['sent'] == 11
+
+    # And what went out is the same as sending them one by one
+    expected = FakeStream()
+    plain = WebSocket({},expected,None)
+    for i in range(10):
+        plain.send(u'[36,1,2,{},["%d"]]' % i)
+    plain.send(b'\x01\x02')
+    assert stream.writes[0] == b''.join(expected.writes)
+    outbound.close()
+
+
+def test_outbound_put_many():
+
+    ws = SlowWebsocket()
+    outbound = WAMPOutboundQueue(ws,depth=10)
+    outbound.start()
+    outbound.put_many([ str(i) for i in range(5) ])
+    assert outbound.stats()['depth'] == 5
+    gevent.sleep(0.01)
+    assert ws.sent == [ str(i) for i in range(5) ]
+
+    # Too many for a peer that's stopped reading falls back to the
+    # policy, which by default is to give up on the peer
+    ws.delay = 1
+    outbound.put_many([ str(i) for i in range(12) ])
+    assert outbound.stats()['high_water'] == 10
+    assert outbound.closed
+
+    # A batch bigger than the queue goes out in queue sized pieces
+    # to a peer that's keeping up
+    ws = SlowWebsocket()
+    outbound = WAMPOutboundQueue(ws,depth=1000)
+    outbound.start()
+    outbound.put_many([ str(i) for i in range(1500) ])
+    gevent.sleep(0.05)
+    assert not outbound.closed
+    assert ws.sent == [ str(i) for i in range(1500) ]
+    assert outbound.stats()['dropped'] == 0
+    assert outbound.stats()['high_water'] == 1000
+    outbound.close()
+
+def test_outbound_burst():
+
+    # A burst bigger than the queue from the writer's own greenlet
+    # goes out to a peer that's keeping up
+    ws = SlowWebsocket()
+    outbound = WAMPOutboundQueue(ws,depth=10)
+    outbound.start()
+    for i in range(11):
+        outbound.put(str(i))
+    gevent.sleep(0.01)
+    assert not outbound.closed
+    assert ws.sent == [ str(i) for i in range(11) ]
+    assert outbound.stats()['dropped'] == 0
+    outbound.close()
+
+def test_outbound_default_policy():
+
+    # A peer that's fallen behind doesn't hold up the sender
+    ws = SlowWebsocket(delay=1)
+    outbound = WAMPOutboundQueue(ws,depth=2)
+    outbound.start()
+    start = time.time()
+    for i in range(10):
+        if outbound.closed:
+            break
+        outbound.put(str(i))
+    assert time.time() - start < 0.5
+    assert outbound.closed
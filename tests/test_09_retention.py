@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+from swampyer.messages import *
+
+from izaber_flask_wamp.uri import *
+from izaber_flask_wamp.retention import *
+from izaber_flask_wamp.registrations import *
+
+def publish(regs,topic,value,retain=True):
+    return regs.publish(PUBLISH(
+                    options={'retain':retain},
+                    topic=topic,
+                    args=[value],
+                    kwargs={}
+                ))
+
+def test_retention():
+
+    regs = WAMPRegistrations()
+    regs.retention = WAMPRetention(depth=2,topics={'deep':3})
+
+    publish(regs,'a.b',1)
+    publish(regs,'a.b',2)
+    publish(regs,'a.b',3)
+    publish(regs,'a.c',4)
+    publish(regs,'a.c',5,retain=False)
+    for i in range(5):
+        publish(regs,'deep',i)
+
+    # Exact subscriptions only see their own topic, oldest first
+    sub_id = regs.subscribe_remote('a.b',object())
+    events = regs.retained_events(sub_id)
+    assert [ e.args[0] for e in events ] == [2,3]
+    assert events[0].subscription_id == sub_id
+    assert events[0].details == {'topic':'a.b','retained':True}
+
+    # Pattern subscriptions collect from every matching topic
+    sub_id = regs.subscribe_remote('a',object(),{'match':'prefix'})
+    events = regs.retained_events(sub_id)
+    assert sorted( e.args[0] for e in events ) == [2,3,4]
+
+    # Per topic depth overrides
+    sub_id = regs.subscribe_remote('deep',object())
+    assert [ e.args[0] for e in regs.retained_events(sub_id) ] == [2,3,4]
+
+    # Nothing retained
+    sub_id = regs.subscribe_remote('nothing',object())
+    assert regs.retained_events(sub_id) == []
+    assert regs.retained_events(12345) == []
+
+def test_retention_budget():
+
+    retention = WAMPRetention(depth=10,max_bytes=100)
+    retention.retain('old',1,['x'*40],{})
+    retention.retain('new',2,['y'*40],{})
+    retention.retain('new',3,['z'*40],{})
+
+    # The least recently published topic gets evicted first
+    stats = retention.stats()
+    assert stats['bytes'] <= 100
+    assert stats['evicted'] == 1
+    assert stats['topics'] == 1
+    assert retention.matching(WAMPURI('old')) == []
+    assert len(retention.matching(WAMPURI('new'))) == 2
+
+    # Depth 0 turns retention off for the topic
+    retention = WAMPRetention(topics={'off':0})
+    retention.retain('off',1,[],{})
+    assert retention.stats()['events'] == 0
+
+def test_retention_snapshot():
+
+    regs = WAMPRegistrations()
+
+    # The publisher changing its data afterwards doesn't change
+    # what gets replayed
+    kwargs = {'v': 1}
+    regs.publish(PUBLISH(options={'retain':True},topic='a.b',args=[],kwargs=kwargs))
+    kwargs['v'] = 2
+    sub_id = regs.subscribe_remote('a.b',object())
+    assert regs.retained_events(sub_id)[0].kwargs == {'v': 1}
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+import os
+import time
+
+from swampyer.messages import *
+
+from izaber_flask_wamp.history import *
+from izaber_flask_wamp.registrations import *
+
+def publish(regs,topic,value):
+    return regs.publish(PUBLISH(
+                    options={},
+                    topic=topic,
+                    args=[value],
+                    kwargs={'value':value}
+                ))
+
+def test_history(tmp_path):
+
+    regs = WAMPRegistrations()
+    regs.history = WAMPHistory(str(tmp_path),topics=['logged.*'],segment_bytes=256)
+
+    ids = [ publish(regs,'logged.a',i) for i in range(20) ]
+    publish(regs,'logged.b','other')
+    publish(regs,'unlogged','nope')
+    regs.history.flush()
+
+    # Small segments means the log was split up
+    topic_dir = os.path.join(str(tmp_path),'logged.a')
+    assert len([ f for f in os.listdir(topic_dir) if f.endswith('.log') ]) > 1
+
+    events = regs.history.read('logged.a')
+    assert [ e['args'][0] for e in events ] == list(range(20))
+    assert events[3]['publish_id'] == ids[3]
+    assert events[3]['kwargs'] == {'value':3}
+
+    # Catch up from a publication id
+    events = regs.history.read('logged.a',after=ids[14])
+    assert [ e['args'][0] for e in events ] == list(range(15,20))
+    assert regs.history.read('logged.a',after=ids[-1]) == []
+    events = regs.history.read('logged.a',after=ids[2],limit=3)
+    assert [ e['args'][0] for e in events ] == [3,4,5]
+
+    # By timestamp
+    all_events = regs.history.read('logged.a')
+    since = all_events[5]['timestamp']
+    events = regs.history.read('logged.a',since=since)
+    assert events[0]['timestamp'] >= since
+    assert len(regs.history.read('logged.a',until=0)) == 0
+
+    # Unknown ids and unlogged topics are errors
+    try:
+        regs.history.read('logged.a',after=12345)
+        assert False
+    except Exception as ex:
+        assert str(ex) == 'wamp.error.history_unavailable'
+    try:
+        regs.history.read('unlogged')
+        assert False
+    except Exception as ex:
+        assert str(ex) == 'wamp.error.history_unavailable'
+
+    assert regs.history.stats()['events'] == 21
+    regs.history.close()
+
+    # Everything survives a restart
+    history = WAMPHistory(str(tmp_path),topics=['logged.*'],segment_bytes=256)
+    events = history.read('logged.a',after=ids[9])
+    assert [ e['args'][0] for e in events ] == list(range(10,20))
+
+    # Lost index entries are recovered from the log
+    for fname in os.listdir(topic_dir):
+        if fname.endswith('.idx'):
+            os.unlink(os.path.join(topic_dir,fname))
+    history = WAMPHistory(str(tmp_path),topics=['logged.*'],segment_bytes=256)
+    assert len(history.read('logged.a')) == 20
+
+def test_history_trim(tmp_path):
+
+    history = WAMPHistory(str(tmp_path),topics=['t'],
+                            segment_bytes=256,max_bytes=1024,max_age=60)
+    for i in range(100):
+        history.append('t',i+1,['x'*20],{})
+    history.flush()
+    history.trim()
+
+    # Oldest segments go first once we're over budget
+    stats = history.stats()
+    assert stats['bytes'] <= 1024
+    assert stats['trimmed'] > 0
+    events = history.read('t')
+    assert events[-1]['publish_id'] == 100
+    assert events[0]['publish_id'] > 1
+
+    # Everything eventually ages out
+    history.trim(time.time()+120)
+    assert history.read('t') == []
+    assert history.stats()['events'] == 0
+
+def test_history_snapshot(tmp_path):
+
+    regs = WAMPRegistrations()
+    regs.history = WAMPHistory(str(tmp_path),topics=['logged.*'])
+
+    # Changes the publisher makes afterwards don't end up in history
+    kwargs = {'v': 1}
+    regs.publish(PUBLISH(options={},topic='logged.a',args=[],kwargs=kwargs))
+    kwargs['v'] = 2
+    kwargs['extra'] = True
+    regs.history.flush()
+    assert regs.history.read('logged.a')[0]['kwargs'] == {'v': 1}
+    regs.history.close()
+
+def test_history_payloads(tmp_path):
+
+    import decimal
+
+    history = WAMPHistory(str(tmp_path),topics=['t'])
+
+    # Payloads are encoded just as they are for EVENTs
+    history.append('t',1,[1.5,decimal.Decimal('2.5'),'x'],{'n':None})
+    history.flush()
+    event = history.read('t')[0]
+    assert event['args'] == [1.5,2.5,'x']
+    assert event['kwargs'] == {'n':None}
+    history.close()
+
+def test_history_open_files(tmp_path):
+
+    history = WAMPHistory(str(tmp_path),topics=['t.*'],max_open=2)
+
+    # Only the most recently written topics keep their files open
+    ids = {}
+    for i in range(5):
+        for topic in ('t.a','t.b','t.c'):
+            publish_id = secure_rand()
+            ids.setdefault(topic,[]).append(publish_id)
+            history.append(topic,publish_id,[i],{})
+        history.flush()
+        assert history.stats()['open_topics'] == 2
+    open_segments = [
+        topic_log for topic_log in history.logs.values()
+        if topic_log.active and topic_log.active.mm
+    ]
+    assert len(open_segments) == 2
+
+    # A topic that was closed picks up where it left off
+    topic_dir = os.path.join(str(tmp_path),'t.a')
+    assert len([ f for f in os.listdir(topic_dir) if f.endswith('.log') ]) == 1
+    for topic in ('t.a','t.b','t.c'):
+        events = history.read(topic)
+        assert [ e['args'][0] for e in events ] == list(range(5))
+        events = history.read(topic,after=ids[topic][2])
+        assert [ e['args'][0] for e in events ] == [3,4]
+    history.close()
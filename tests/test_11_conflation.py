@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import time
+
+from swampyer.messages import *
+
+from izaber_flask_wamp.registrations import *
+
+class RecordingClient(object):
+    def __init__(self):
+        self.messages = []
+
+    def closed(self):
+        return False
+
+    def send_message(self,message):
+        self.messages.append(message)
+
+def publish(regs,topic,value):
+    return regs.publish(PUBLISH(
+                    options={},
+                    topic=topic,
+                    args=[value],
+                    kwargs={}
+                ))
+
+def test_conflation():
+
+    regs = WAMPRegistrations()
+
+    fast = RecordingClient()
+    slow = RecordingClient()
+    regs.subscribe_remote('telemetry',fast,{'match':'prefix'})
+    regs.subscribe_remote('telemetry',slow,{'match':'prefix','conflate_ms':200})
+
+    for i in range(100):
+        publish(regs,'telemetry.a',i)
+        publish(regs,'telemetry.b',i)
+
+    # Regular subscribers see everything, conflated ones only get
+    # the first event per topic until the window closes
+    assert len(fast.messages) == 200
+    assert [ m.args[0] for m in slow.messages ] == [0,0]
+    assert regs.conflator.stats()['pending'] == 2
+
+    time.sleep(0.5)
+
+    # Then the newest event for each topic
+    latest = sorted(
+                ( m.details['topic'], m.args[0] )
+                for m in slow.messages[2:]
+            )
+    assert latest == [('telemetry.a',99),('telemetry.b',99)]
+    assert regs.conflator.stats()['pending'] == 0
+
+    # Unsubscribing drops anything still waiting
+    publish(regs,'telemetry.a','sent')
+    publish(regs,'telemetry.a','waiting')
+    assert slow.messages[-1].args[0] == 'sent'
+    regs.reap_client(slow)
+    assert regs.conflator.stats()['subscribers'] == 0
+    time.sleep(0.4)
+    assert slow.messages[-1].args[0] == 'sent'
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+import copy
+
+from swampyer.messages import *
+
+from izaber_flask_wamp.delta import *
+from izaber_flask_wamp.registrations import *
+
+class RecordingClient(object):
+    def __init__(self):
+        self.messages = []
+
+    def closed(self):
+        return False
+
+    def send_message(self,message):
+        self.messages.append(message)
+
+def test_json_diff():
+
+    old = {
+        'a': 1,
+        'b': {'c': [1,2,3], 'd': 'x'},
+        'gone': True,
+        'odd/key~': 1,
+    }
+    new = {
+        'a': 1.0,
+        'b': {'c': [1,5,3], 'd': 'x', 'e': None},
+        'odd/key~': 2,
+        'list': [1],
+    }
+    patch = json_diff(old,new)
+    assert {'op':'remove','path':'/gone'} in patch
+    assert {'op':'replace','path':'/a','value':1.0} in patch
+    assert {'op':'replace','path':'/b/c/1','value':5} in patch
+    assert {'op':'add','path':'/b/e','value':None} in patch
+    assert {'op':'replace','path':'/odd~1key~0','value':2} in patch
+    assert apply_patch(copy.deepcopy(old),patch) == new
+
+    assert json_diff(new,copy.deepcopy(new)) == []
+    assert json_diff({'a':[1]},{'a':[1,2]}) == [{'op':'replace','path':'/a','value':[1,2]}]
+
+def test_delta_publish():
+
+    regs = WAMPRegistrations()
+
+    plain = RecordingClient()
+    delta = RecordingClient()
+    regs.subscribe_remote('state',plain)
+    regs.subscribe_remote('state',delta,{'delta':True})
+
+    def publish(state):
+        regs.publish(PUBLISH(
+                        options={'delta':True},
+                        topic='state',
+                        args=[],
+                        kwargs=copy.deepcopy(state)
+                    ))
+
+    state = {'big': 'x'*1000, 'count': 0}
+    publish(state)
+
+    # Everyone starts with a snapshot
+    assert delta.messages[-1].kwargs == state
+    assert delta.messages[-1].details['state'] == 'snapshot'
+    assert delta.messages[-1].details['version'] == 1
+
+    held = copy.deepcopy(state)
+    for i in range(1,5):
+        state['count'] = i
+        publish(state)
+
+        # Plain subscribers keep getting the whole thing
+        assert plain.messages[-1].kwargs == state
+
+        # Delta subscribers only get the changes
+        event = delta.messages[-1]
+        assert event.kwargs == {}
+        assert event.details['state'] == 'delta'
+        assert event.details['base'] == i
+        assert event.details['version'] == i + 1
+        assert event.details['patch'] == [{'op':'replace','path':'/count','value':i}]
+        held = apply_patch(held,event.details['patch'])
+        assert held == state
+
+    assert regs.deltas.get('state').version == 5
+
+    # Late joiners (and resubscribers) get a snapshot first
+    late = RecordingClient()
+    regs.subscribe_remote('state',late,{'delta':True})
+    state['count'] = 100
+    publish(state)
+    assert late.messages[-1].details['state'] == 'snapshot'
+    assert late.messages[-1].kwargs == state
+    assert delta.messages[-1].details['state'] == 'delta'
+
+    # Ordinary publishes on the topic don't touch the state
+    regs.publish(PUBLISH(options={},topic='state',args=[],kwargs={'x':1}))
+    assert 'version' not in delta.messages[-1].details
+    assert regs.deltas.get('state').kwargs == state
+
+def test_delta_bounds():
+
+    regs = WAMPRegistrations()
+    regs.deltas.max_topics = 2
+
+    client = RecordingClient()
+    regs.subscribe_remote('state.a',client,{'delta':True})
+    other = regs.subscribe_remote('state.b',client,{'delta':True})
+
+    def publish(topic,count):
+        regs.publish(PUBLISH(
+                        options={'delta':True},
+                        topic=topic,
+                        args=[],
+                        kwargs={'count':count}
+                    ))
+        return client.messages[-1] if client.messages else None
+
+    publish('state.a',1)
+    assert publish('state.a',2).details['state'] == 'delta'
+
+    # Once the topic's state has been pushed out, the next publish is
+    # a full snapshot again
+    publish('state.b',1)
+    publish('state.c',1)
+    assert regs.deltas.get('state.a') is None
+    assert regs.deltas.stats()['evicted'] == 1
+    event = publish('state.a',3)
+    assert event.details['state'] == 'snapshot'
+    assert event.kwargs == {'count':3}
+    assert publish('state.a',4).details['state'] == 'delta'
+
+    # Unsubscribing from one topic leaves what the client has seen on
+    # its other subscriptions alone
+    publish('state.b',2)
+    regs.remove_subscriber(regs.subscriptions_by_id[other],client)
+    assert publish('state.a',5).details['state'] == 'delta'
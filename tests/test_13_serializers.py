@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+import json
+import pytest
+
+from swampyer.messages import *
+
+from izaber_flask_wamp.common import *
+from izaber_flask_wamp.app import *
+from izaber_flask_wamp.client import *
+
+class MockApp(object):
+    realm = 'izaber'
+
+class MockWebsocket(object):
+    def __init__(self,serializer=None):
+        self.environ = {}
+        if serializer:
+            self.environ['wamp.serializer'] = serializer
+        self.closed = False
+        self.last_sent = None
+
+    def send(self,data):
+        self.last_sent = data
+
+class MockWamp(object):
+    def do_wamp_authenticated(self,*args):
+        pass
+
+msgpack = pytest.importorskip('msgpack')
+
+def test_negotiation():
+
+    protocols = available_protocols()
+    assert protocols == ['wamp.2.json','wamp.2.msgpack']
+    assert available_protocols(['json']) == ['wamp.2.json']
+
+    # The client's order of preference wins
+    assert negotiate_protocol('wamp.2.msgpack, wamp.2.json',protocols) == 'wamp.2.msgpack'
+    assert negotiate_protocol('wamp.2.json,wamp.2.msgpack',protocols) == 'wamp.2.json'
+    assert negotiate_protocol('wamp.2.cbor,wamp.2.msgpack',['wamp.2.json']) is None
+    assert negotiate_protocol(None,protocols) is None
+    assert protocol_serializer('wamp.2.msgpack') == 'msgpack'
+
+def test_encoding():
+
+    event = EVENT(
+                subscription_id=1,
+                publish_id=2,
+                args=[b'\x00\x01'.decode('latin-1'),1.5],
+                kwargs={'a':[1,2,3]},
+                details={},
+            )
+
+    # Binary protocols give us bytes, and each serializer's frame
+    # is cached separately
+    event.frame_cache = {}
+    packed = encode_message(event,'msgpack')
+    text = encode_message(event)
+    assert isinstance(packed,bytes)
+    assert isinstance(text,six.text_type)
+    assert encode_message(event,'msgpack') is packed
+    assert json.loads(text) == json.loads(event.as_str())
+
+    decoded = decode_message(packed,'msgpack')
+    assert decoded == WAMP_EVENT
+    assert decoded.package() == decode_message(text).package()
+
+def test_msgpack_client():
+
+    app = FlaskAppWrapper(MockApp())
+    ws = MockWebsocket('msgpack')
+    client = WAMPServiceClient(app,ws,MockWamp(),{})
+    assert client.serializer == 'msgpack'
+
+    client.receive_message(decode_message(
+                                msgpack.dumps([1,'izaber',{}]),
+                                client.serializer
+                            ))
+    assert isinstance(ws.last_sent,bytes)
+    assert decode_message(ws.last_sent,'msgpack') == WAMP_WELCOME
+
+    # Plain websockets still get json
+    client = WAMPServiceClient(app,MockWebsocket(),MockWamp(),{})
+    assert client.serializer == 'json'
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+import json
+import decimal
+
+from datetime import datetime
+
+from swampyer.messages import EVENT
+
+from izaber_flask_wamp.jsoncodec import *
+from izaber_flask_wamp.common import *
+
+SAMPLES = [
+    [16,1,{},'com.example.procedure',[1,2.5,'three',None,True],{'a':{'b':[1]}}],
+    [36,123,456,{'topic':'a.b'},[u'unicodé ☃ "quoted" \\ /slash'],{}],
+    [50,9007199254740991,{},[[]],{'empty':{}}],
+]
+
+def test_stdlib_codec():
+
+    # The fallback is exactly what swampyer has always sent
+    codec = load_json_codec('json')
+    assert codec.name == 'json'
+    for sample in SAMPLES:
+        assert codec.dumps(sample) == json.dumps(sample)
+        assert codec.loads(codec.dumps(sample)) == sample
+
+def test_codecs_agree():
+
+    codec = load_json_codec()
+    assert codec.name in JSON_CODECS
+
+    stdlib = load_json_codec('json')
+    for sample in SAMPLES:
+        assert codec.loads(codec.dumps(sample)) == sample
+        assert codec.loads(stdlib.dumps(sample)) == sample
+        assert stdlib.loads(codec.dumps(sample)) == sample
+
+    # Types swampyer's encoder understands
+    when = datetime(2020,1,2,3,4,5,6)
+    odd = [decimal.Decimal('1.5'),when,when.date(),b'bytes',memoryview(b'view')]
+    assert json.loads(codec.dumps(odd)) == json.loads(stdlib.dumps(odd))
+
+    # Things the fast libraries choke on go through the stdlib
+    assert codec.dumps([2**70]) == stdlib.dumps([2**70])
+    assert codec.dumps({1:'int key'}) == stdlib.dumps({1:'int key'})
+    assert codec.loads('[NaN, 1237940039285380274899124224]')[1] == 2**90
+
+def test_selection():
+
+    # Asking for something that isn't installed falls back to stdlib
+    codec = load_json_codec('ujson')
+    assert codec.name in ('ujson','json')
+
+    try:
+        load_json_codec('nope')
+        assert False
+    except Exception as ex:
+        assert 'nope' in str(ex)
+
+    try:
+        assert set_json_codec('json').name == 'json'
+        event = EVENT(subscription_id=1,publish_id=2,args=[1],kwargs={},details={})
+        assert encode_message(event) == event.as_str()
+    finally:
+        set_json_codec('auto')
+
+def test_star_import():
+
+    # Only the codec names come along with a star import
+    namespace = {}
+    exec('import datetime\nfrom izaber_flask_wamp.jsoncodec import *',namespace)
+    assert isinstance(namespace['datetime'],type(json))
+    assert 'date' not in namespace
+    assert 'decimal' not in namespace
+    assert 'load_json_codec' in namespace
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+
+import json
+
+from swampyer.messages import *
+
+from izaber_flask_wamp.common import *
+from izaber_flask_wamp.passthrough import *
+from izaber_flask_wamp.registrations import *
+
+class CalleeClient(object):
+    def __init__(self):
+        self.sent = []
+        self.callbacks = {}
+
+    def closed(self):
+        return False
+
+    def send_and_await_response(self,request,callback):
+        self.sent.append(request)
+        self.callbacks[request.request_id] = callback
+
+class CallerClient(object):
+    session_id = 1
+    auth = {}
+
+def test_decode_header():
+
+    raw = u'[1, "two", {"three": 3.0}], {"big": "%s", "odd": "]\\"["}' % ('x'*100)
+    frame = u' [ 48 , 123, {"receive_progress": false}, "com.example.proc", %s ] ' % raw
+    call = decode_header(frame)
+    assert call == WAMP_CALL
+    assert call.request_id == 123
+    assert call.options == {'receive_progress': False}
+    assert call.procedure == 'com.example.proc'
+    assert call.raw_payload == raw
+
+    # Looking at the payload decodes it
+    assert call.args == [1,'two',{'three':3.0}]
+    assert call.raw_payload is None
+    assert call.kwargs['odd'] == ']"['
+
+    # Bytes work too, and so do messages without a payload
+    call = decode_header(b'[48,1,{},"com.example.proc"]')
+    assert call.raw_payload is None
+    assert call.args == [] and call.kwargs == {}
+
+    yielded = decode_header(u'[70,5,{},[1]]')
+    assert yielded == WAMP_YIELD
+    assert yielded.raw_payload == u'[1]'
+
+    # Other messages and anything odd get decoded normally
+    assert decode_header(u'[16,1,{},"topic",[1]]') is None
+    assert decode_header(u'[48,1,{} "oops",[1]]') is None
+    assert decode_header(u'[48,1,{},"proc",[1],{}') is None
+    assert decode_header(u'{"48":1}') is None
+
+def test_passthrough_routing():
+
+    regs = WAMPRegistrations()
+    callee = CalleeClient()
+    regs.register_remote('com.example.proc',callee)
+
+    raw = u'[{"payload": "%s"}], {"k": [1, 2, 3]}' % ('y'*1000)
+    call = decode_header(u'[48,77,{},"com.example.proc",%s]' % raw)
+
+    results = []
+    regs.invoke(CallerClient(),call,results.append)
+
+    # The callee receives exactly the text the caller sent
+    invocation = callee.sent[0]
+    assert invocation.raw_payload == raw
+    frame = encode_message(invocation)
+    assert frame.endswith(u',' + raw + u']')
+    assert json.loads(frame)[4][0]['payload'] == 'y'*1000
+
+    # And the callee's reply goes straight back
+    reply = u'["result %s"], {}' % ('z'*1000)
+    callee.callbacks[invocation.request_id](
+        decode_header(u'[70,%d,{},%s]' % (invocation.request_id,reply))
+    )
+    result = results[0]
+    assert result == WAMP_RESULT
+    assert result.request_id == 77
+    frame = encode_message(result)
+    assert frame.endswith(u',' + reply + u']')
+    assert decode_message(frame).args == ['result ' + 'z'*1000]
+
+    # The raw text only ever goes out as json
+    result = forward_payload(decode_header(u'[70,1,{},[1],{"a":2}]'),RESULT,
+                                request_id=1,details={})
+    assert decode_message(encode_message(result,'msgpack'),'msgpack').kwargs == {'a':2}
+
+    # Messages that were fully decoded are forwarded as normal
+    result = forward_payload(YIELD(request_id=1,options={},args=[3],kwargs={}),
+                                RESULT,request_id=1,details={})
+    assert getattr(result,'raw_payload',None) is None
+    assert result.args == [3]
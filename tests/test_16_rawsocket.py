@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+import os
+import struct
+import socket
+import tempfile
+
+import gevent
+import gevent.socket
+
+from swampyer.messages import *
+
+from izaber_flask_wamp.common import *
+from izaber_flask_wamp.rawsocket import *
+from izaber_flask_wamp.outbound import *
+from izaber_flask_wamp.app import *
+from izaber_flask_wamp.client import *
+
+class MockApp(object):
+    realm = 'izaber'
+
+class MockWamp(object):
+    def do_wamp_connect(self,*args):
+        pass
+
+    def do_wamp_disconnect(self,*args):
+        pass
+
+    def do_wamp_authenticated(self,*args):
+        pass
+
+def connect(address,family=socket.AF_INET):
+    sock = gevent.socket.socket(family,socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+def recv_exactly(sock,length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length-len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def send_message(sock,data,message_type=RAWSOCKET_REGULAR):
+    if isinstance(data,six.text_type):
+        data = data.encode('utf-8')
+    sock.sendall(struct.pack('>I',( message_type << 24 ) | len(data)) + data)
+
+def recv_message(sock):
+    header = recv_exactly(sock,4)
+    if len(header) < 4:
+        return None, None
+    value = struct.unpack('>I',header)[0]
+    return value >> 24, recv_exactly(sock,value & 0xFFFFFF)
+
+def session_server(address='127.0.0.1:0',protocols=None):
+    app = FlaskAppWrapper(MockApp())
+    wamp = MockWamp()
+    def session(transport):
+        WAMPServiceClient(app,transport,wamp,{}).run()
+    server = WAMPRawSocketServer(
+                    address,
+                    session,
+                    protocols or ['wamp.2.json'],
+                    max_length_exp=15,
+                )
+    server.start()
+    return app, server
+
+def test_handshake():
+
+    app, server = session_server()
+    try:
+        # json with the largest message size we can ask for
+        sock = connect(server.server_address)
+        sock.sendall(bytes(bytearray([0x7F,0xF1,0,0])))
+        assert bytearray(recv_exactly(sock,4)) == bytearray([0x7F,0xF1,0,0])
+        sock.close()
+
+        # msgpack wasn't allowed
+        sock = connect(server.server_address)
+        sock.sendall(bytes(bytearray([0x7F,0xF2,0,0])))
+        assert bytearray(recv_exactly(sock,4)) == bytearray([0x7F,0x10,0,0])
+        assert sock.recv(1) == b''
+        sock.close()
+
+        # Reserved bytes must be zero
+        sock = connect(server.server_address)
+        sock.sendall(bytes(bytearray([0x7F,0xF1,0,1])))
+        assert bytearray(recv_exactly(sock,4)) == bytearray([0x7F,0x30,0,0])
+        sock.close()
+
+        # Not WAMP at all, we just hang up
+        sock = connect(server.server_address)
+        sock.sendall(b'GET / HTTP/1.1\r\n\r\n')
+        assert sock.recv(4) == b''
+        sock.close()
+    finally:
+        server.stop()
+
+def test_session():
+
+    app, server = session_server()
+    try:
+        sock = connect(server.server_address)
+        sock.sendall(bytes(bytearray([0x7F,0xF1,0,0])))
+        recv_exactly(sock,4)
+
+        # PINGs are answered with the same payload
+        send_message(sock,b'abc',RAWSOCKET_PING)
+        assert recv_message(sock) == ( RAWSOCKET_PONG, b'abc' )
+
+        # A WAMP session runs over the stream like any websocket one
+        send_message(sock,encode_message(HELLO(realm='izaber',details={})))
+        message_type, data = recv_message(sock)
+        assert message_type == RAWSOCKET_REGULAR
+        assert WampMessage.loads(data.decode('utf-8')) == WAMP_WELCOME
+
+        # And shares the app's registrations
+        app.register_local('com.example.add',lambda invoke,a,b: a+b)
+        send_message(sock,encode_message(CALL(
+                            request_id=1,
+                            options={},
+                            procedure='com.example.add',
+                            args=[1,2],
+                            kwargs={}
+                        )))
+        gevent.sleep(0.1)
+        message_type, data = recv_message(sock)
+        result = WampMessage.loads(data.decode('utf-8'))
+        assert result == WAMP_RESULT
+        assert result.args == [3]
+        sock.close()
+    finally:
+        server.stop()
+
+def test_unix_socket():
+
+    path = os.path.join(tempfile.mkdtemp(),'wamp.sock')
+    app, server = session_server(path)
+    try:
+        sock = connect(path,socket.AF_UNIX)
+        sock.sendall(bytes(bytearray([0x7F,0xF1,0,0])))
+        assert bytearray(recv_exactly(sock,4)) == bytearray([0x7F,0xF1,0,0])
+        send_message(sock,b'',RAWSOCKET_PING)
+        assert recv_message(sock) == ( RAWSOCKET_PONG, b'' )
+        sock.close()
+    finally:
+        server.stop()
+    assert not os.path.exists(path)
+
+def test_frame_limits():
+
+    class MockSocket(object):
+        def __init__(self):
+            self.written = b''
+
+        def sendall(self,data):
+            self.written += data
+
+    # Messages are limited to what the peer said it would accept
+    sock = MockSocket()
+    transport = WAMPRawSocket(sock,None,'wamp.2.json',512,2**24)
+    transport.send(u'x'*512)
+    assert sock.written == b'\x00\x00\x02\x00' + b'x'*512
+    try:
+        transport.send(u'x'*513)
+        assert False
+    except Exception as ex:
+        assert 'payload_size_exceeded' in str(ex)
+    assert transport.environ['wamp.serializer'] == 'json'
+
+    # Coalesced writes use the RawSocket framing
+    sock = MockSocket()
+    transport = WAMPRawSocket(sock,None,'wamp.2.json',512,2**24)
+    outbound = WAMPOutboundQueue(transport,coalesce=True)
+    outbound.write([u'ab',b'c'])
+    assert sock.written == b'\x00\x00\x00\x02ab\x00\x00\x00\x01c'
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+import os
+import zlib
+import base64
+import struct
+
+import gevent
+import gevent.socket
+from gevent import pywsgi
+
+from izaber_flask_wamp.deflate import *
+from izaber_flask_wamp.app import *
+
+class EchoApp(object):
+    """ Sends back whatever it receives
+    """
+    allowed_protocols = ['wamp.2.json']
+    cookie_name = 'zfwid'
+
+    def __init__(self,deflate_options):
+        self.deflate_options = deflate_options
+        self.deflate_stats = WAMPDeflateStats()
+        self.sockets = []
+
+    def __call__(self,environ,start_response):
+        ws = environ['wsgi.websocket']
+        self.sockets.append(ws)
+        while True:
+            message = ws.receive()
+            if message is None:
+                break
+            ws.send(message)
+        return []
+
+def open_websocket(address,extensions):
+    sock = gevent.socket.create_connection(address)
+    key = base64.b64encode(os.urandom(16)).decode('ascii')
+    request = [
+        'GET /ws HTTP/1.1',
+        'Host: localhost',
+        'Upgrade: websocket',
+        'Connection: Upgrade',
+        'Sec-WebSocket-Key: {}'.format(key),
+        'Sec-WebSocket-Version: 13',
+        'Sec-WebSocket-Protocol: wamp.2.json',
+    ]
+    if extensions:
+        request.append('Sec-WebSocket-Extensions: {}'.format(extensions))
+    sock.sendall(('\r\n'.join(request) + '\r\n\r\n').encode('ascii'))
+
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += sock.recv(1)
+    headers = {}
+    for line in response.decode('ascii').split('\r\n')[1:]:
+        if ':' in line:
+            name, value = line.split(':',1)
+            headers[name.strip().lower()] = value.strip()
+    return sock, headers
+
+def recv_exactly(sock,length):
+    data = b''
+    while len(data) < length:
+        data += sock.recv(length-len(data))
+    return data
+
+def send_frame(sock,payload,opcode=0x1,rsv1=False):
+    first = 0x80 | opcode | ( 0x40 if rsv1 else 0 )
+    mask = os.urandom(4)
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB',first,0x80|length)
+    else:
+        header = struct.pack('!BBH',first,0x80|126,length)
+    masked = bytes(bytearray( b ^ mask[i%4] for i, b in enumerate(bytearray(payload)) ))
+    sock.sendall(header + mask + masked)
+
+def recv_frame(sock):
+    first, second = struct.unpack('!BB',recv_exactly(sock,2))
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack('!H',recv_exactly(sock,2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q',recv_exactly(sock,8))[0]
+    return first, recv_exactly(sock,length)
+
+def deflate(data):
+    compressor = zlib.compressobj(6,zlib.DEFLATED,-15)
+    return ( compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) )[:-4]
+
+def test_negotiation():
+
+    options = {'enabled': True}
+
+    params, response = negotiate_deflate('permessage-deflate',options)
+    assert response == 'permessage-deflate'
+    assert params['server_no_context_takeover'] is False
+    assert params['server_max_window_bits'] == 15
+
+    # The first offer we can accept wins
+    params, response = negotiate_deflate(
+                            'x-webkit-deflate-frame, '
+                            'permessage-deflate; server_max_window_bits=8, '
+                            'permessage-deflate; client_max_window_bits',
+                            options)
+    assert response == 'permessage-deflate'
+
+    # Our own settings are layered on top
+    params, response = negotiate_deflate(
+                            'permessage-deflate; client_max_window_bits; '
+                            'server_max_window_bits=12',
+                            {
+                                'enabled': True,
+                                'server_no_context_takeover': True,
+                                'client_max_window_bits': 10,
+                            })
+    assert response == 'permessage-deflate; server_no_context_takeover; ' \
+                        'server_max_window_bits=12; client_max_window_bits=10'
+    assert params['server_max_window_bits'] == 12
+
+    # Nothing we can use
+    assert negotiate_deflate(None,options) is None
+    assert negotiate_deflate('permessage-deflate; foo',options) is None
+    assert negotiate_deflate('permessage-deflate; server_max_window_bits',options) is None
+    assert negotiate_deflate('permessage-deflate; client_max_window_bits=16',options) is None
+    assert negotiate_deflate(
+                'permessage-deflate; server_no_context_takeover; '
+                'server_no_context_takeover',options) is None
+
+def test_compression():
+
+    app = EchoApp({
+                'enabled': True,
+                'min_bytes': 100,
+            })
+    server = pywsgi.WSGIServer(('127.0.0.1',0),app,handler_class=MyWebSocketHandler)
+    server.start()
+    try:
+        sock, headers = open_websocket(
+                            server.address,
+                            'permessage-deflate; client_max_window_bits')
+        assert headers['sec-websocket-extensions'] == 'permessage-deflate'
+        assert headers['sec-websocket-protocol'] == 'wamp.2.json'
+
+        # Large messages come back compressed
+        message = b'[36,1,2,{},[],{"value":"' + b'x'*1000 + b'"}]'
+        send_frame(sock,deflate(message),rsv1=True)
+        first, payload = recv_frame(sock)
+        assert first == 0x80 | 0x40 | 0x1
+        decompressor = zlib.decompressobj(-15)
+        assert decompressor.decompress(payload + b'\x00\x00\xff\xff') == message
+        assert len(payload) < len(message)
+
+        # With context takeover the next one builds on the last
+        send_frame(sock,message)
+        first, payload = recv_frame(sock)
+        assert first == 0x80 | 0x40 | 0x1
+        assert decompressor.decompress(payload + b'\x00\x00\xff\xff') == message
+
+        # Small ones don't
+        send_frame(sock,b'[1,"izaber",{}]')
+        first, payload = recv_frame(sock)
+        assert first == 0x80 | 0x1
+        assert payload == b'[1,"izaber",{}]'
+
+        gevent.sleep(0.01)
+        stats = app.deflate_stats.stats()
+        assert stats['compressed'] == 2
+        assert stats['skipped'] == 1
+        assert stats['uncompressed_bytes'] == 2*len(message)
+        assert stats['compressed_bytes'] < stats['uncompressed_bytes']
+        assert stats['inflated'] == 1
+        assert stats['inflated_uncompressed_bytes'] == len(message)
+        assert app.sockets[0].compression_stats()['compressed'] == 2
+        sock.close()
+
+        # Clients that don't ask get a plain websocket
+        sock, headers = open_websocket(server.address,None)
+        assert 'sec-websocket-extensions' not in headers
+        send_frame(sock,message)
+        first, payload = recv_frame(sock)
+        assert first == 0x80 | 0x1
+        assert payload == message
+        sock.close()
+    finally:
+        server.stop()
+
+def test_inflate_limit():
+
+    app = EchoApp({
+                'enabled': True,
+                'max_message_bytes': 1000,
+            })
+    server = pywsgi.WSGIServer(('127.0.0.1',0),app,handler_class=MyWebSocketHandler)
+    server.start()
+    try:
+        sock, headers = open_websocket(server.address,'permessage-deflate')
+        assert headers['sec-websocket-extensions'] == 'permessage-deflate'
+
+        # Something that inflates past the limit gets the connection closed
+        send_frame(sock,deflate(b'x'*5000),rsv1=True)
+        first, payload = recv_frame(sock)
+        assert first == 0x80 | 0x8
+        assert app.deflate_stats.stats()['inflated'] == 0
+        sock.close()
+    finally:
+        server.stop()